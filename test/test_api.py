@@ -1,5 +1,8 @@
 import time
+import threading
 import unittest
+from tlspyo.framing import encode_frame, encode_control
+
 from utils import HelperTester
 
 NUM_OBJECTS = 10
@@ -151,5 +154,258 @@ class TestAPI(unittest.TestCase):
         self.ht.clear()
 
 
+class TestStop(unittest.TestCase):
+
+    def setUp(self):
+        self.ht = HelperTester()
+
+    def test_stop(self):
+        relay = self.ht.spawn_relay(accepted_groups=None)
+        prod = self.ht.spawn_endpoint(groups='producer')
+        cons = self.ht.spawn_endpoint(groups='consumer', max_queue_len=1, overflow="block")
+        time.sleep(1.0)  # let everyone handshake the relay
+
+        # the producer stops as soon as its objects are acknowledged by the Relay:
+        prod.send_objects(range(NUM_OBJECTS), 'consumer')
+        t_start = time.monotonic()
+        prod.stop()
+        self.assertLess(time.monotonic() - t_start, 1.0)
+        self.assertEqual(cons.pop(blocking=True), [0])
+
+        # the consumer does not read the objects of the Relay anymore, which are never acknowledged:
+        large = bytes(1000000)
+        for _ in range(NUM_OBJECTS):
+            sender = self.ht.spawn_endpoint(groups='producer')
+            sender.send_object(large, 'consumer')
+            sender.stop()
+        t_start = time.monotonic()
+        relay.stop(timeout=0.5)
+        self.assertLess(time.monotonic() - t_start, 2.0)
+
+    def test_force_pending_stop(self):
+        relay = self.ht.spawn_relay(accepted_groups=None)
+        prod = self.ht.spawn_endpoint(groups='producer')
+        cons = self.ht.spawn_endpoint(groups='consumer', max_queue_len=1, overflow="block")
+        time.sleep(1.0)  # let everyone handshake the relay
+
+        # the consumer does not read the objects of the Relay anymore, which are never acknowledged:
+        large = bytes(1000000)
+        for _ in range(NUM_OBJECTS):
+            prod.send_object(large, 'consumer')
+        time.sleep(1.0)
+        # an interrupted stop leaves the Relay waiting indefinitely for pending ACKs, a forced stop escalates it:
+        relay._send_local('STOP', encode_control({'timeout': None, 'force': False}))
+        time.sleep(0.5)
+        t_start = time.monotonic()
+        relay.stop(force=True)
+        self.assertLess(time.monotonic() - t_start, 2.0)
+
+        # same for the consumer, which cannot acknowledge anything now that the Relay is gone:
+        cons.send_object(large, 'producer')
+        cons._local_com_conn.sendall(encode_frame('STOP', encode_control({'timeout': None, 'force': False})))
+        time.sleep(0.5)
+        t_start = time.monotonic()
+        cons.stop(force=True)
+        self.assertLess(time.monotonic() - t_start, 2.0)
+
+    def tearDown(self):
+        self.ht.clear()
+
+
+class TestBoundedQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.ht = HelperTester()
+
+    def test_overflow(self):
+        self.ht.spawn_relay(accepted_groups=None)
+        prod = self.ht.spawn_endpoint(groups='producer')
+        newest = self.ht.spawn_endpoint(groups='consumers', max_queue_len=3, overflow="drop_newest")
+        oldest = self.ht.spawn_endpoint(groups='consumers', max_queue_len=3, overflow="drop_oldest")
+        block = self.ht.spawn_endpoint(groups='consumers', max_queue_len=3, overflow="block")
+        time.sleep(1.0)  # let everyone handshake the relay so that broadcasts don't get overwritten before that
+
+        prod.send_objects(range(NUM_OBJECTS), 'consumers')
+        time.sleep(1.0)
+        self.assertEqual(newest.receive_all(), [0, 1, 2])
+        self.assertEqual(newest.stats()['dropped'], NUM_OBJECTS - 3)
+        self.assertEqual(oldest.receive_all(), list(range(NUM_OBJECTS - 3, NUM_OBJECTS)))
+        self.assertEqual(oldest.stats()['dropped'], NUM_OBJECTS - 3)
+        self.assertEqual(block.stats()['queued'], 3)
+        self.assertEqual(block.stats()['dropped'], 0)
+        res = []
+        while len(res) < NUM_OBJECTS:
+            res += block.pop(blocking=True)
+        self.assertEqual(res, list(range(NUM_OBJECTS)))
+
+        # stopping an Endpoint whose queue is full does not block:
+        prod.send_objects(range(NUM_OBJECTS), 'consumers')
+        time.sleep(1.0)
+        block.stop()
+
+    def tearDown(self):
+        self.ht.clear()
+
+
+class TestMailbox(unittest.TestCase):
+
+    def setUp(self):
+        self.ht = HelperTester()
+
+    def test_latest(self):
+        self.ht.spawn_relay(accepted_groups=None)
+        prod = self.ht.spawn_endpoint(groups='producer', chunk_size=100000)
+        actor = self.ht.spawn_endpoint(groups=('weights', 'tasks'), mailbox='weights')
+        other = self.ht.spawn_endpoint(groups='tasks', mailbox=True)
+        time.sleep(1.0)  # let everyone handshake the relay so that broadcasts don't get overwritten before that
+
+        self.assertEqual(actor.get_latest('weights'), [])
+        for i in range(NUM_OBJECTS):
+            prod.broadcast(i, 'weights')
+        prod.send_object(i, ('weights', 'tasks'))  # broadcast to both groups
+        time.sleep(1.0)
+        self.assertEqual(actor.get_latest('weights'), [NUM_OBJECTS - 1])
+        self.assertEqual(actor.get_latest('weights'), [])
+        self.assertEqual(actor.stats()['superseded'], NUM_OBJECTS)
+        self.assertEqual(actor.receive_all(), [NUM_OBJECTS - 1])  # tasks are queued
+        self.assertEqual(other.get_latest('tasks', blocking=True), [NUM_OBJECTS - 1])
+
+        large = [bytes([i]) * 10000 for i in range(30)]  # chunked
+        prod.broadcast(large, 'weights')
+        self.assertEqual(actor.get_latest('weights', blocking=True), [large])
+
+        prod.produce_many(range(3), 'tasks')
+        other.notify({'tasks': 3})
+        time.sleep(1.0)
+        self.assertEqual(other.get_latest('tasks'), [2])
+        self.assertEqual(other.receive_all(), [])
+
+    def test_latest_stop(self):
+        self.ht.spawn_relay(accepted_groups=None)
+        actor = self.ht.spawn_endpoint(groups='weights', mailbox=True)
+        pool = self.ht.spawn_pool()
+        pooled = pool.endpoint('weights')
+        time.sleep(1.0)  # let everyone handshake the relay
+
+        # calls waiting for a mailbox object raise EOFError once their endpoint is stopped:
+        errors = []
+        def wait(endpoint):
+            try:
+                endpoint.get_latest('weights', blocking=True)
+            except EOFError as e:
+                errors.append(e)
+        threads = [threading.Thread(target=wait, args=(endpoint, )) for endpoint in (actor, pooled)]
+        for t in threads:
+            t.start()
+        time.sleep(0.5)
+        actor.stop()
+        pool.stop()
+        for t in threads:
+            t.join(timeout=5.0)
+        self.assertEqual(len(errors), 2)
+        self.assertRaises(EOFError, lambda: actor.get_latest('weights', blocking=True))
+
+    def tearDown(self):
+        self.ht.clear()
+
+
+class TestDeserializerPool(unittest.TestCase):
+
+    def setUp(self):
+        self.ht = HelperTester()
+
+    def test_order(self):
+        self.ht.spawn_relay(accepted_groups=None)
+        prod = self.ht.spawn_endpoint(groups='producer')
+        threads = self.ht.spawn_endpoint(groups='consumers', deserializer_workers=4, deserializer_pool="thread")
+        processes = self.ht.spawn_endpoint(groups='consumers', deserializer_workers=2, deserializer_pool="process")
+        time.sleep(1.0)  # let everyone handshake the relay so that broadcasts don't get overwritten before that
+
+        large = [bytes([i]) * 10000 for i in range(30)]  # chunked
+        objs = [large if i % 3 == 0 else i for i in range(NUM_OBJECTS)]
+        prod.send_objects(objs, 'consumers')
+        for ep in (threads, processes):
+            res = []
+            while len(res) < NUM_OBJECTS:
+                res += ep.pop(blocking=True)
+            self.assertEqual(res, objs)  # objects are retrieved in order of reception
+
+        prod.send_objects(range(NUM_OBJECTS), 'consumers')
+        time.sleep(1.0)
+        self.assertEqual(threads.get_last(max_items=2), [NUM_OBJECTS - 2, NUM_OBJECTS - 1])
+        self.assertEqual(processes.receive_all(), list(range(NUM_OBJECTS)))
+
+    def tearDown(self):
+        self.ht.clear()
+
+
+class TestEndpointPool(unittest.TestCase):
+
+    def setUp(self):
+        self.ht = HelperTester()
+
+    def test_sessions(self):
+        self.ht.spawn_relay(accepted_groups=None)
+        pool = self.ht.spawn_pool(chunk_size=100000)
+        agents = [pool.endpoint(groups=('agents', f'agent{i}')) for i in range(3)]
+        trainer = self.ht.spawn_endpoint(groups='trainer')
+        time.sleep(1.0)  # let everyone handshake the relay so that broadcasts don't get overwritten before that
+
+        # broadcasts are received by every logical endpoint of the group:
+        trainer.broadcast('weights', 'agents')
+        for agent in agents:
+            self.assertEqual(agent.pop(blocking=True), ['weights'])
+        large = [bytes([i]) * 10000 for i in range(30)]  # chunked
+        trainer.broadcast(large, 'agents')
+        for agent in agents:
+            self.assertEqual(agent.pop(blocking=True), [large])
+
+        # consumables are dispatched to the logical endpoint that notifies the Relay:
+        agents[1].produce('sample', 'trainer')
+        trainer.notify('trainer')
+        self.assertEqual(trainer.pop(blocking=True), ['sample'])
+        trainer.produce('task', 'agents')
+        agents[2].notify('agents')
+        self.assertEqual(agents[2].pop(blocking=True), ['task'])
+        agents[0].send_objects(['a', 'b'], 'agent1')
+        self.assertEqual(agents[1].pop(max_items=2, blocking=True), ['a', 'b'])
+        self.assertEqual(agents[0].receive_all() + agents[2].receive_all(), [])
+
+        # stopped logical endpoints leave their groups:
+        agents[0].stop()
+        time.sleep(0.5)
+        trainer.broadcast('new weights', 'agents')
+        for agent in agents[1:]:
+            self.assertEqual(agent.pop(blocking=True), ['new weights'])
+        self.assertEqual(agents[0].receive_all(), [])
+
+        # new logical endpoints receive the current broadcast:
+        agent = pool.endpoint(groups='agents')
+        self.assertEqual(agent.pop(blocking=True), ['new weights'])
+
+    def test_delta_broadcasts(self):
+        self.ht.spawn_relay(accepted_groups=None)
+        pool = self.ht.spawn_pool(delta_broadcasts=True)
+        producer = pool.endpoint(groups='producer')
+        consumer = pool.endpoint(groups='consumer')
+        time.sleep(1.0)  # let everyone handshake the relay so that broadcasts don't get overwritten before that
+
+        v1 = list(range(10000))
+        v2 = v1[:5000] + [9999] + v1[5001:]
+        producer.broadcast(v1, 'consumer')
+        self.assertEqual(consumer.pop(blocking=True), [v1])
+        producer.broadcast(v2, 'consumer')  # delta
+        self.assertEqual(consumer.pop(blocking=True), [v2])
+
+        # the Relay requests the full object from the logical endpoint that sent the delta:
+        pool.endpoint(groups='other').broadcast('other', 'consumer')
+        self.assertEqual(consumer.pop(blocking=True), ['other'])
+        producer.broadcast(v1, 'consumer')
+        self.assertEqual(consumer.pop(blocking=True), [v1])
+
+    def tearDown(self):
+        self.ht.clear()
+
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)
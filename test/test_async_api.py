@@ -0,0 +1,107 @@
+import unittest
+import asyncio
+
+from tlspyo import AsyncEndpoint
+
+from utils import HelperTester, TEST_RELAY_IP, TEST_RELAY_PORT, TEST_PASSWORD, TEST_HEADER_SIZE
+
+
+class TestAsyncEndpoint(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.ht = HelperTester()
+        self.ht.spawn_relay(accepted_groups=None)
+
+    def spawn_async_endpoint(self, groups, **kwargs):
+        return AsyncEndpoint(ip_server=TEST_RELAY_IP,
+                             port=TEST_RELAY_PORT,
+                             password=TEST_PASSWORD,
+                             groups=groups,
+                             header_size=TEST_HEADER_SIZE,
+                             **kwargs)
+
+    async def test_receive(self):
+        async with self.spawn_async_endpoint('group1') as ep1, self.spawn_async_endpoint('group2') as ep2:
+            await asyncio.sleep(1.0)  # let everyone handshake the relay so that broadcasts don't get overwritten before that
+
+            await ep1.broadcast('test', 'group2')
+            self.assertEqual(await asyncio.wait_for(ep2.receive(), 10.0), 'test')
+
+            await ep1.produce_many(range(5), 'group2')
+            await ep2.notify({'group2': 5})
+            res = []
+            async for obj in ep2:
+                res.append(obj)
+                if len(res) == 5:
+                    break
+            self.assertEqual(res, list(range(5)))
+
+            await ep2.send_object('back', 'group1')
+            self.assertEqual(await ep1.receive_all(blocking=True), ['back'])
+            self.assertEqual(await ep1.get_last(), [])
+
+            # waiting for objects does not change their order:
+            waiting = asyncio.ensure_future(ep2.get_last(max_items=5, blocking=True))
+            await ep1.produce_many(range(5), 'group2')
+            await ep2.notify({'group2': 5})
+            res = await asyncio.wait_for(waiting, 10.0)
+            await asyncio.sleep(1.0)
+            res += await ep2.receive_all()
+            self.assertEqual(res, list(range(5)))
+
+    async def test_overflow(self):
+        async with self.spawn_async_endpoint('group1') as ep1, \
+                self.spawn_async_endpoint('group2', max_queue_len=3, overflow="drop_oldest") as ep2, \
+                self.spawn_async_endpoint('group3', max_queue_len=3, overflow="block") as ep3:
+            await asyncio.sleep(1.0)
+
+            await ep1.produce_many(range(10), 'group2')
+            await ep1.produce_many(range(10), 'group3')
+            await ep2.notify({'group2': 10})
+            await ep3.notify({'group3': 10})
+            await asyncio.sleep(1.0)
+            self.assertEqual(await ep2.receive_all(), [7, 8, 9])
+            # the other objects wait until there is room for them:
+            self.assertEqual(await ep3.receive_all(), [0, 1, 2])
+            res = []
+            while len(res) < 7:
+                res.append(await asyncio.wait_for(ep3.receive(), 10.0))
+            self.assertEqual(res, list(range(3, 10)))
+
+    async def test_get_latest(self):
+        async with self.spawn_async_endpoint('group1') as ep1, \
+                self.spawn_async_endpoint(('weights', 'tasks'), mailbox='weights') as ep2:
+            await asyncio.sleep(1.0)
+
+            self.assertEqual(await ep2.get_latest('weights'), [])
+            waiting = asyncio.ensure_future(ep2.get_latest('weights', blocking=True))
+            await ep1.broadcast('w', 'tasks')  # queued
+            self.assertEqual(await asyncio.wait_for(ep2.receive(), 10.0), 'w')
+            self.assertFalse(waiting.done())
+            for i in range(10):
+                await ep1.broadcast(i, 'weights')
+            res = await asyncio.wait_for(waiting, 10.0)
+            await asyncio.sleep(1.0)
+            res += await ep2.get_latest('weights')  # empty if the waiting coroutine already got the last object
+            self.assertEqual(res[-1], 9)
+            self.assertEqual(await ep2.get_latest('weights'), [])
+
+            waiting = asyncio.ensure_future(ep2.get_latest('weights', blocking=True))
+            await asyncio.sleep(0.1)
+        with self.assertRaises(EOFError):
+            await asyncio.wait_for(waiting, 10.0)
+
+    async def test_stop(self):
+        ep = self.spawn_async_endpoint('group1')
+        waiting = asyncio.ensure_future(ep.receive())
+        await ep.stop()
+        with self.assertRaises(EOFError):
+            await asyncio.wait_for(waiting, 10.0)
+        self.assertEqual([obj async for obj in ep], [])
+
+    def tearDown(self):
+        self.ht.clear()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import unittest
+import time
+
+from tlspyo.framing import encode_envelope, decode_batch
+
+from utils import HelperTester
+
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.ht = HelperTester()
+
+    def test_decode_batch(self):
+        body = encode_envelope('OBJ', {'dest': {'a': -1}}, 3) + b"obj" + encode_envelope('NTF', {'dest': {'a': 1}})
+        frames = decode_batch(body)
+        self.assertEqual([(f.cmd, f.body, f.routing) for f in frames],
+                         [('OBJ', b"obj", {'dest': {'a': -1}}), ('NTF', b"", {'dest': {'a': 1}})])
+        self.assertRaises(ValueError, lambda: decode_batch(body[:-1]))
+
+    def test_coalescing(self):
+        self.ht.spawn_relay(accepted_groups=None)
+        ep1 = self.ht.spawn_endpoint(groups='group1', coalesce_delay=0.05)
+        ep2 = self.ht.spawn_endpoint(groups='group2', coalesce_delay=0.05)
+        time.sleep(1.0)  # let everyone handshake the relay so that broadcasts don't get overwritten before that
+
+        for i in range(100):
+            ep1.produce(i, 'group2')
+        ep1.produce(b"x" * 100000, 'group2')  # too large to be coalesced
+        ep2.notify({'group2': -1})
+        res = []
+        while len(res) < 101:
+            res += ep2.receive_all(blocking=True)
+        self.assertEqual(res, list(range(100)) + [b"x" * 100000])
+
+    def test_coalescing_window(self):
+        self.ht.spawn_relay(accepted_groups=None)
+        ep1 = self.ht.spawn_endpoint(groups='group1', coalesce_delay=0.01, ack_window=1)
+        ep2 = self.ht.spawn_endpoint(groups='group2')
+        time.sleep(1.0)
+
+        # batches wait for the window to open like other commands, and objects keep their order:
+        objs = []
+        for i in range(20):
+            objs += list(range(i * 10, i * 10 + 10)) + [b"x" * 100000]
+        for obj in objs:
+            ep1.produce(obj, 'group2')
+        ep2.notify({'group2': len(objs)})
+        res = []
+        while len(res) < len(objs):
+            res += ep2.receive_all(blocking=True)
+        self.assertEqual(res, objs)
+
+    def test_send_objects(self):
+        self.ht.spawn_relay(accepted_groups=None)
+        ep1 = self.ht.spawn_endpoint(groups='group1', chunk_size=2000)
+        ep2 = self.ht.spawn_endpoint(groups='group2')
+        time.sleep(1.0)  # let everyone handshake the relay so that broadcasts don't get overwritten before that
+
+        objs = list(range(1000)) + [b"x" * 5000] + ['last']  # several batches and a chunked object
+        ep1.produce_many(objs, 'group2')
+        ep2.notify({'group2': len(objs)})
+        res = []
+        while len(res) < len(objs):
+            res += ep2.receive_all(blocking=True)
+        self.assertEqual(res, objs)
+
+        ep1.send_objects(('a', 'b'), destination='group2')
+        res = []
+        while len(res) < 2:
+            res += ep2.receive_all(blocking=True)
+        self.assertEqual(res, ['a', 'b'])
+
+    def tearDown(self):
+        self.ht.clear()
+
+
+if __name__ == '__main__':
+    unittest.main()
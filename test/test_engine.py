@@ -0,0 +1,113 @@
+import unittest
+import time
+import pickle as pkl
+
+from tlspyo.serialization import OOB_AVAILABLE, OOB_MIN_SIZE
+
+from utils import HelperTester
+
+
+class TestThreadEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.ht = HelperTester(engine="thread")
+
+    def test_produce_notify_broadcast(self):
+        self.ht.spawn_relay(accepted_groups=None)
+        ep1 = self.ht.spawn_endpoint(groups='group1')
+        ep2 = self.ht.spawn_endpoint(groups='group2')
+        time.sleep(1.0)  # let everyone handshake the relay so that broadcasts don't get overwritten before that
+
+        ep1.broadcast('test', 'group2')
+        self.assertEqual(ep2.pop(blocking=True), ['test'])
+        for i in range(10):
+            ep1.produce(i, 'group2')
+        ep2.notify({'group2': 10})
+        res = []
+        while len(res) < 10:
+            res += ep2.receive_all(blocking=True)
+        self.assertEqual(res, list(range(10)))
+
+    def test_large_objects(self):
+        self.ht.spawn_relay(accepted_groups=None)
+        ep1 = self.ht.spawn_endpoint(groups='group1', chunk_size=100000)
+        ep2 = self.ht.spawn_endpoint(groups='group2')
+        time.sleep(1.0)  # let everyone handshake the relay so that broadcasts don't get overwritten before that
+
+        obj = [bytes([i]) * 10000 for i in range(100)]  # chunked
+        ep1.broadcast(obj, 'group2')
+        self.assertEqual(ep2.pop(blocking=True), [obj])
+        if OOB_AVAILABLE:
+            large = bytearray(range(256)) * (OOB_MIN_SIZE // 256)
+            sent = bytes(large)
+            ep1.send_object(obj=pkl.PickleBuffer(large), destination='group2')
+            large[:256] = bytes(256)  # buffers can be reused as soon as the object is sent
+            r = ep2.pop(blocking=True)
+            self.assertEqual(bytes(r[0]), sent)
+            self.assertFalse(r[0].readonly)  # rebuilt in place
+
+    def test_batches(self):
+        self.ht.spawn_relay(accepted_groups=None)
+        ep1 = self.ht.spawn_endpoint(groups='group1', chunk_size=2000)
+        ep2 = self.ht.spawn_endpoint(groups='group2')
+        time.sleep(1.0)  # let everyone handshake the relay so that broadcasts don't get overwritten before that
+
+        objs = list(range(500)) + [b"x" * 5000] + ['last']  # several batches and a chunked object
+        ep1.produce_many(objs, 'group2')
+        ep2.notify({'group2': len(objs)})
+        res = []
+        while len(res) < len(objs):
+            res += ep2.receive_all(blocking=True)
+        self.assertEqual(res, objs)
+
+    def test_mixed_engines(self):
+        self.ht.spawn_relay(accepted_groups=None)
+        ep1 = self.ht.spawn_endpoint(groups='group1')
+        self.ht.engine = "process"
+        ep2 = self.ht.spawn_endpoint(groups='group2')
+        time.sleep(1.0)  # let everyone handshake the relay so that broadcasts don't get overwritten before that
+
+        ep1.send_object('to process', 'group2')
+        self.assertEqual(ep2.pop(blocking=True), ['to process'])
+        ep2.send_object('to thread', 'group1')
+        self.assertEqual(ep1.pop(blocking=True), ['to thread'])
+
+    def test_stats(self):
+        re = self.ht.spawn_relay(accepted_groups=None)
+        ep1 = self.ht.spawn_endpoint(groups='group1')
+        ep2 = self.ht.spawn_endpoint(groups='group2')
+        time.sleep(1.0)  # let everyone handshake the relay so that broadcasts don't get overwritten before that
+
+        ep1.broadcast('test', 'group2')
+        self.assertEqual(ep2.pop(blocking=True), ['test'])
+        time.sleep(0.5)  # let ep2 acknowledge the broadcast
+        self.assertEqual(re.stats(), {'clients': 2, 'retained_links': 0, 'pending_frames': 0, 'pending_bytes': 0,
+                                      'backlog': 0, 'backlog_bytes': 0})
+
+    def tearDown(self):
+        self.ht.clear()
+
+
+class TestLocalChannel(unittest.TestCase):
+
+    def setUp(self):
+        self.ht = HelperTester(local_ports=True)
+
+    def test_local_ports(self):
+        self.ht.spawn_relay(accepted_groups=None)
+        ep1 = self.ht.spawn_endpoint(groups='group1')
+        ep2 = self.ht.spawn_endpoint(groups='group2')
+        time.sleep(1.0)  # let everyone handshake the relay so that broadcasts don't get overwritten before that
+
+        ep1.broadcast('test', 'group2')
+        self.assertEqual(ep2.pop(blocking=True), ['test'])
+        ep2.produce('consumable', 'group1')
+        ep1.notify('group1')
+        self.assertEqual(ep1.pop(blocking=True), ['consumable'])
+
+    def tearDown(self):
+        self.ht.clear()
+
+
+if __name__ == '__main__':
+    unittest.main()
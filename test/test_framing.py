@@ -0,0 +1,193 @@
+import unittest
+import time
+import json
+import pickle as pkl
+
+from twisted.internet.testing import StringTransport
+
+from tlspyo.framing import PROTOCOL_VERSION, FRAME_HEADER_SIZE, FLAG_OOB, FrameDecoder, encode_frame, encode_envelope, \
+    encode_header, decode_header, is_legacy_frame, encode_legacy_header, encode_hello, decode_hello, split_chunks
+from tlspyo.serialization import OOB_MIN_SIZE, dumps_oob
+from tlspyo.client import Client, ClientProtocol
+
+from utils import HelperTester, LegacyClient, BinaryClient, TEST_PASSWORD, TEST_HEADER_SIZE
+
+
+class TestFraming(unittest.TestCase):
+
+    def test_header(self):
+        frame = encode_frame('OBJ', b"payload", stamp=42, flags=3)
+        self.assertEqual(len(frame), FRAME_HEADER_SIZE + len(b"payload"))
+        self.assertFalse(is_legacy_frame(frame))
+        self.assertEqual(decode_header(frame), (len(b"payload"), 3, 'OBJ', 42))
+        self.assertEqual(frame[:FRAME_HEADER_SIZE], encode_header('OBJ', len(b"payload"), stamp=42, flags=3))
+        self.assertTrue(is_legacy_frame(encode_legacy_header(7, 10) + b"payload"))
+        self.assertRaises(ValueError, lambda: decode_header(b"\x00" * FRAME_HEADER_SIZE))
+
+    def test_decoder_chunks(self):
+        payloads = [bytes([i]) * i * 1000 for i in range(10)]
+        frames = [encode_envelope('OBJ', {'dest': {'group': i}}, len(p), stamp=i) + p for i, p in enumerate(payloads)]
+        stream = b"".join(frames)
+        for chunk_size in (1, 7, 4096, len(stream)):
+            decoder = FrameDecoder()
+            res = []
+            for k in range(0, len(stream), chunk_size):
+                decoder.feed(stream[k:k + chunk_size])
+                frame = decoder.next_frame()
+                while frame is not None:
+                    res.append(frame)
+                    frame = decoder.next_frame()
+            self.assertEqual(len(decoder), 0)
+            self.assertEqual([f.stamp for f in res], list(range(10)))
+            self.assertEqual([f.body for f in res], payloads)
+            self.assertEqual([f.routing for f in res], [{'dest': {'group': i}} for i in range(10)])
+
+    def test_decoder_legacy(self):
+        decoder = FrameDecoder(legacy=None, header_size=10, password=b"psw")
+        decoder.feed(encode_legacy_header(4, 10) + b"psw" + b"abcd" + encode_legacy_header(1, 10))
+        frame = decoder.next_frame()
+        self.assertTrue(decoder.legacy)
+        self.assertEqual((frame.cmd, frame.body), (None, b"abcd"))
+        self.assertIsNone(decoder.next_frame())
+        decoder.feed(b"bad")
+        self.assertRaises(ValueError, decoder.next_frame)
+
+    def test_decoder_truncated_routing(self):
+        # the body of an envelope is too short for its routing header:
+        for body in (b"", b"\x00\x00", b"\x00\x00\x00\x10{}"):
+            for following in (b"", encode_frame('ACK')):
+                decoder = FrameDecoder()
+                decoder.feed(encode_header('OBJ', len(body)) + body + following)
+                self.assertRaises(ValueError, decoder.next_frame)
+
+    def test_hello(self):
+        hello = {'version': PROTOCOL_VERSION, 'nonce': 'abc'}
+        frame = encode_hello(hello, pkl.dumps, 10)
+        self.assertTrue(is_legacy_frame(frame))
+        # Endpoints of older versions deserialize it, and ignore its object:
+        self.assertEqual(pkl.loads(frame[10:])[:2], (0, 'HELLO'))
+        self.assertEqual(decode_hello(frame[10:], None), (0, 'HELLO', hello))
+        # pickled HELLOs never resolve globals, whatever the deserializer:
+        self.assertRaises(pkl.UnpicklingError, decode_hello, pkl.dumps((0, 'HELLO', unittest.TestCase)), pkl.loads)
+        self.assertEqual(decode_hello(pkl.dumps((1, 'HELLO', None)), None), (1, 'HELLO', None))
+        # custom serializers are shared with the Relay:
+        frame = encode_hello(hello, lambda obj: bytes(json.dumps(obj), 'utf-8'), 10)
+        self.assertEqual(decode_hello(frame[10:], json.loads), (0, 'HELLO', hello))
+
+
+class TestChunks(unittest.TestCase):
+
+    def setUp(self):
+        self.ht = HelperTester()
+
+    def test_split_chunks(self):
+        parts = [b"abc", bytearray(b"defgh"), b"", b"ij"]
+        chunks = list(split_chunks(parts, 4))
+        self.assertEqual([b"".join(chunk) for chunk in chunks], [b"abcd", b"efgh", b"ij"])
+        self.assertTrue(all(isinstance(part, memoryview) for chunk in chunks for part in chunk))
+
+    def test_chunked_transfer(self):
+        self.ht.spawn_relay(accepted_groups=None)
+        ep1 = self.ht.spawn_endpoint(groups='group1', chunk_size=1000)
+        ep2 = self.ht.spawn_endpoint(groups='group2')
+        time.sleep(1.0)  # let everyone handshake the relay so that broadcasts don't get overwritten before that
+
+        obj = [bytes([i]) * 1000 for i in range(100)]
+        ep1.broadcast(obj, 'group2')
+        self.assertEqual(ep2.pop(blocking=True), [obj])
+        ep1.produce(obj[:50], 'group2')
+        ep1.produce('small', 'group2')
+        ep2.notify({'group2': 2})  # the relay waits for the consumables, which may not have reached it yet
+        self.assertEqual(ep2.pop(blocking=True) + ep2.pop(blocking=True), [obj[:50], 'small'])
+
+        # the broadcast is stored as a list of chunks for late joiners:
+        ep3 = self.ht.spawn_endpoint(groups='group2')
+        self.assertEqual(ep3.pop(blocking=True), [obj])
+
+    def test_transfer_drops_previous_broadcast(self):
+        self.ht.spawn_relay(accepted_groups=None)
+        ep1 = self.ht.spawn_endpoint(groups='group1')
+        cli = BinaryClient(groups=['group1'], broadcasts={}, token='token')
+        time.sleep(0.5)
+
+        ep1.broadcast('old', 'group2')
+        time.sleep(0.5)
+        payload = pkl.dumps(b"x" * 10000)
+        routing = {'dest': {'group2': -1}, 'id': 1, 'size': len(payload), 'last': False}
+        cli.sock.sendall(encode_envelope('CHK', routing, 5000, 1) + payload[:5000])
+        time.sleep(0.5)
+        # the Relay does not hold the previous broadcast during the transfer of the new one:
+        ep2 = self.ht.spawn_endpoint(groups='group2')
+        time.sleep(1.0)
+        self.assertEqual(ep2.receive_all(), [])
+        cli.sock.sendall(encode_envelope('CHK', {'id': 1, 'last': True}, len(payload) - 5000, 2) + payload[5000:])
+        self.assertEqual(ep2.pop(blocking=True), [b"x" * 10000])
+        cli.close()
+
+    def tearDown(self):
+        self.ht.clear()
+
+
+class TestLegacyPeers(unittest.TestCase):
+
+    def setUp(self):
+        self.ht = HelperTester()
+
+    def test_legacy_client(self):
+        self.ht.spawn_relay(accepted_groups=None)
+        ep = self.ht.spawn_endpoint(groups='new')
+        legacy = LegacyClient(groups=('legacy', ))
+        time.sleep(1.0)  # let everyone handshake the relay
+
+        ep.send_object(obj='to legacy', destination='legacy')
+        self.assertEqual(legacy.recv_obj(), 'to legacy')
+
+        legacy.send_obj('OBJ', dest={'new': -1}, obj=pkl.dumps('from legacy'))
+        self.assertEqual(ep.pop(blocking=True), ['from legacy'])
+        legacy.close()
+
+    def test_authentication(self):
+        self.ht.spawn_relay(accepted_groups=None)
+        ep = self.ht.spawn_endpoint(groups='group')
+        intruder = self.ht.spawn_endpoint(groups='group', password=TEST_PASSWORD + "x")
+        legacy = LegacyClient(groups=('group', ))
+        time.sleep(1.0)  # let everyone handshake the relay
+
+        legacy.send_obj('OBJ', dest={'group': -1}, obj=pkl.dumps('secret'))
+        self.assertEqual(ep.pop(blocking=True), ['secret'])
+        self.assertEqual(legacy.recv_obj(), 'secret')
+        time.sleep(0.5)
+        self.assertEqual(intruder.receive_all(), [])
+        legacy.close()
+
+    def test_legacy_relay(self):
+        client = Client(ip_server=None, port_server=None, password=TEST_PASSWORD, serializer=pkl.dumps,
+                        deserializer=pkl.loads, header_size=TEST_HEADER_SIZE, groups=('group', ))
+        protocol = ClientProtocol(client, TEST_PASSWORD, header_size=TEST_HEADER_SIZE, groups=('group', ))
+        transport = StringTransport()
+        protocol.makeConnection(transport)
+        hello = pkl.dumps((1, 'HELLO', None))  # Relays older than the binary protocol send no control message
+        protocol.dataReceived(encode_legacy_header(len(hello), TEST_HEADER_SIZE) + hello)
+        transport.clear()
+
+        # objects chunked and pickled out-of-band before the Endpoint knew the version of the Relay are rebuilt:
+        large = bytearray(b"l" * OOB_MIN_SIZE)
+        parts, _ = dumps_oob(('test', pkl.PickleBuffer(large)))
+        payload = b"".join(parts)
+        protocol.send_obj('CHK', {'id': 1, 'dest': {'group': -1}, 'size': len(payload), 'last': False},
+                          payload[:1000], flags=FLAG_OOB)
+        self.assertEqual(transport.value(), b"")
+        protocol.send_obj('CHK', {'id': 1, 'last': True}, payload[1000:], flags=FLAG_OOB)
+        msg = transport.value()
+        i = TEST_HEADER_SIZE + len(TEST_PASSWORD)
+        self.assertEqual(int(msg[:TEST_HEADER_SIZE]), len(msg) - i)
+        stamp, cmd, dest, obj = pkl.loads(msg[i:])
+        self.assertEqual((cmd, dest), ('OBJ', {'group': -1}))
+        self.assertEqual(pkl.loads(obj), ('test', large))
+
+    def tearDown(self):
+        self.ht.clear()
+
+
+if __name__ == '__main__':
+    unittest.main()
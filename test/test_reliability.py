@@ -0,0 +1,267 @@
+import unittest
+import time
+import pickle as pkl
+
+from tlspyo.framing import encode_frame, encode_envelope, FLAG_FIRE_AND_FORGET
+from tlspyo.reliability import Link
+
+from utils import HelperTester, BinaryClient
+
+
+class TestKnownBroadcasts(unittest.TestCase):
+
+    def setUp(self):
+        self.ht = HelperTester()
+
+    def test_reconnection(self):
+        self.ht.spawn_relay(accepted_groups=None)
+        ep1 = self.ht.spawn_endpoint(groups='group1', chunk_size=1000)
+        time.sleep(1.0)  # let everyone handshake the relay so that broadcasts don't get overwritten before that
+
+        ep1.broadcast('v1', 'group2')
+        time.sleep(0.5)
+        cli = BinaryClient(groups=['group2'], broadcasts={})
+        frame = cli.recv_obj()
+        self.assertEqual((frame.cmd, pkl.loads(frame.body)), ('OBJ', 'v1'))
+        self.assertEqual(frame.routing['group'], 'group2')
+        version = frame.routing['hash']
+        cli.close()
+
+        # a client that already holds the broadcast does not receive it again:
+        cli = BinaryClient(groups=['group2'], broadcasts={'group2': version})
+        time.sleep(0.5)
+        ep1.broadcast('v2', 'group2')
+        frame = cli.recv_obj()
+        self.assertEqual(pkl.loads(frame.body), 'v2')
+        self.assertNotEqual(frame.routing['hash'], version)
+
+        # chunked broadcasts are versioned too:
+        ep1.broadcast(b"x" * 5000, 'group2')
+        frame = cli.recv_obj()
+        self.assertEqual(frame.cmd, 'CHK')
+        self.assertEqual(frame.routing['groups'], ['group2'])
+        self.assertIn('hash', frame.routing)
+        while not frame.routing.get('last', False):
+            frame = cli.recv_obj()
+
+        # and so are the broadcasts of batches, batched or chunked:
+        ep1.send_objects(['v3', b"y" * 5000], 'group2')
+        frame = cli.recv_obj()
+        self.assertEqual(pkl.loads(frame.body), 'v3')
+        self.assertIn('hash', frame.routing)
+        frame = cli.recv_obj()
+        self.assertEqual(frame.cmd, 'CHK')
+        self.assertIn('hash', frame.routing)
+        cli.close()
+
+    def tearDown(self):
+        self.ht.clear()
+
+
+class TestReliability(unittest.TestCase):
+
+    def setUp(self):
+        self.ht = HelperTester()
+
+    def test_retransmission(self):
+        self.ht.spawn_relay(accepted_groups=None)
+        ep = self.ht.spawn_endpoint(groups='producer')
+        cli = BinaryClient(groups=['consumer'], broadcasts={}, token='token')
+        time.sleep(0.5)
+
+        ep.broadcast('obj', 'consumer')
+        frame = cli.recv_obj(ack=False)
+        cli.close()
+        # the frame was not acknowledged, it is retransmitted when the client reconnects:
+        cli = BinaryClient(groups=['consumer'], broadcasts={'consumer': frame.routing['hash']}, token='token')
+        retransmitted = cli.recv_obj(ack=False)
+        self.assertEqual((retransmitted.stamp, pkl.loads(retransmitted.body)), (frame.stamp, 'obj'))
+        cli.close()
+
+        # frames that the client reports as received are not retransmitted:
+        cli = BinaryClient(groups=['consumer'], broadcasts={'consumer': frame.routing['hash']}, token='token',
+                           received=frame.stamp)
+        time.sleep(0.5)
+        ep.broadcast('new obj', 'consumer')
+        new_frame = cli.recv_obj()
+        self.assertEqual((new_frame.stamp, pkl.loads(new_frame.body)), (frame.stamp + 1, 'new obj'))
+        cli.close()
+
+    def test_duplicates(self):
+        self.ht.spawn_relay(accepted_groups=None)
+        ep = self.ht.spawn_endpoint(groups='consumer')
+        cli = BinaryClient(groups=['producer'], broadcasts={}, token='token')
+        time.sleep(0.5)
+
+        cli.send_obj(1, {'consumer': -1}, 'once')
+        self.assertEqual(ep.pop(blocking=True), ['once'])
+        cli.close()
+        # the relay discards the frames that a reconnecting client retransmits:
+        cli = BinaryClient(groups=['producer'], broadcasts={}, token='token')
+        cli.send_obj(1, {'consumer': -1}, 'once')
+        cli.send_obj(2, {'consumer': -1}, 'twice')
+        self.assertEqual(ep.pop(blocking=True), ['twice'])
+        self.assertEqual(ep.receive_all(), [])
+        cli.close()
+
+    def test_link(self):
+        link = Link(window=3)
+        for i in range(3):
+            self.assertTrue(link.is_open())
+            self.assertEqual(link.send(lambda stamp: [bytes([stamp])]), [bytes([i + 1])])
+        self.assertFalse(link.is_open())
+        self.assertIsNone(link.acknowledge(0))
+        self.assertIsNotNone(link.acknowledge(2))  # ACKs are cumulative
+        self.assertEqual(list(link.pending.keys()), [3])
+        self.assertIsNone(link.acknowledge(2))
+        self.assertFalse(link.receive(1))
+        self.assertFalse(link.receive(2))
+        self.assertTrue(link.receive(2))
+
+    def test_link_backlog(self):
+        link = Link(max_backlog=10)
+        self.assertTrue(link.queue('a', 4, key='group'))
+        self.assertTrue(link.queue('b', 4))
+        self.assertTrue(link.queue('c', 6, key='group'))  # supersedes 'a'
+        self.assertEqual(link.backlog_bytes, 10)
+        self.assertTrue(link.queue('e', 0, first=True))
+        self.assertFalse(link.queue('d', 1))
+        self.assertEqual([link.next_command() for _ in range(4)], ['e', 'b', 'c', 'd'])
+        self.assertTrue(link.is_idle())
+        self.assertEqual(link.backlog_bytes, 0)
+
+    def test_cumulative_acks(self):
+        self.ht.spawn_relay(accepted_groups=None)
+        cli = BinaryClient(groups=['producer'], broadcasts={}, token='token')
+        time.sleep(0.5)
+
+        frames = b""
+        for i in range(1, 33):
+            payload = pkl.dumps(i)
+            frames += encode_envelope('OBJ', {'dest': {'consumer': 1}}, len(payload), i) + payload
+        cli.sock.sendall(frames)
+        acks = []
+        while len(acks) == 0 or acks[-1] < 32:
+            frame = cli.recv()
+            if frame.cmd == 'ACK':
+                acks.append(frame.stamp)
+        self.assertLess(len(acks), 32)
+        self.assertEqual(acks, sorted(acks))
+        cli.close()
+
+    def test_release_on_disconnect(self):
+        re = self.ht.spawn_relay(accepted_groups=None, reconnection_timeout=1.0)
+        ep = self.ht.spawn_endpoint(groups='producer')
+        cli = BinaryClient(groups=['consumer'], broadcasts={}, token='token')
+        time.sleep(0.5)
+
+        ep.broadcast(b"x" * 1000, 'consumer')
+        cli.recv_obj(ack=False)
+        stats = re.stats()
+        self.assertEqual((stats['clients'], stats['pending_frames']), (2, 1))
+        self.assertGreater(stats['pending_bytes'], 1000)
+        cli.close()
+        time.sleep(0.5)
+        # the frames in flight are kept for reconnection_timeout seconds, then released:
+        stats = re.stats()
+        self.assertEqual((stats['clients'], stats['retained_links'], stats['pending_frames']), (1, 1, 1))
+        time.sleep(1.0)
+        stats = re.stats()
+        self.assertEqual((stats['retained_links'], stats['pending_frames'], stats['pending_bytes']), (0, 0, 0))
+
+    def test_window(self):
+        self.ht.spawn_relay(accepted_groups=None, ack_window=2)
+        prod = self.ht.spawn_endpoint(groups='producer', ack_window=1)
+        cons = self.ht.spawn_endpoint(groups='consumer')
+        time.sleep(1.0)  # let everyone handshake the relay
+
+        for i in range(100):
+            prod.send_object(i, 'consumer')
+        res = []
+        while len(res) < 100:
+            res += cons.pop(blocking=True)
+        self.assertEqual(res, list(range(100)))
+
+    def test_backlog(self):
+        re = self.ht.spawn_relay(accepted_groups=None, ack_window=1, max_backlog=10000)
+        ep = self.ht.spawn_endpoint(groups='producer')
+        cli = BinaryClient(groups=['consumer'], broadcasts={}, token='token')
+        time.sleep(0.5)
+
+        for i in range(10):
+            ep.broadcast(i, 'consumer')
+        frame = cli.recv_obj(ack=False)
+        time.sleep(0.5)
+        # broadcasts waiting for the window to open are superseded by the next ones:
+        self.assertEqual(re.stats()['backlog'], 1)
+        cli.sock.sendall(encode_frame('ACK', stamp=frame.stamp))
+        self.assertEqual(pkl.loads(cli.recv_obj(ack=False).body), 9)
+        # the client is disconnected when its backlog exceeds max_backlog:
+        ep.send_object(b"x" * 20000, {'consumer': 1})
+        cli.sock.sendall(encode_envelope('NTF', {'dest': {'consumer': 1}}, stamp=1))
+        time.sleep(0.5)
+        stats = re.stats()
+        self.assertEqual((stats['clients'], stats['retained_links'], stats['backlog_bytes']), (1, 0, 0))
+        cli.close()
+
+        # the chunks of stored broadcasts are shared and do not count, late joiners receive them whatever their size:
+        producer = self.ht.spawn_endpoint(groups='producer', chunk_size=5000)
+        time.sleep(0.5)
+        payload = b"y" * 50000
+        producer.broadcast(payload, 'late')
+        time.sleep(0.5)
+        cli = BinaryClient(groups=['late'], broadcasts={})
+        chunks = [cli.recv_obj()]
+        while not chunks[-1].routing['last']:
+            chunks.append(cli.recv_obj())
+        self.assertEqual(pkl.loads(b"".join(bytes(chunk.body) for chunk in chunks)), payload)
+        self.assertEqual(re.stats()['clients'], 3)
+        cli.close()
+
+    def tearDown(self):
+        self.ht.clear()
+
+
+class TestQoS(unittest.TestCase):
+
+    def setUp(self):
+        self.ht = HelperTester()
+
+    def test_fire_and_forget(self):
+        self.ht.spawn_relay(accepted_groups=None)
+        ep = self.ht.spawn_endpoint(groups='producer')
+        cli = BinaryClient(groups=['consumer'], broadcasts={}, token='token')
+        time.sleep(0.5)
+
+        ep.send_object('telemetry', 'consumer', qos='fire_and_forget')
+        frame = cli.recv_obj(ack=False)
+        # fire-and-forget objects are not stamped, such that they are neither acknowledged nor retransmitted:
+        self.assertEqual((frame.stamp, pkl.loads(frame.body)), (0, 'telemetry'))
+        self.assertTrue(frame.flags & FLAG_FIRE_AND_FORGET)
+        ep.send_object('command', 'consumer')
+        frame = cli.recv_obj()
+        self.assertEqual((frame.stamp, frame.flags & FLAG_FIRE_AND_FORGET, pkl.loads(frame.body)), (1, 0, 'command'))
+        cli.close()
+
+    def test_group_qos(self):
+        self.ht.spawn_relay(accepted_groups={
+            'producer': {'max_count': None, 'max_consumables': None},
+            'consumer': {'max_count': None, 'max_consumables': None, 'qos': 'fire_and_forget'}})
+        ep = self.ht.spawn_endpoint(groups='producer')
+        cli = BinaryClient(groups=['consumer'], broadcasts={}, token='token')
+        time.sleep(0.5)
+
+        cli.sock.sendall(encode_envelope('NTF', {'dest': {'consumer': 3}}))
+        time.sleep(0.5)
+        ep.produce_many(['a', 'b'], 'consumer')
+        ep.produce('c', 'consumer', qos='reliable')  # the QoS of an object overrides the QoS of its group
+        frames = [cli.recv_obj() for _ in range(3)]
+        self.assertEqual([(frame.stamp, pkl.loads(frame.body)) for frame in frames], [(0, 'a'), (0, 'b'), (1, 'c')])
+        cli.close()
+
+    def tearDown(self):
+        self.ht.clear()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,6 +2,12 @@ import unittest
 import time
 import pickle as pkl
 
+from tlspyo.framing import FLAG_OOB, FLAG_COMPRESSED, FLAG_DELTA
+from tlspyo.serialization import OOB_AVAILABLE, OOB_MIN_SIZE, dumps_oob, loads_oob, compress_payload, decompress_payload, \
+    payload_hash, encode_delta, apply_delta, iter_delta
+from tlspyo.server import rebuild_payload
+from tlspyo.client import legacy_payload
+
 from utils import HelperTester
 
 
@@ -51,6 +57,215 @@ class TestSerialization(unittest.TestCase):
         self.assertEqual(len(r), 1, f"r:{r}")
         self.assertEqual(r[0], 'test1', f"r:{r}")
 
+    def test_relay_default_serialization(self):
+        # the Relay forwards objects without deserializing them, it does not need the custom serializer
+        sr = self.ht.spawn_relay
+        se = self.ht.spawn_endpoint
+        relay = sr(accepted_groups=None, custom_serialization=False)
+        ep1 = se(groups='group1')
+        ep2 = se(groups='group2')
+        time.sleep(1.0)  # let everyone handshake the relay so that broadcasts don't get overwritten before that
+
+        ep1.send_object(obj='test1', destination='group2')
+        r = ep2.pop(blocking=True)
+        self.assertEqual(r, ['test1'], f"r:{r}")
+
+        ep1.produce(obj='test2', group='group2')
+        ep2.notify(groups='group2')
+        r = ep2.pop(blocking=True)
+        self.assertEqual(r, ['test2'], f"r:{r}")
+
+    def tearDown(self):
+        self.ht.clear()
+
+
+@unittest.skipUnless(OOB_AVAILABLE, "pickle protocol 5 is not available")
+class TestOutOfBand(unittest.TestCase):
+
+    def setUp(self):
+        self.ht = HelperTester()
+
+    def test_dumps_loads(self):
+        small = bytearray(b"s" * 10)
+        large = bytearray(b"l" * OOB_MIN_SIZE)
+        parts, oob = dumps_oob({'small': pkl.PickleBuffer(small), 'large': pkl.PickleBuffer(large)})
+        self.assertTrue(oob)
+        self.assertTrue(any(part.obj is large for part in parts if isinstance(part, memoryview)))  # not copied
+        payload = bytearray(b"".join(parts))
+        obj = loads_oob(payload)
+        self.assertEqual(bytes(obj['small']), bytes(small))
+        self.assertEqual(bytes(obj['large']), bytes(large))
+        self.assertFalse(obj['large'].readonly)
+        obj['large'][0] = ord("x")  # rebuilt in place
+        self.assertIn(b"x" + b"l" * 10, payload)
+
+        parts, oob = dumps_oob({'small': pkl.PickleBuffer(small)})
+        self.assertFalse(oob)
+        self.assertEqual(bytes(pkl.loads(parts[0])['small']), bytes(small))
+
+    def test_transfer(self):
+        self.ht.spawn_relay(accepted_groups=None)
+        ep1 = self.ht.spawn_endpoint(groups='group1')
+        ep2 = self.ht.spawn_endpoint(groups='group2')
+        time.sleep(1.0)  # let everyone handshake the relay so that broadcasts don't get overwritten before that
+
+        large = bytearray(range(256)) * (4 * OOB_MIN_SIZE // 256)
+        ep1.send_object(obj=('test', pkl.PickleBuffer(large)), destination='group2')
+        r = ep2.pop(blocking=True)
+        self.assertEqual(len(r), 1)
+        self.assertEqual(r[0][0], 'test')
+        self.assertEqual(bytes(r[0][1]), bytes(large))
+
+    def test_legacy_relay(self):
+        large = bytearray(b"l" * OOB_MIN_SIZE)
+        obj = ('test', pkl.PickleBuffer(large))
+        # Relays that use legacy frames, or that have not advertised their version yet, receive in-band pickles:
+        ep = self.ht.spawn_endpoint(groups='group1')
+        for legacy in (None, True):
+            ep._relay_legacy = legacy
+            parts, flags = ep._serialize(obj)
+            self.assertEqual(flags, 0)
+            self.assertEqual(bytes(pkl.loads(b"".join(parts))[1]), bytes(large))
+            self.assertEqual(ep._qos_flags({'group1': -1}, "fire_and_forget"), 0)
+        ep._relay_legacy = False
+        self.assertEqual(ep._serialize(obj)[1], FLAG_OOB)
+        # payloads encoded before the version of the Relay is known are re-encoded by the Twisted process:
+        parts, _ = dumps_oob(obj)
+        for payload, flags in ((b"".join(parts), FLAG_OOB), (b"".join(compress_payload(parts, 'zlib')), FLAG_OOB | FLAG_COMPRESSED)):
+            payload, flags = legacy_payload(payload, flags)
+            self.assertEqual(flags, 0)
+            self.assertEqual(bytes(pkl.loads(payload)[1]), bytes(large))
+        self.assertEqual(legacy_payload(b"delta", FLAG_DELTA), (b"delta", FLAG_DELTA))
+
+    def tearDown(self):
+        self.ht.clear()
+
+
+class TestCompression(unittest.TestCase):
+
+    def setUp(self):
+        self.ht = HelperTester()
+
+    def test_compress_decompress(self):
+        payload = b"abc" * 1000
+        parts = compress_payload([payload[:10], payload[10:]], 'zlib')
+        self.assertLess(sum(len(part) for part in parts), len(payload))
+        self.assertEqual(decompress_payload(b"".join(parts)), payload)
+        self.assertIsNone(compress_payload([b"abc"], 'zlib'))  # too small to be reduced
+        self.assertRaises(ValueError, lambda: decompress_payload(b"\xff" + payload))
+
+    def test_groups(self):
+        accepted_groups = {
+            'plain': {'max_count': None, 'max_consumables': None, 'compression': None},
+            'packed': {'max_count': None, 'max_consumables': None, 'compression_threshold': 100},
+        }
+        self.ht.spawn_relay(accepted_groups=accepted_groups, compression='zlib')
+        ep1 = self.ht.spawn_endpoint(groups='plain')
+        ep2 = self.ht.spawn_endpoint(groups='packed')
+        time.sleep(1.0)  # let everyone handshake the relay so that broadcasts don't get overwritten before that
+
+        obj = ['test'] * 1000
+        self.assertTrue(ep1._serialize(obj, {'packed': -1})[1] & FLAG_COMPRESSED)
+        self.assertFalse(ep1._serialize(obj, {'plain': -1})[1] & FLAG_COMPRESSED)
+        self.assertFalse(ep1._serialize(obj, {'plain': -1, 'packed': -1})[1] & FLAG_COMPRESSED)
+        self.assertFalse(ep1._serialize('test', {'packed': -1})[1] & FLAG_COMPRESSED)  # below threshold
+
+        ep1.send_object(obj=obj, destination='packed')
+        self.assertEqual(ep2.pop(blocking=True), [obj])
+        ep2.send_object(obj=obj, destination='plain')
+        self.assertEqual(ep1.pop(blocking=True), [obj])
+        if OOB_AVAILABLE:
+            large = bytearray(OOB_MIN_SIZE)
+            ep1.send_object(obj=pkl.PickleBuffer(large), destination='packed')
+            r = ep2.pop(blocking=True)
+            self.assertEqual(bytes(r[0]), bytes(large))
+            self.assertFalse(r[0].readonly)
+
+    def tearDown(self):
+        self.ht.clear()
+
+
+class TestDelta(unittest.TestCase):
+
+    def setUp(self):
+        self.ht = HelperTester()
+
+    def test_encode_apply(self):
+        base = pkl.dumps(list(range(10000)))
+        payload = pkl.dumps(list(range(5000)) + [9999] + list(range(5001, 10000)))
+        delta = encode_delta(base, payload)
+        self.assertLess(len(delta), len(payload) // 10)
+        self.assertEqual(apply_delta(base, delta), payload)
+        self.assertEqual(apply_delta(payload, encode_delta(payload, b"short")), b"short")
+        self.assertEqual(apply_delta(b"short", encode_delta(b"short", payload)), payload)
+
+    def test_chunked_base(self):
+        base = pkl.dumps(list(range(10000)))
+        payload = pkl.dumps(list(range(5000)) + [9999] + list(range(5001, 10000)))
+        delta = encode_delta(base, payload)
+        chunks = [base[i:i + 1000] for i in range(0, len(base), 1000)]
+        blocks = list(iter_delta(chunks, delta, block_size=700))
+        self.assertTrue(all(len(block) == 700 for block in blocks[:-1]))
+        self.assertEqual(b"".join(blocks), payload)
+        payload2 = payload[:100] + b"new" + payload[103:]
+        rebuilt = rebuild_payload(chunks, [delta, [encode_delta(payload, payload2)]], chunk_size=1000)
+        self.assertIsInstance(rebuilt, list)
+        self.assertEqual(b"".join(rebuilt), payload2)
+        self.assertEqual(rebuild_payload(base, [delta]), payload)
+
+    def test_broadcasts(self):
+        self.ht.spawn_relay(accepted_groups=None)
+        ep1 = self.ht.spawn_endpoint(groups='group1', delta_broadcasts=True)
+        ep2 = self.ht.spawn_endpoint(groups='group2')
+        ep3 = self.ht.spawn_endpoint(groups='group3', delta_broadcasts=True)
+        time.sleep(1.0)  # let everyone handshake the relay so that broadcasts don't get overwritten before that
+
+        v1 = list(range(10000))
+        v2 = v1[:5000] + [9999] + v1[5001:]
+        ep1.broadcast(v1, 'group2')
+        self.assertEqual(ep2.pop(blocking=True), [v1])
+        ep1.broadcast(v2, 'group2')  # delta
+        self.assertEqual(ep2.pop(blocking=True), [v2])
+        self.assertEqual(ep2._broadcasts['group2'][0], payload_hash(b"".join(ep1._serialize(v2)[0])))
+
+        # the Relay does not hold the base version of ep1 anymore, ep1 sends the full object:
+        ep3.broadcast('other', 'group2')
+        self.assertEqual(ep2.pop(blocking=True), ['other'])
+        ep1.broadcast(v1, 'group2')
+        self.assertEqual(ep2.pop(blocking=True), [v1])
+
+        # new joiners receive the full object:
+        ep4 = self.ht.spawn_endpoint(groups='group2')
+        self.assertEqual(ep4.pop(blocking=True), [v1])
+        ep1.broadcast(v2, 'group2')  # delta for ep2, full object for ep4 (which holds v1 too)
+        self.assertEqual(ep2.pop(blocking=True), [v2])
+        self.assertEqual(ep4.pop(blocking=True), [v2])
+
+        # the Relay rebuilds the full object for clients that join after a delta:
+        ep5 = self.ht.spawn_endpoint(groups='group2')
+        self.assertEqual(ep5.pop(blocking=True), [v2])
+
+    def test_chunked_broadcasts(self):
+        self.ht.spawn_relay(accepted_groups=None)
+        ep1 = self.ht.spawn_endpoint(groups='group1', delta_broadcasts=True, chunk_size=4096)
+        ep2 = self.ht.spawn_endpoint(groups='group2', chunk_size=4096)
+        time.sleep(1.0)
+
+        v1 = list(range(100000))
+        v2 = v1[:5000] + [9999] + v1[5001:]
+        v3 = [-1] + v2[1:]
+        ep1.broadcast(v1, 'group2')  # chunked full object
+        self.assertEqual(ep2.pop(blocking=True), [v1])
+        ep1.broadcast(v2, 'group2')  # delta
+        self.assertEqual(ep2.pop(blocking=True), [v2])
+
+        ep3 = self.ht.spawn_endpoint(groups='group2', chunk_size=4096)
+        self.assertEqual(ep3.pop(blocking=True), [v2])  # rebuilt by the Relay, chunked
+        ep1.broadcast(v3, 'group2')  # chunked delta
+        self.assertEqual(ep2.pop(blocking=True), [v3])
+        self.assertEqual(ep3.pop(blocking=True), [v3])
+        self.assertEqual(ep3._broadcasts['group2'][0], payload_hash(b"".join(ep1._serialize(v3)[0])))
+
     def tearDown(self):
         self.ht.clear()
 
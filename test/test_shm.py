@@ -0,0 +1,61 @@
+import unittest
+import time
+import os
+
+from tlspyo.shm import SHM_AVAILABLE, write_shared, read_shared, discard_shared
+
+from utils import HelperTester
+
+
+@unittest.skipUnless(SHM_AVAILABLE, "shared memory is not available")
+class TestSharedMemory(unittest.TestCase):
+
+    def setUp(self):
+        self.ht = HelperTester()
+
+    def test_write_read(self):
+        body = write_shared([b"abc", memoryview(bytearray(b"defgh")), b""], 8)
+        self.assertLess(len(body), 100)
+        payload = read_shared(body, writable=True)
+        self.assertEqual(payload, bytearray(b"abcdefgh"))
+        self.assertIsInstance(payload, bytearray)
+        self.assertRaises(FileNotFoundError, lambda: read_shared(body))  # the segment is destroyed
+        body = write_shared([b"abc"], 3)
+        discard_shared(body)
+        self.assertRaises(FileNotFoundError, lambda: read_shared(body))
+
+    def test_transfer(self):
+        self.ht.spawn_relay(accepted_groups=None)
+        ep1 = self.ht.spawn_endpoint(groups='group1', shm_threshold=1000, chunk_size=10000)
+        ep2 = self.ht.spawn_endpoint(groups='group2', shm_threshold=1000)
+        time.sleep(1.0)  # let everyone handshake the relay so that broadcasts don't get overwritten before that
+
+        obj = [bytes([i]) * 1000 for i in range(100)]
+        ep1.broadcast(obj, 'group2')  # chunked
+        self.assertEqual(ep2.pop(blocking=True), [obj])
+        ep1.send_object(obj[:5], 'group2')
+        ep1.send_object('small', 'group2')
+        self.assertEqual(ep2.pop(blocking=True) + ep2.pop(blocking=True), [obj[:5], 'small'])
+
+    @unittest.skipUnless(os.path.isdir('/dev/shm'), "shared memory segments are not listed")
+    def test_unread_segments(self):
+        segments = set(os.listdir('/dev/shm'))
+        self.ht.spawn_relay(accepted_groups=None)
+        ep1 = self.ht.spawn_endpoint(groups='group1')
+        ep2 = self.ht.spawn_endpoint(groups='group2', max_queue_len=1, overflow="block")
+        time.sleep(1.0)  # let everyone handshake the relay
+
+        for i in range(20):
+            ep1.produce(bytes([i]) * 400000, 'group2')
+        ep2.notify({'group2': 20})
+        time.sleep(1.0)
+        # the objects that were not retrieved are discarded along with their shared memory segments:
+        ep2.stop()
+        self.assertEqual(set(os.listdir('/dev/shm')) - segments, set())
+
+    def tearDown(self):
+        self.ht.clear()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,12 @@
-from tlspyo import Relay, Endpoint
+import socket
+import ssl
+import pickle as pkl
+
+from tlspyo import Relay, Endpoint, EndpointPool
+from tlspyo.framing import PROTOCOL_VERSION, DEFAULT_CHUNK_SIZE, FrameDecoder, encode_frame, encode_envelope, encode_control, \
+    decode_hello, encode_legacy_header, hello_digest
+from tlspyo.shm import DEFAULT_SHM_THRESHOLD
+from tlspyo.reliability import DEFAULT_ACK_WINDOW, DEFAULT_RECONNECTION_TIMEOUT, DEFAULT_MAX_BACKLOG
 
 
 TEST_RELAY_PORT = 22222
@@ -9,39 +17,80 @@ TEST_HEADER_SIZE = 12
 
 
 class HelperTester:
-    def __init__(self, serializer=None, deserializer=None, deserializer_mode="asynchronous"):
+    def __init__(self, serializer=None, deserializer=None, deserializer_mode="asynchronous", engine="process",
+                 local_ports=False):
         self.next_local_port = TEST_LOCAL_PORT_START
         self.endpoints = []
+        self.pools = []
         self.relays = []
         self.serializer = serializer
         self.deserializer = deserializer
         self.deserializer_mode = deserializer_mode
+        self.engine = engine
+        self.local_ports = local_ports  # if False, local channels are allocated automatically
 
-    def spawn_endpoint(self, groups):
+    def spawn_endpoint(self, groups, password=TEST_PASSWORD, chunk_size=DEFAULT_CHUNK_SIZE, coalesce_delay=None,
+                       delta_broadcasts=False, shm_threshold=DEFAULT_SHM_THRESHOLD, max_queue_len=None, overflow="block",
+                       mailbox=None, deserializer_workers=None, deserializer_pool="thread", ack_window=DEFAULT_ACK_WINDOW):
         ep = Endpoint(
             ip_server=TEST_RELAY_IP,
             port=TEST_RELAY_PORT,
-            password=TEST_PASSWORD,
+            password=password,
             groups=groups,
-            local_com_port=self.next_local_port,
+            local_com_port=self.next_local_port if self.local_ports else None,
             header_size=TEST_HEADER_SIZE,
             serializer=self.serializer,
             deserializer=self.deserializer,
-            deserializer_mode=self.deserializer_mode
+            deserializer_mode=self.deserializer_mode,
+            chunk_size=chunk_size,
+            coalesce_delay=coalesce_delay,
+            delta_broadcasts=delta_broadcasts,
+            engine=self.engine,
+            shm_threshold=shm_threshold,
+            max_queue_len=max_queue_len,
+            overflow=overflow,
+            mailbox=mailbox,
+            deserializer_workers=deserializer_workers,
+            deserializer_pool=deserializer_pool,
+            ack_window=ack_window
         )
         self.next_local_port += 1
         self.endpoints.append(ep)
         return ep
 
-    def spawn_relay(self, accepted_groups):
+    def spawn_pool(self, delta_broadcasts=False, chunk_size=DEFAULT_CHUNK_SIZE):
+        pool = EndpointPool(
+            ip_server=TEST_RELAY_IP,
+            port=TEST_RELAY_PORT,
+            password=TEST_PASSWORD,
+            local_com_port=self.next_local_port if self.local_ports else None,
+            header_size=TEST_HEADER_SIZE,
+            serializer=self.serializer,
+            deserializer=self.deserializer,
+            deserializer_mode=self.deserializer_mode,
+            chunk_size=chunk_size,
+            delta_broadcasts=delta_broadcasts,
+            engine=self.engine
+        )
+        self.next_local_port += 1
+        self.pools.append(pool)
+        return pool
+
+    def spawn_relay(self, accepted_groups, custom_serialization=True, compression=None, ack_window=DEFAULT_ACK_WINDOW,
+                    reconnection_timeout=DEFAULT_RECONNECTION_TIMEOUT, max_backlog=DEFAULT_MAX_BACKLOG):
         re = Relay(
             port=TEST_RELAY_PORT,
             password=TEST_PASSWORD,
             accepted_groups=accepted_groups,
-            local_com_port=self.next_local_port,
+            local_com_port=self.next_local_port if self.local_ports else None,
             header_size=TEST_HEADER_SIZE,
-            serializer=self.serializer,
-            deserializer=self.deserializer
+            serializer=self.serializer if custom_serialization else None,
+            deserializer=self.deserializer if custom_serialization else None,
+            compression=compression,
+            engine=self.engine,
+            ack_window=ack_window,
+            reconnection_timeout=reconnection_timeout,
+            max_backlog=max_backlog
         )
         self.next_local_port += 1
         self.relays.append(re)
@@ -50,5 +99,96 @@ class HelperTester:
     def clear(self):
         for ep in self.endpoints:
             ep.stop()
+        for pool in self.pools:
+            pool.stop()
         for re in self.relays:
             re.stop()
+
+
+class LegacyClient:
+    """
+    Minimal client speaking the legacy ASCII protocol, as Endpoints of older versions do.
+    """
+    def __init__(self, groups):
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        self.sock = context.wrap_socket(socket.create_connection((TEST_RELAY_IP, TEST_RELAY_PORT)))
+        self.stamp = 0
+        self.buf = b""
+        stamp, cmd, _ = self.recv()
+        assert cmd == 'HELLO', cmd
+        self.send(stamp, 'ACK')
+        self.send_obj('HELLO', obj=groups)
+
+    def send(self, stamp, cmd, dest=None, obj=None):
+        msg = pkl.dumps((stamp, cmd, dest, obj))
+        self.sock.sendall(encode_legacy_header(len(msg), TEST_HEADER_SIZE) + bytes(TEST_PASSWORD, 'utf-8') + msg)
+
+    def send_obj(self, cmd, dest=None, obj=None):
+        self.stamp += 1
+        self.send(self.stamp, cmd, dest, obj)
+
+    def recv(self):
+        while True:
+            if len(self.buf) >= TEST_HEADER_SIZE:
+                j = TEST_HEADER_SIZE + int(self.buf[:TEST_HEADER_SIZE])
+                if len(self.buf) >= j:
+                    res = pkl.loads(self.buf[TEST_HEADER_SIZE:j])
+                    self.buf = self.buf[j:]
+                    return res
+            self.buf += self.sock.recv(4096)
+
+    def recv_obj(self):
+        while True:
+            stamp, cmd, obj = self.recv()
+            if cmd != 'ACK':
+                self.send(stamp, 'ACK')
+                return pkl.loads(obj)
+
+    def close(self):
+        self.sock.close()
+
+
+class BinaryClient:
+    """
+    Minimal client speaking the binary protocol, advertising the broadcasts it already holds.
+    """
+    def __init__(self, groups, broadcasts, token=None, received=0):
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        self.sock = context.wrap_socket(socket.create_connection((TEST_RELAY_IP, TEST_RELAY_PORT)))
+        self.decoder = FrameDecoder(legacy=True, header_size=TEST_HEADER_SIZE)
+        stamp, cmd, obj = decode_hello(self.recv().body, pkl.loads)
+        assert cmd == 'HELLO' and stamp == 0 and obj['version'] == PROTOCOL_VERSION, (cmd, obj)
+        self.decoder.legacy = False
+        body = encode_control({'version': PROTOCOL_VERSION,
+                               'auth': hello_digest(TEST_PASSWORD, obj['nonce']),
+                               'groups': groups,
+                               'broadcasts': broadcasts,
+                               'token': token,
+                               'received': received})
+        self.sock.sendall(encode_frame('HELLO', body))
+
+    def recv(self):
+        frame = self.decoder.next_frame()
+        while frame is None:
+            self.decoder.feed(self.sock.recv(4096))
+            frame = self.decoder.next_frame()
+        return frame
+
+    def recv_obj(self, ack=True):
+        while True:
+            frame = self.recv()
+            if frame.cmd != 'ACK':
+                if ack:
+                    self.sock.sendall(encode_frame('ACK', stamp=frame.stamp))
+                return frame
+
+    def send_obj(self, stamp, dest, obj):
+        payload = pkl.dumps(obj)
+        self.sock.sendall(encode_envelope('OBJ', {'dest': dest}, len(payload), stamp) + payload)
+
+    def close(self):
+        self.sock.close()
@@ -1 +1,2 @@
-from tlspyo.api import Relay, Endpoint
+from tlspyo.api import Relay, Endpoint, EndpointPool
+from tlspyo.async_api import AsyncEndpoint
@@ -1,12 +1,23 @@
 import queue
-from socket import AF_INET, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR, socket
 import pickle as pkl
-from threading import Thread, Lock
-from multiprocessing import Process
+from threading import Thread, Lock, Condition
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import multiprocessing
 import os
 
 from tlspyo.server import Server
 from tlspyo.client import Client
+from tlspyo.engine import ENGINES, LocalChannel, ReactorThread, InProcessConnection, new_process
+from tlspyo.local_protocol_for_server import InProcessProtocolForServer
+from tlspyo.local_protocol_for_client import InProcessProtocolForClient
+from tlspyo.framing import ENVELOPE_COMMANDS, FLAG_OOB, FLAG_COMPRESSED, FLAG_DELTA, FLAG_FIRE_AND_FORGET, FLAG_SHM, DEFAULT_CHUNK_SIZE, FRAME_HEADER_SIZE, DEFAULT_STOP_TIMEOUT, FrameDecoder, \
+    encode_frame, encode_header, encode_routing, encode_envelope, encode_control, decode_control, send_parts, split_chunks
+from tlspyo.serialization import OOB_AVAILABLE, DEFAULT_COMPRESSION_THRESHOLD, COMPRESSION_CODECS, dumps_oob, loads_oob, \
+    compress_payload, decompress_payload, payload_hash, encode_delta, apply_delta
+from tlspyo.reliability import DEFAULT_ACK_WINDOW, DEFAULT_ACK_EVERY, DEFAULT_ACK_DELAY, DEFAULT_RECONNECTION_TIMEOUT, \
+    DEFAULT_MAX_BACKLOG
+from tlspyo.shm import SHM_AVAILABLE, DEFAULT_SHM_THRESHOLD, write_shared, read_shared, discard_shared
+from tlspyo.logs import logger
 
 from tlspyo.utils import get_from_queue
 
@@ -17,6 +28,22 @@ __docformat__ = "google"
 DEFAULT_SECURITY = "TLS"
 DEFAULT_SERIALIZER = pkl.dumps
 DEFAULT_DESERIALIZER = pkl.loads
+OVERFLOW_POLICIES = ("block", "drop_oldest", "drop_newest")
+DESERIALIZER_POOLS = ("thread", "process")
+QOS_LEVELS = ("reliable", "fire_and_forget")
+
+
+def _deserialize_payload(payload, flags, deserializer):
+    """
+    Deserializes a received payload (this is run by the workers of the deserializer pool, if any).
+    """
+    if flags & FLAG_COMPRESSED:
+        payload = decompress_payload(payload)
+        if flags & FLAG_OOB:
+            payload = bytearray(payload)  # out-of-band buffers are rebuilt in place
+    if flags & FLAG_OOB:
+        return loads_oob(payload)
+    return deserializer(payload)
 
 
 class Relay:
@@ -24,12 +51,20 @@ class Relay:
                  port: int,
                  password: str,
                  accepted_groups=None,
-                 local_com_port: int = 2096,
+                 local_com_port: int = None,
                  header_size: int = 10,
                  security: str = DEFAULT_SECURITY,
                  keys_dir: str = None,
                  serializer=None,
-                 deserializer=None):
+                 deserializer=None,
+                 compression=None,
+                 compression_threshold=None,
+                 engine: str = "process",
+                 ack_window: int = DEFAULT_ACK_WINDOW,
+                 ack_every: int = DEFAULT_ACK_EVERY,
+                 ack_delay: float = DEFAULT_ACK_DELAY,
+                 reconnection_timeout: float = DEFAULT_RECONNECTION_TIMEOUT,
+                 max_backlog: int = DEFAULT_MAX_BACKLOG):
         """
         ``tlspyo`` Relay.
 
@@ -49,16 +84,45 @@ class Relay:
 
                     - 'max_count': max number of connected clients in the group (None for unlimited)
                     - 'max_consumables': max number of pending consumables in the group (None for unlimited)
+                    - 'compression' (optional): overrides the compression argument for objects sent to the group
+                    - 'compression_threshold' (optional): overrides the compression_threshold argument for the group
+                    - 'qos' (optional): one of ("reliable", "fire_and_forget"); default QoS of the objects sent to the
+                      group (see Endpoint.send_object)
 
-            local_com_port (int): local port used for internal communication with Twisted.
-            header_size (int): bytes to read at once from socket buffers (the default should work for most cases)
+            local_com_port (int): local port used for internal communication with Twisted
+                (None to allocate a private channel automatically: a socketpair on POSIX systems, an ephemeral port
+                otherwise; only needed when the Twisted process must connect to a fixed port)
+            header_size (int): number of bytes used for the ASCII header of legacy frames, exchanged during the handshake and with Endpoints of other protocol versions (the default should work for most cases)
             security (str): one of (None, "TLS");
                 None disables TLS, do not use None on a public network unless you know what you are doing!
             serializer (callable): custom serializer that outputs a bytestring from a python object
+                (the Relay forwards objects without deserializing them, it only uses the serializer and deserializer
+                to communicate with Endpoints of older versions)
             deserializer (callable): custom deserializer that outputs a python object from a bytestring
+            compression (str): codec used by Endpoints to compress the objects they send (None for no compression);
+                one of ("zlib", "lz4", "zstd") or any codec registered with tlspyo.serialization.register_codec;
+                "lz4" and "zstd" require the lz4 and zstandard packages on all Endpoints;
+                objects sent to several groups are compressed only if all groups use the same setting
+            compression_threshold (int): objects whose serialized size is below this number of bytes are not compressed
+                (None for the default)
+            engine (str): one of ("process", "thread");
+                "process" runs Twisted in a separate process, which communicates with the Relay via local_com_port;
+                "thread" runs Twisted in a background thread of the calling process instead (see Endpoint)
+            ack_window (int): max number of objects sent to each Endpoint and not acknowledged yet (None for unlimited);
+                further objects wait in the Relay until acknowledgements arrive
+            ack_every (int): the objects received from an Endpoint are acknowledged at once, every ack_every objects
+            ack_delay (float): max number of seconds before the objects received from an Endpoint are acknowledged
+            reconnection_timeout (float): number of seconds during which the Relay keeps the unacknowledged objects
+                of a disconnected Endpoint, to retransmit them if the Endpoint reconnects (None to release them
+                immediately); Endpoints discard the objects they have already received
+            max_backlog (int): max size in bytes of the objects waiting for the ack_window of an Endpoint to open
+                (None for unlimited); a broadcast waiting for an Endpoint is replaced by the next broadcast to its group,
+                and Endpoints that exceed max_backlog anyway are disconnected and lose the waiting objects
+                (they receive the current broadcasts of their groups when they reconnect)
         """
 
         assert security in (None, "TLS"), f"Unsupported security: {security}"
+        assert engine in ENGINES, f"Unsupported engine: {engine}"
 
         if security is None:
             security = "TCP"
@@ -66,13 +130,12 @@ class Relay:
             security = "TLS"
 
         assert accepted_groups is None or isinstance(accepted_groups, dict), "Invalid format for accepted_groups."
+        if accepted_groups is not None:
+            for group, d_group in accepted_groups.items():
+                assert d_group.get('qos') in (None, ) + QOS_LEVELS, f"Unsupported qos for group {group}: {d_group['qos']}"
 
         self._header_size = header_size
-        self._local_com_port = local_com_port
-        self._local_com_srv = socket(AF_INET, SOCK_STREAM)
-        self._local_com_srv.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
-        self._local_com_srv.bind(('127.0.0.1', self._local_com_port))
-        self._local_com_srv.listen()
+        self._local_channel = LocalChannel(local_com_port) if engine == "process" else None
 
         keys_dir = os.path.abspath(keys_dir) if keys_dir is not None else keys_dir
         serializer = serializer if serializer is not None else DEFAULT_SERIALIZER
@@ -83,39 +146,97 @@ class Relay:
                               serializer=serializer,
                               deserializer=deserializer,
                               accepted_groups=accepted_groups,
-                              local_com_port=local_com_port,
+                              local_com_port=self._local_channel.port if self._local_channel is not None else None,
+                              local_com_sock=self._local_channel.child_sock if self._local_channel is not None else None,
                               header_size=header_size,
                               security=security,
-                              keys_dir=keys_dir)
-        self._p = Process(target=self._server.run, args=())
-        self._p.start()
-        self._local_com_conn, self._local_com_addr = self._local_com_srv.accept()
+                              keys_dir=keys_dir,
+                              compression=compression,
+                              compression_threshold=compression_threshold,
+                              ack_window=ack_window,
+                              ack_every=ack_every,
+                              ack_delay=ack_delay,
+                              reconnection_timeout=reconnection_timeout,
+                              max_backlog=max_backlog)
+        if engine == "process":
+            self._p = new_process(target=self._server.run)
+            self._p.start()
+            self._local_com_conn = self._local_channel.accept()
+        else:
+            self._local_com_conn = InProcessConnection(None)
+            self._local_com_conn.protocol = InProcessProtocolForServer(self._server, self._local_com_conn.frames)
+            self._p = ReactorThread(target=self._server.start, local=self._local_com_conn)
+            self._p.start()
         self._send_local('TEST')
 
         self._stop_lock = Lock()
         self._stopped = False
+        self._stats_lock = Lock()
+        self._decoder = FrameDecoder()  # replies of the Twisted process (see stats)
 
     def __del__(self):
         self.stop()
 
-    def _send_local(self, cmd):
-        msg = self._server.serializer((cmd, None))
-        msg = bytes(f"{len(msg):<{self._header_size}}", 'utf-8') + msg
-        self._local_com_conn.sendall(msg)
+    def _send_local(self, cmd, body=b""):
+        self._local_com_conn.sendall(encode_frame(cmd, body))
 
-    def stop(self):
+    def _recv_local(self):
+        """
+        Waits for the next frame of the Twisted process (or thread).
+        """
+        if isinstance(self._local_com_conn, InProcessConnection):
+            frame = self._local_com_conn.frames.get()
+            if frame is None:
+                raise ConnectionError("The Relay is stopped.")
+            return frame
+        frame = self._decoder.next_frame()
+        while frame is None:
+            data = self._local_com_conn.recv(self._header_size + 4096)
+            if len(data) == 0:
+                raise ConnectionError("The Relay is stopped.")
+            self._decoder.feed(data)
+            frame = self._decoder.next_frame()
+        return frame
+
+    def stats(self):
+        """
+        Statistics of the Relay.
+
+        The Relay keeps the objects it sends to each Endpoint until they are acknowledged,
+        and for reconnection_timeout seconds after the Endpoint disconnects:
+        pending_bytes is the memory held for them (payloads shared by several Endpoints are counted for each of them).
+
+        Returns:
+            dict: 'clients' (number of connected Endpoints),
+                'retained_links' (number of disconnected Endpoints whose objects are kept for reconnection),
+                'pending_frames' and 'pending_bytes' (number and size of the objects not acknowledged yet),
+                'backlog' and 'backlog_bytes' (number and size of the objects waiting for the ack_window of their
+                Endpoint to open)
+        """
+        with self._stats_lock:
+            self._send_local('STS')
+            frame = self._recv_local()
+        return decode_control(frame.body)
+
+    def stop(self, timeout=DEFAULT_STOP_TIMEOUT, force=False):
         """
         Stop the Relay.
+
+        The Relay waits until the objects it sent to Endpoints are acknowledged, or until the timeout expires.
+
+        Args:
+            timeout (float): maximum number of seconds to wait for acknowledgements (None to wait indefinitely)
+            force (bool): if True, the Relay is stopped without waiting for acknowledgements
         """
         try:
             with self._stop_lock:
                 if not self._stopped:
-                    self._send_local('STOP')
+                    self._send_local('STOP', encode_control({'timeout': timeout, 'force': force}))
 
                     self._p.join()
                     self._local_com_conn.close()
-                    self._local_com_srv.close()
-                    self._local_com_addr = None
+                    if self._local_channel is not None:
+                        self._local_channel.close()
                     self._stopped = True
         except KeyboardInterrupt as e:
             self.stop()
@@ -128,9 +249,9 @@ class Endpoint:
                  port: int,
                  password: str,
                  groups=None,
-                 local_com_port: int = 2097,
+                 local_com_port: int = None,
                  header_size: int = 10,
-                 max_buf_len: int = 4096,
+                 max_buf_len: int = 65536,
                  security: str = DEFAULT_SECURITY,
                  keys_dir: str = None,
                  hostname: str = "default",
@@ -140,7 +261,21 @@ class Endpoint:
                  recon_initial_delay=10.0,
                  recon_factor=1.5,
                  recon_jitter=0.1,
-                 deserializer_mode="asynchronous"):
+                 deserializer_mode="asynchronous",
+                 chunk_size: int = DEFAULT_CHUNK_SIZE,
+                 coalesce_delay: float = None,
+                 coalesce_max_size: int = 65536,
+                 delta_broadcasts: bool = False,
+                 engine: str = "process",
+                 shm_threshold: int = DEFAULT_SHM_THRESHOLD,
+                 max_queue_len: int = None,
+                 overflow: str = "block",
+                 mailbox=None,
+                 deserializer_workers: int = None,
+                 deserializer_pool: str = "thread",
+                 ack_window: int = DEFAULT_ACK_WINDOW,
+                 ack_every: int = DEFAULT_ACK_EVERY,
+                 ack_delay: float = DEFAULT_ACK_DELAY):
         """
         ``tlspyo`` Endpoint.
 
@@ -154,11 +289,15 @@ class Endpoint:
             password (str): password of the Relay (use the same for the Relay, the stronger, the better)
             groups (tuple of str, or str): groups in which this Endpoint is
             local_com_port (int): local port used for internal communication with Twisted
-            header_size (int): number of bytes used for the header (the default should be OK for most cases)
+                (None to allocate a private channel automatically: a socketpair on POSIX systems, an ephemeral port
+                otherwise; only needed when the Twisted process must connect to a fixed port)
+            header_size (int): number of bytes used for the ASCII header of legacy frames, exchanged during the handshake and with Relays of other protocol versions (the default should be OK for most cases)
             max_buf_len (int): max bytes to read at once from socket buffers (the default should be OK for most cases)
             security (str): one of (None, "TLS");
                 None disables TLS, do not use None on a public network unless you know what you are doing!
             serializer (callable): custom serializer that outputs a bytestring from a python object
+                (by default, objects are pickled with protocol 5 when available, and large contiguous buffers such as
+                numpy arrays are transferred out-of-band, without being copied into the pickle stream)
             deserializer (callable): custom deserializer that outputs a python object from a bytestring
             recon_max_delay (float): in case of network failure, maximum delay between reconnection attempts
             recon_initial_delay (float): in case of network failure, initial delay between reconnection attempts
@@ -170,9 +309,61 @@ class Endpoint:
                 in synchronous mode, objects are deserialized by the calling thread upon object retrieval;
                 synchronous mode removes the need for potentially useless, randomly timed deserialization in the
                 background, at the cost of performing deserialization upon object retrieval instead
+            chunk_size (int): objects whose serialized size is larger than this number of bytes are streamed in chunks
+                of this size, such that neither the Relay nor the Twisted processes buffer them entirely
+                before forwarding them (None to disable)
+            coalesce_delay (float): if not None, small objects and notifications sent within this delay (in seconds)
+                are coalesced and sent to the Relay as a single frame, which saves TLS records and acknowledgements
+                at the cost of this additional latency
+            coalesce_max_size (int): max size of coalesced frames in bytes (larger objects are sent immediately)
+            delta_broadcasts (bool): if True, objects broadcast to a single group are sent as binary deltas against
+                the previous object that this Endpoint broadcast to the group, when this is smaller;
+                the Relay and receivers rebuild full objects, and the Relay falls back to full objects for receivers
+                that do not hold the previous version; this Endpoint keeps the last serialized object of each group,
+                and these objects are neither compressed nor chunked
+            engine (str): one of ("process", "thread");
+                "process" runs Twisted in a separate process, which communicates with the Endpoint via local_com_port;
+                "thread" runs Twisted in a background thread of the calling process, shared by all the Relays and
+                Endpoints that use this engine, and objects are passed in memory (local_com_port is not used);
+                this saves the process spawn and the loopback hop, but Twisted then competes with the calling
+                process for the GIL; once a "thread" engine runs in a process, the Twisted processes of
+                subsequent "process" engines are spawned rather than forked, such that custom serializers and
+                deserializers must be picklable
+            shm_threshold (int): with the "process" engine, payloads larger than this number of bytes are passed
+                between the Endpoint and its Twisted process in shared memory rather than through local_com_port
+                (None to disable; shared memory is only used on POSIX systems)
+            max_queue_len (int): max number of received objects waiting to be retrieved (None for unlimited)
+            overflow (str): one of ("block", "drop_oldest", "drop_newest"); what happens when an object is received
+                while max_queue_len objects are waiting to be retrieved;
+                "block" blocks the receiver thread until an object is retrieved, and the Twisted process (or thread)
+                stops reading from the Relay meanwhile, such that received objects do not accumulate in memory;
+                "drop_oldest" discards the oldest waiting object, and "drop_newest" discards the received object;
+                discarded objects are counted in `stats`
+            mailbox (tuple of str, or str, or bool): groups whose received objects are kept in a latest-value mailbox
+                rather than queued (True for all groups); only the most recent object received from each of these
+                groups is kept, and it is deserialized only when it is retrieved with `get_latest`
+                (superseded objects are never deserialized, and are counted in `stats`)
+            deserializer_workers (int): in asynchronous deserializer_mode, number of workers that deserialize
+                received objects concurrently (None to deserialize them one at a time in the receiver thread);
+                objects are still retrieved in the order in which they were received
+            deserializer_pool (str): one of ("thread", "process"); kind of the deserializer_workers;
+                "thread" only helps with deserializers that release the GIL (e.g., decompression);
+                "process" deserializes objects in other processes, which requires a picklable deserializer,
+                and the deserialized objects are pickled back to the Endpoint: this only helps with expensive
+                custom deserializers (e.g., parsing or validation) whose output is cheap to pickle
+            ack_window (int): max number of objects sent to the Relay and not acknowledged yet (None for unlimited);
+                further objects wait in the Twisted process (or thread) until acknowledgements arrive;
+                unacknowledged objects are retransmitted if the connection is lost, and the Relay discards the objects
+                it has already received
+            ack_every (int): the objects received from the Relay are acknowledged at once, every ack_every objects
+            ack_delay (float): max number of seconds before the objects received from the Relay are acknowledged
         """
 
         assert security in (None, "TLS"), f"Unsupported security: {security}"
+        assert engine in ENGINES, f"Unsupported engine: {engine}"
+        assert overflow in OVERFLOW_POLICIES, f"Unsupported overflow policy: {overflow}"
+        assert deserializer_pool in DESERIALIZER_POOLS, f"Unsupported deserializer pool: {deserializer_pool}"
+        assert max_queue_len is None or max_queue_len > 0, "Value of max_queue_len must be > 0"
 
         if security is None:
             security = "TCP"
@@ -180,20 +371,41 @@ class Endpoint:
             security = "TLS"
 
         # threading for local object receiving
-        self.__obj_buffer = queue.Queue()
+        if isinstance(groups, str):
+            groups = (groups, )
+        if isinstance(mailbox, str):
+            mailbox = (mailbox, )
+        self._max_queue_len = max_queue_len
+        self._overflow = overflow
+        self._mailbox_groups = mailbox if mailbox is True else frozenset(mailbox or ())
+        self._init_session(0, groups)
+        self._sessions = {}  # logical endpoints multiplexed on our connection, by session (see EndpointPool)
         self.__socket_closed_lock = Lock() 
         self.__socket_closed_flag = False
     
         # networking (local and internet)
-        if isinstance(groups, str):
-            groups = (groups, )
         self._header_size = header_size
         self._max_buf_len = max_buf_len
-        self._local_com_port = local_com_port
-        self._local_com_srv = socket(AF_INET, SOCK_STREAM)
-        self._local_com_srv.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+        self._local_channel = LocalChannel(local_com_port) if engine == "process" else None
 
         self._deserialize_locally = deserializer_mode in ("synchronous", "sync")
+        self._deserializer_pool = None  # workers that deserialize received objects, in asynchronous mode
+        if deserializer_workers is not None and not self._deserialize_locally:
+            if deserializer_pool == "process":
+                # workers are spawned, because forking a process that runs threads is unsafe
+                self._deserializer_pool = ProcessPoolExecutor(max_workers=deserializer_workers,
+                                                              mp_context=multiprocessing.get_context('spawn'))
+            else:
+                self._deserializer_pool = ThreadPoolExecutor(max_workers=deserializer_workers)
+        self._oob = serializer is None and OOB_AVAILABLE
+        self._compression = None  # compression settings advertised by the Relay
+        # whether the Relay uses legacy frames (it cannot forward chunks or flags), None until the Relay advertises it:
+        self._relay_legacy = None
+        self._qos = {}  # QoS of the groups that set one, advertised by the Relay
+        self._chunk_size = chunk_size
+        self._delta_broadcasts = delta_broadcasts
+        self._send_lock = Lock()  # the receiver thread also sends frames
+        self._shm_threshold = shm_threshold if SHM_AVAILABLE and engine == "process" else None
 
         keys_dir = os.path.abspath(keys_dir) if keys_dir is not None else keys_dir
         serializer = serializer if serializer is not None else DEFAULT_SERIALIZER
@@ -205,7 +417,8 @@ class Endpoint:
                               serializer=serializer,
                               deserializer=deserializer,
                               groups=groups,
-                              local_com_port=local_com_port,
+                              local_com_port=self._local_channel.port if self._local_channel is not None else None,
+                              local_com_sock=self._local_channel.child_sock if self._local_channel is not None else None,
                               header_size=header_size,
                               security=security,
                               keys_dir=keys_dir,
@@ -213,14 +426,25 @@ class Endpoint:
                               recon_max_delay=recon_max_delay,
                               recon_initial_delay=recon_initial_delay,
                               recon_factor=recon_factor,
-                              recon_jitter=recon_jitter)
-
-        # start local server and Twisted process
-        self._local_com_srv.bind(('127.0.0.1', self._local_com_port))
-        self._local_com_srv.listen()
-        self._p = Process(target=self._client.run, args=())
-        self._p.start()
-        self._local_com_conn, self._local_com_addr = self._local_com_srv.accept()
+                              recon_jitter=recon_jitter,
+                              coalesce_delay=coalesce_delay,
+                              coalesce_max_size=coalesce_max_size,
+                              shm_threshold=self._shm_threshold,
+                              ack_window=ack_window,
+                              ack_every=ack_every,
+                              ack_delay=ack_delay)
+
+        if engine == "process":
+            # start Twisted process
+            self._p = new_process(target=self._client.run)
+            self._p.start()
+            self._local_com_conn = self._local_channel.accept()
+        else:
+            # run Twisted in the shared reactor thread, objects are passed in memory
+            self._local_com_conn = InProcessConnection(None)
+            self._local_com_conn.protocol = InProcessProtocolForClient(self._client, self._local_com_conn.frames)
+            self._p = ReactorThread(target=self._client.start, local=self._local_com_conn)
+            self._p.start()
         self._send_local(cmd='TEST')
 
         self._t_manage_received_objects = Thread(target=self._manage_received_objects, daemon=True)
@@ -232,44 +456,463 @@ class Endpoint:
     def __del__(self):
         self.stop()
 
-    def _deserialize(self, obj):
-        return self._client.deserializer(obj)
+    def _init_session(self, session, groups):
+        """
+        Initializes the state of the (logical) endpoint that is specific to its session.
+
+        Args:
+            session (int): 0 for an Endpoint, or identifier of a logical endpoint of an EndpointPool
+            groups (tuple of str): groups of the (logical) endpoint
+        """
+        self._session = session
+        self._groups = frozenset(groups or ())
+        self.__obj_buffer = queue.Queue(maxsize=self._max_queue_len or 0)
+        self._dropped = 0  # number of received objects discarded by the overflow policy
+        self._mailbox = {}  # most recent (payload, flags) received from each mailbox group
+        self._mailbox_cond = Condition()
+        self._superseded = 0  # number of mailbox objects replaced before being retrieved
+        self._transfers = {}  # chunked payloads being received, by transfer identifier
+        self._transfer_id = 0  # identifier of the last chunked transfer
+        self._delta_bases = {}  # last versioned broadcast sent to each group: (version, payload, flags)
+        self._broadcasts = {}  # last versioned broadcast received from each group: (version, payload)
+
+    def _get_compression(self, dest):
+        """
+        Compression setting shared by all destination groups.
+
+        Returns:
+            tuple: (codec, threshold), or None if the object must not be compressed
+        """
+        settings = self._compression
+        if settings is None or dest is None:
+            return None
+        res = None
+        for group in dest:
+            setting = settings['groups'].get(group, settings['default'])
+            if setting is None or (res is not None and setting != res):
+                return None
+            res = setting
+        if res is None or res[0] not in COMPRESSION_CODECS:
+            return None
+        codec, threshold = res
+        return codec, threshold if threshold is not None else DEFAULT_COMPRESSION_THRESHOLD
+
+    def _qos_flags(self, dest, qos=None):
+        """
+        Payload flags of the QoS of an object.
+
+        Args:
+            dest (dict): destination groups
+            qos (str): QoS of the object (None for the QoS of the destination groups)
+
+        Returns:
+            int: FLAG_FIRE_AND_FORGET if the object is fire-and-forget, 0 otherwise
+        """
+        assert qos in (None, ) + QOS_LEVELS, f"Unsupported qos: {qos}"
+        if qos is None:
+            # objects sent to several groups are fire-and-forget only if all groups are
+            qos = "fire_and_forget" if all(self._qos.get(group) == "fire_and_forget" for group in dest) else "reliable"
+        return FLAG_FIRE_AND_FORGET if qos == "fire_and_forget" and self._relay_legacy is False else 0
+
+    def _serialize(self, obj, dest=None):
+        """
+        Serializes an object into the parts of a payload.
+
+        With the default serializer, large contiguous buffers are kept out-of-band so that they are never copied.
+        Relays that use legacy frames forward payloads without flags: objects are pickled in-band instead
+        (as long as the Relay has not advertised its version).
+        Payloads are then compressed if the Relay requires it for the destination groups.
+
+        Returns:
+            tuple: (list of bytes-like parts, payload flags)
+        """
+        if self._oob and self._relay_legacy is not False:
+            parts, flags = [pkl.dumps(obj, protocol=5)], 0
+        elif self._oob:
+            parts, oob = dumps_oob(obj)
+            flags = FLAG_OOB if oob else 0
+        else:
+            parts, flags = [self._client.serializer(obj)], 0
+        compression = self._get_compression(dest)
+        if compression is not None:
+            codec, threshold = compression
+            if sum(len(part) for part in parts) >= threshold:
+                compressed = compress_payload(parts, codec)
+                if compressed is not None:
+                    parts, flags = compressed, flags | FLAG_COMPRESSED
+        return parts, flags
+
+    def _receive_broadcast(self, group, routing, payload, flags):
+        """
+        Rebuilds versioned broadcasts from deltas, and keeps the last version of each group.
+
+        Args:
+            group (str): group of the broadcast
+            routing (dict): routing header of the broadcast (of its first chunk if it was chunked)
+            payload (bytes-like): full payload or delta
+            flags (int): payload flags
+
+        Returns:
+            tuple: (payload, flags), or None if the base version of a delta is not available
+        """
+        if flags & FLAG_DELTA:
+            base = self._broadcasts.get(group)
+            if base is None or base[0] != routing['base']:
+                logger.warning(f"Received a delta for an unknown version of the broadcast of group {group}, discarding it.")
+                return None
+            payload = apply_delta(base[1], payload)
+            flags &= ~FLAG_DELTA
+        # out-of-band buffers are rebuilt in place, we keep an immutable copy:
+        self._broadcasts[group] = (routing['hash'], bytes(payload) if isinstance(payload, bytearray) else payload)
+        if flags & FLAG_OOB and not isinstance(payload, bytearray):
+            payload = bytearray(payload)
+        return payload, flags
+
+    def _deserialize(self, obj, flags=0):
+        return _deserialize_payload(obj, flags, self._client.deserializer)
+
+    def _deserialize_received(self, payload, flags):
+        """
+        Deserializes a received object in the receiver thread, or submits it to the deserializer pool.
+
+        Returns:
+            object: the object, or a Future of the object (resolved upon retrieval, see _process_received_list)
+        """
+        if self._deserializer_pool is not None:
+            return self._deserializer_pool.submit(_deserialize_payload, payload, flags, self._client.deserializer)
+        return self._deserialize(payload, flags)
+
+    def _receive_chunk(self, transfers, frame):
+        """
+        Reassembles chunked payloads in preallocated buffers.
+
+        Args:
+            transfers (dict): ongoing transfers, by transfer identifier
+            frame (Frame): received chunk
+
+        Returns:
+            tuple: (full payload, routing header of the first chunk) if frame is its last chunk, None otherwise
+        """
+        routing = frame.routing
+        if 'size' in routing:  # first chunk
+            transfers[routing['id']] = [bytearray(routing['size']), 0, routing]
+        transfer = transfers.get(routing['id'])
+        if transfer is None:
+            return None  # the first chunk was not received (e.g., we connected during the transfer)
+        payload, offset, first_routing = transfer
+        payload[offset:offset + len(frame.body)] = frame.body
+        transfer[1] = offset + len(frame.body)
+        if not routing['last']:
+            return None
+        del transfers[routing['id']]
+        if routing.get('abort', False) or transfer[1] != len(payload):
+            return None
+        return payload, first_routing
+
+    def _receive_local_frames(self):
+        """
+        Yields the frames received from the Twisted process (or thread), until the Endpoint is stopped.
+
+        With the "process" engine, the local channel is read until the Twisted process closes it.
+        """
+        if isinstance(self._local_com_conn, InProcessConnection):
+            frame = self._local_com_conn.frames.get()
+            while frame is not None:
+                yield frame
+                frame = self._local_com_conn.frames.get()
+            return
+        # out-of-band buffers are rebuilt in place, they need to be writable:
+        decoder = FrameDecoder(writable_flags=FLAG_OOB)
+        buffer = bytearray(self._max_buf_len)
+        view = memoryview(buffer)
+        while True:
+            received = self._local_com_conn.recv_into(buffer)
+            if received == 0:
+                return  # the Twisted process closed the local channel
+            decoder.feed(view[:received])
+            frame = decoder.next_frame()
+            while frame is not None:
+                if self._is_closed():
+                    # once the Endpoint is stopped, frames are read until the Twisted process closes the channel,
+                    # such that the shared memory segments of their payloads are destroyed
+                    if frame.flags & FLAG_SHM:
+                        discard_shared(frame.body)
+                elif frame.flags & FLAG_SHM:
+                    body = read_shared(frame.body, writable=bool(frame.flags & FLAG_OOB))
+                    yield frame._replace(flags=frame.flags & ~FLAG_SHM, body=body)
+                else:
+                    yield frame
+                frame = decoder.next_frame()
 
     def _manage_received_objects(self):
         """
         Called in its own thread.
         """
-        buf = b""
-        while True:
-            # Check if socket is still open
-            with self.__socket_closed_lock:
-                if self.__socket_closed_flag:
+        for frame in self._receive_local_frames():
+            if frame.cmd in ("OBJ", "CHK"):
+                endpoint = self._session_endpoint(frame.routing.get('session'))
+                if endpoint is not None:
+                    endpoint._receive_frame(frame)
+            elif frame.cmd == "CFG":
+                config = decode_control(frame.body)
+                self._compression = config['compression']
+                self._relay_legacy = config['legacy']
+                self._qos = config.get('qos') or {}
+            elif frame.cmd == "RST":
+                reset = decode_control(frame.body)
+                endpoint = self._session_endpoint(reset.get('session'))
+                if endpoint is not None:
+                    with self._send_lock:
+                        endpoint._send_full_broadcast(reset['group'], reset['hash'])
+
+    def _session_endpoint(self, session):
+        """
+        Logical endpoint to which a received frame is addressed (None if its session has been closed).
+        """
+        return self if not session else self._sessions.get(session)
+
+    def _receive_frame(self, frame):
+        """
+        Stores the object received in an OBJ frame, or in the last CHK frame of a transfer.
+        """
+        payload, routing, flags = frame.body, frame.routing, frame.flags
+        if frame.cmd == "CHK":
+            payload, routing = self._receive_chunk(self._transfers, frame) or (None, None)
+        if payload is None:
+            return
+        groups = [routing['group']] if 'group' in routing else routing.get('groups', [])
+        if routing.get('delta', False) and len(groups) > 0:
+            payload, flags = self._receive_broadcast(groups[0], routing, payload, flags) or (None, flags)
+            if payload is None:
+                return
+        group = self._mailbox_group(groups)
+        if group is not None:
+            with self._mailbox_cond:
+                if group in self._mailbox:
+                    self._superseded += 1
+                self._mailbox[group] = (payload, flags)
+                self._mailbox_cond.notify_all()
+        else:
+            to_put = (payload, flags) if self._deserialize_locally else self._deserialize_received(payload, flags)
+            self._put_received(to_put)
+
+    def _mailbox_group(self, groups):
+        """
+        Mailbox in which a received object is kept (None if it is queued).
+
+        Args:
+            groups (list of str): groups of the object (objects broadcast to several groups carry all of them)
+        """
+        for group in groups:
+            if (len(groups) == 1 or group in self._groups) \
+                    and (self._mailbox_groups is True or group in self._mailbox_groups):
+                return group
+        return None
+
+    def _put_received(self, obj):
+        """
+        Stores a received object (or its payload and flags in synchronous mode); called by the receiver thread.
+
+        When max_queue_len objects are waiting to be retrieved, the overflow policy applies.
+        """
+        if self._overflow == "drop_newest":
+            try:
+                self.__obj_buffer.put_nowait(obj)
+            except queue.Full:
+                self._dropped += 1
+        elif self._overflow == "drop_oldest":
+            while True:
+                try:
+                    self.__obj_buffer.put_nowait(obj)
                     return
+                except queue.Full:
+                    try:
+                        self.__obj_buffer.get_nowait()
+                        self._dropped += 1
+                    except queue.Empty:  # retrieved meanwhile
+                        pass
+        else:
+            try:
+                self.__obj_buffer.put_nowait(obj)
+                return
+            except queue.Full:
+                pass
+            # the Twisted process stops reading from the Relay until we can store the object:
+            self._send_flow('PAUSE')
+            while True:
+                try:
+                    self.__obj_buffer.put(obj, timeout=0.1)
+                    break
+                except queue.Full:
+                    # nothing is retrieved anymore once the Endpoint is stopped
+                    if self._is_closed():
+                        return
+            self._send_flow('RESUME')
+
+    def _send_flow(self, cmd):
+        try:
+            self._send_local(cmd)
+        except OSError:  # the Twisted process is stopping
+            pass
+
+    def _is_closed(self):
+        with self.__socket_closed_lock:
+            return self.__socket_closed_flag
+
+    def _wake_mailbox(self):
+        """
+        Wakes the calls to get_latest waiting for a mailbox object, which raise EOFError once we are stopped.
+        """
+        with self._mailbox_cond:
+            self._mailbox_cond.notify_all()
+
+    def _send_local(self, cmd, dest=None, obj=None, qos=None):
+        with self._send_lock:
+            if cmd == 'BAT':
+                self._send_batch(dest, obj, self._qos_flags(dest, qos))
+            elif cmd == 'OBJ' and self._delta_broadcasts and self._relay_legacy is False \
+                    and len(dest) == 1 and list(dest.values())[0] < 0:
+                self._send_delta(list(dest.keys())[0], obj, self._qos_flags(dest, qos))
+            elif cmd in ENVELOPE_COMMANDS:
+                parts, flags = self._serialize(obj, dest) if cmd == 'OBJ' else ([], 0)
+                if cmd == 'OBJ':
+                    flags |= self._qos_flags(dest, qos)
+                size = sum(len(part) for part in parts)
+                version = None
+                if cmd == 'OBJ' and self._relay_legacy is False and any(value < 0 for value in dest.values()):
+                    # clients that reconnect to the Relay do not receive broadcasts they already hold
+                    version = payload_hash(parts)
+                routing = {'dest': dest} if version is None else {'dest': dest, 'hash': version}
+                self._send_payload(cmd, routing, parts, size, flags)
+            else:
+                self._local_com_conn.sendall(encode_frame(cmd))
+
+    def _send_envelope(self, cmd, routing, parts, size, flags=0):
+        """
+        Sends an envelope to the Twisted process.
 
-            buf += self._local_com_conn.recv(self._max_buf_len)
-            i, j = self._process_header(buf)
-            while j <= len(buf):
-                stamp, cmd, obj = self._deserialize(buf[i:j])
-                if cmd == "OBJ":
-                    to_put = obj if self._deserialize_locally else self._deserialize(obj)
-                    self.__obj_buffer.put(to_put)  # TODO: maxlen
-                buf = buf[j:]
-                i, j = self._process_header(buf)
-
-    def _process_header(self, buf):
-        i = self._header_size
-        if len(buf) < i:
-            return 0, len(buf) + 1
-        data_len = int(buf[:self._header_size])
-        j = i + data_len
-        return i, j
-
-    def _send_local(self, cmd, dest=None, obj=None):
-        msg = self._client.serializer((cmd, dest, self._client.serializer(obj)))
-        msg = bytes(f"{len(msg):<{self._header_size}}", 'utf-8') + msg
-        self._local_com_conn.sendall(msg)
-
-    def send_object(self, obj, destination):
+        Payloads larger than shm_threshold are written once in shared memory,
+        only the name of their segment is sent through the local socket.
+        """
+        if self._shm_threshold is not None and size >= self._shm_threshold:
+            parts, flags = [write_shared(parts, size)], flags | FLAG_SHM
+            size = len(parts[0])
+        if self._session:
+            routing['session'] = self._session
+        if isinstance(self._local_com_conn, InProcessConnection):
+            # the routing header and payload are handed to the Twisted thread as they are, without being encoded;
+            # the destination is copied, the caller may reuse it
+            if 'dest' in routing:
+                routing['dest'] = dict(routing['dest'])
+            self._local_com_conn.send_frame(cmd, routing, parts, flags)
+            return
+        head = encode_envelope(cmd, routing, size, flags=flags)
+        send_parts(self._local_com_conn, [head] + parts)
+
+    def _send_payload(self, cmd, routing, parts, size, flags=0):
+        """
+        Sends an envelope, or streams its payload as a sequence of chunks if it is larger than chunk_size.
+
+        Payloads are only chunked once the Relay has advertised its version: Relays that use legacy frames
+        cannot forward chunks.
+        """
+        if self._chunk_size is not None and size > self._chunk_size and self._relay_legacy is False:
+            self._send_chunks(routing, parts, size, flags)
+        else:
+            self._send_envelope(cmd, routing, parts, size, flags)
+
+    def _send_delta(self, group, obj, qos_flags=0):
+        """
+        Broadcasts an object as a delta against the previous object broadcast to the group, when this is smaller.
+
+        Full payloads requested by the Relay are always sent reliably, the base does not keep qos_flags.
+        Payloads and deltas are not compressed (deltas are compressed by construction), but large ones are chunked.
+        """
+        parts, flags = self._serialize(obj)
+        payload = b"".join(parts)
+        version = payload_hash(payload)
+        base = self._delta_bases.get(group)
+        self._delta_bases[group] = (version, payload, flags)
+        routing = {'dest': {group: -1}, 'hash': version, 'delta': True}
+        if base is not None:
+            delta = encode_delta(base[1], payload)
+            if len(delta) < len(payload):
+                routing['base'] = base[0]
+                payload, flags = delta, flags | FLAG_DELTA
+        self._send_payload('OBJ', routing, [payload], len(payload), flags | qos_flags)
+
+    def _send_full_broadcast(self, group, version):
+        """
+        Sends the full payload of a delta broadcast, upon request of the Relay.
+
+        Nothing is sent if a more recent object has been broadcast to the group since then.
+        """
+        base = self._delta_bases.get(group)
+        if base is not None and base[0] == version:
+            _, payload, flags = base
+            self._send_payload('OBJ', {'dest': {group: -1}, 'hash': version, 'delta': True}, [payload], len(payload), flags)
+
+    def _send_batch(self, dest, objs, qos_flags=0):
+        """
+        Sends objects to the same destination in BAT frames of at most chunk_size bytes.
+
+        The routing header is encoded once and shared by all the objects,
+        except for broadcasts, whose routing header also holds the version (hash) of each object.
+        The batches of fire-and-forget objects are fire-and-forget themselves.
+        """
+        shared = {'dest': dest, 'session': self._session} if self._session else {'dest': dest}
+        routing = encode_routing(shared)
+        # clients that reconnect to the Relay do not receive broadcasts they already hold
+        broadcast = self._relay_legacy is False and any(value < 0 for value in dest.values())
+        max_size = self._chunk_size if self._chunk_size is not None else float('inf')
+        batch, size = [], 0
+        for obj in objs:
+            parts, flags = self._serialize(obj, dest)
+            flags |= qos_flags
+            obj_size = sum(len(part) for part in parts)
+            version = payload_hash(parts) if broadcast else None
+            if version is not None:
+                routing = encode_routing(dict(shared, hash=version))
+            frame_size = FRAME_HEADER_SIZE + len(routing) + obj_size
+            if len(batch) > 0 and (size + frame_size > max_size or obj_size > max_size):
+                self._send_batch_frame(batch, size, qos_flags)
+                batch, size = [], 0
+            if obj_size > max_size and self._relay_legacy is False:
+                self._send_chunks({'dest': dest} if version is None else {'dest': dest, 'hash': version},
+                                  parts, obj_size, flags)
+                continue
+            batch += [encode_header('OBJ', len(routing) + obj_size, flags=flags), routing] + parts
+            size += frame_size
+        if len(batch) > 0:
+            self._send_batch_frame(batch, size, qos_flags)
+
+    def _send_batch_frame(self, batch, size, flags=0):
+        """
+        Sends a BAT frame, whose body is the concatenation of the encoded frames of the batch.
+        """
+        if isinstance(self._local_com_conn, InProcessConnection):
+            self._local_com_conn.send_frame('BAT', None, batch, flags)
+        else:
+            send_parts(self._local_com_conn, [encode_header('BAT', size, flags=flags)] + batch)
+
+    def _send_chunks(self, routing, parts, size, flags):
+        """
+        Streams a large payload as a sequence of chunks.
+
+        Chunks are views of the payload, they are not copied.
+        The routing header of the payload (destination, version...) is sent with the first chunk.
+        """
+        self._transfer_id += 1
+        routing = dict(routing, id=self._transfer_id, size=size)
+        sent = 0
+        for chunk in split_chunks(parts, self._chunk_size):
+            chunk_len = sum(len(part) for part in chunk)
+            sent += chunk_len
+            routing['last'] = sent == size
+            self._send_envelope('CHK', routing, chunk, chunk_len, flags)
+            routing = {'id': self._transfer_id}
+
+    def send_object(self, obj, destination, qos=None):
         """
         Either broadcast object to destination group(s) or send it as a consumable.
 
@@ -288,10 +931,37 @@ class Endpoint:
             - if the value is N < 0, the object is broadcast to the group
             - if the value is N > 0, N objects are sent to the group to be consumed. To consume an object, the Endpoint first needs to signal itself as idle for the corresponding group with Endpoint.notify().
 
+        qos can either be:
+            - "reliable": the object is delivered at least once, it is retransmitted after disconnections
+            - "fire_and_forget": the object is sent immediately and is neither acknowledged nor retransmitted; it may be lost when a connection drops, and may overtake reliable objects that wait for the window to open (this is meant for frequently updated objects, e.g., telemetry, whose next update supersedes a lost one)
+            - None: the QoS of the destination groups in the Relay's accepted_groups (fire-and-forget only if all groups are)
+
         Args:
             obj (object): object to broadcast to destination
             destination (object): destination group(s)
+            qos (str): one of ("reliable", "fire_and_forget", None)
+        """
+        destination = self._format_destination(destination)
+        self._send_local(cmd='OBJ', dest=destination, obj=obj, qos=qos)
+
+    def send_objects(self, objs, destination, qos=None):
+        """
+        Sends several objects to the same destination group(s), in order.
+
+        This is equivalent to calling send_object for each object, but much more efficient for many small objects:
+        objects are transferred to the Relay in batches, which the Relay acknowledges and dispatches as a whole.
+        Batches are at most chunk_size large (objects larger than chunk_size are streamed separately).
+
+        Args:
+            objs (iterable): objects to send to destination
+            destination (object): destination group(s), as in send_object
+            qos (str): QoS of the objects, as in send_object
         """
+        destination = self._format_destination(destination)
+        self._send_local(cmd='BAT', dest=destination, obj=objs, qos=qos)
+
+    @staticmethod
+    def _format_destination(destination):
         if isinstance(destination, str):
             destination = {destination: -1}
         elif isinstance(destination, tuple) or isinstance(destination, list):
@@ -302,30 +972,44 @@ class Endpoint:
                 assert isinstance(k, str), f"destination keys must be strings."
                 assert isinstance(v, int), f"destination values must be integers."
         assert len(destination.keys()) > 0, f"Please specify at least one group to be notified"
-        self._send_local(cmd='OBJ', dest=destination, obj=obj)
+        return destination
 
-    def produce(self, obj, group):
+    def produce(self, obj, group, qos=None):
         """
-        Alias for send_object(obj=obj, destination={group: 1}).
+        Alias for send_object(obj=obj, destination={group: 1}, qos=qos).
 
         Args:
             obj (object): object to send as consumable
             group (str): target group
+            qos (str): QoS of the object, as in send_object
+        """
+        assert isinstance(group, str), f"group must be a string, not {type(group)}"
+        self.send_object(obj=obj, destination={group: 1}, qos=qos)
+
+    def produce_many(self, objs, group, qos=None):
+        """
+        Alias for send_objects(objs=objs, destination={group: 1}, qos=qos).
+
+        Args:
+            objs (iterable): objects to send as consumables
+            group (str): target group
+            qos (str): QoS of the objects, as in send_object
         """
         assert isinstance(group, str), f"group must be a string, not {type(group)}"
-        self.send_object(obj=obj, destination={group: 1})
+        self.send_objects(objs=objs, destination={group: 1}, qos=qos)
 
-    def broadcast(self, obj, group):
-        """Alias for send_object(obj=obj, destination={group: -1})
+    def broadcast(self, obj, group, qos=None):
+        """Alias for send_object(obj=obj, destination={group: -1}, qos=qos)
 
         Note that broadcasting an object overrides the previous brodcast object
 
         Args:
             obj (object): object to send to be broadcast to entire group
             group (str): destination group to which the object should be broadcast.
+            qos (str): QoS of the object, as in send_object
         """
         assert isinstance(group, str), f"group must be a string, not {type(group)}"
-        self.send_object(obj=obj, destination={group: -1})
+        self.send_object(obj=obj, destination={group: -1}, qos=qos)
 
     def notify(self, groups):
         """
@@ -360,36 +1044,62 @@ class Endpoint:
         assert len(groups.keys()) > 0, f"Please specify at least one group to be notified"
         self._send_local(cmd='NTF', dest=groups, obj=None)
 
-    def stop(self):
+    def stop(self, timeout=DEFAULT_STOP_TIMEOUT, force=False):
         """
         Stop the Endpoint.
+
+        The Endpoint waits until the objects it sent are acknowledged by the Relay, or until the timeout expires.
+
+        Args:
+            timeout (float): maximum number of seconds to wait for acknowledgements (None to wait indefinitely)
+            force (bool): if True, the Endpoint is stopped without waiting for acknowledgements
         """
         try:
             with self._stop_lock:
                 if not self._stopped:
                     # send STOP to the local server
-                    self._send_local(cmd='STOP', dest=None, obj=None)
+                    with self._send_lock:
+                        stop = encode_frame('STOP', encode_control({'timeout': timeout, 'force': force}))
+                        self._local_com_conn.sendall(stop)
 
                     # Join the message reading thread
                     with self.__socket_closed_lock:
                         self.__socket_closed_flag = True
+                    for endpoint in [self] + list(self._sessions.values()):
+                        endpoint._wake_mailbox()
                     self._t_manage_received_objects.join()
 
                     # join Twisted process and stop local server
                     self._p.join()
 
                     self._local_com_conn.close()
-                    self._local_com_srv.close()
-                    self._local_com_addr = None
+                    if self._local_channel is not None:
+                        self._local_channel.close()
+                    if self._deserializer_pool is not None:
+                        self._deserializer_pool.shutdown(wait=False)
                     self._stopped = True
         except KeyboardInterrupt as e:
             self.stop()
             raise e
 
+    def stats(self):
+        """
+        Statistics of the objects received by the Endpoint.
+
+        Returns:
+            dict: 'queued': number of received objects waiting to be retrieved,
+                'dropped': number of received objects discarded because max_queue_len was reached,
+                'superseded': number of mailbox objects replaced by a more recent one before being retrieved
+        """
+        return {'queued': self.__obj_buffer.qsize(), 'dropped': self._dropped, 'superseded': self._superseded}
+
     def _process_received_list(self, received_list):
         if self._deserialize_locally:
+            for i, (obj, flags) in enumerate(received_list):
+                received_list[i] = self._deserialize(obj, flags)
+        elif self._deserializer_pool is not None:
             for i, obj in enumerate(received_list):
-                received_list[i] = self._deserialize(obj)
+                received_list[i] = obj.result()  # waits for the workers, in order of reception
         return received_list
 
     def receive_all(self, blocking=False):
@@ -460,5 +1170,158 @@ class Endpoint:
         while len(elem) > 0:
             cpy += elem
             elem = get_from_queue(self.__obj_buffer, blocking=False)
+        if self._deserializer_pool is not None:
+            for obj in cpy[:-max_items]:
+                obj.cancel()  # older objects are not deserialized if their workers have not started
         cpy = self._process_received_list(cpy[-max_items:])
         return cpy
+
+    def get_latest(self, group, blocking=False):
+        """
+        Returns the most recent object received from a mailbox group (see the mailbox argument), if any.
+
+        The object is deserialized by this call, and removed from the mailbox:
+        subsequent calls only return an object once a more recent one is received from the group.
+
+        Args:
+            group (str): mailbox group
+            blocking (bool): If True, the call blocks until an object is available.
+                Otherwise, the returned list may be empty.
+
+        Returns:
+            list: The returned item (at most one).
+
+        Raises:
+            EOFError: if blocking and the Endpoint is stopped
+        """
+        with self._mailbox_cond:
+            while blocking and group not in self._mailbox:
+                if self._stopped or self._is_closed():
+                    raise EOFError("The Endpoint is stopped.")
+                self._mailbox_cond.wait()
+            item = self._mailbox.pop(group, None)
+        if item is None:
+            return []
+        return [self._deserialize(*item)]
+
+
+class PooledEndpoint(Endpoint):
+    def __init__(self, endpoint, session, groups):
+        """
+        Logical Endpoint of an EndpointPool.
+
+        It has the interface of an Endpoint, but shares the Twisted process (or thread), local channel, receiver thread
+        and connection to the Relay of its EndpointPool.
+        PooledEndpoints are created by `EndpointPool.endpoint`.
+
+        Args:
+            endpoint (Endpoint): Endpoint that owns the connection
+            session (int): identifier of the logical endpoint on the connection (> 0)
+            groups (tuple of str): groups in which this logical endpoint is
+        """
+        self._endpoint = endpoint
+        self._max_queue_len = endpoint._max_queue_len
+        self._overflow = endpoint._overflow
+        self._mailbox_groups = endpoint._mailbox_groups
+        self._init_session(session, groups)
+        self._header_size = endpoint._header_size
+        self._deserialize_locally = endpoint._deserialize_locally
+        self._deserializer_pool = endpoint._deserializer_pool
+        self._oob = endpoint._oob
+        self._chunk_size = endpoint._chunk_size
+        self._delta_broadcasts = endpoint._delta_broadcasts
+        self._send_lock = endpoint._send_lock
+        self._shm_threshold = endpoint._shm_threshold
+        self._client = endpoint._client
+        self._local_com_conn = endpoint._local_com_conn
+        self._stop_lock = Lock()
+        self._stopped = False
+        with self._send_lock:
+            endpoint._sessions[session] = self
+            self._local_com_conn.sendall(encode_frame('JOIN', encode_control({'session': session, 'groups': list(groups)})))
+
+    @property
+    def _compression(self):
+        return self._endpoint._compression
+
+    @property
+    def _relay_legacy(self):
+        return self._endpoint._relay_legacy
+
+    @property
+    def _qos(self):
+        return self._endpoint._qos
+
+    def _is_closed(self):
+        return self._endpoint._is_closed()
+
+    def stop(self):
+        """
+        Stop the logical Endpoint.
+
+        The Relay removes it from its groups, whereas the EndpointPool keeps running.
+        """
+        with self._stop_lock:
+            if not self._stopped:
+                with self._send_lock:
+                    if not self._endpoint._stopped:
+                        self._local_com_conn.sendall(encode_frame('LEAVE', encode_control({'session': self._session})))
+                    self._endpoint._sessions.pop(self._session, None)
+                self._stopped = True
+                self._wake_mailbox()
+
+
+class EndpointPool:
+    def __init__(self, ip_server: str, port: int, password: str, **kwargs):
+        """
+        Pool of logical ``tlspyo`` Endpoints that share a single connection to the Relay.
+
+        Each Endpoint costs a Twisted process (or thread), a local channel, a receiver thread and a TLS connection.
+        The logical Endpoints created by an EndpointPool (see `endpoint`) share all of these:
+        their objects are multiplexed on the connection of the pool, and demultiplexed by the Relay,
+        which treats each logical Endpoint as a separate client with its own groups.
+        This is useful to run many Endpoints (e.g., hundreds of simulated agents) on a single machine.
+
+        Args:
+            ip_server (str): the IP address of the Relay (set to '127.0.0.1' for local testing)
+            port (int): the port of the Relay
+            password (str): password of the Relay
+            kwargs: other arguments of `tlspyo.api.Endpoint` (except groups), shared by all logical Endpoints
+                (with the "block" overflow policy, a logical Endpoint whose queue is full pauses the reception of
+                objects for all the logical Endpoints of the pool)
+        """
+        assert 'groups' not in kwargs, "The groups of an EndpointPool are those of its logical Endpoints."
+        self._endpoint = Endpoint(ip_server=ip_server, port=port, password=password, groups=(), **kwargs)
+        self._session_lock = Lock()
+        self._last_session = 0
+
+    def __del__(self):
+        self.stop()
+
+    def endpoint(self, groups):
+        """
+        Creates a logical Endpoint that shares the connection of the pool.
+
+        Args:
+            groups (tuple of str, or str): groups in which the logical Endpoint is
+
+        Returns:
+            PooledEndpoint: the logical Endpoint, which has the interface of an Endpoint
+        """
+        if isinstance(groups, str):
+            groups = (groups, )
+        with self._session_lock:
+            self._last_session += 1
+            return PooledEndpoint(self._endpoint, self._last_session, groups)
+
+    def stop(self, timeout=DEFAULT_STOP_TIMEOUT, force=False):
+        """
+        Stop all the logical Endpoints of the pool, and the pool.
+
+        Args:
+            timeout (float): maximum number of seconds to wait for acknowledgements (None to wait indefinitely)
+            force (bool): if True, the pool is stopped without waiting for acknowledgements
+        """
+        for endpoint in list(self._endpoint._sessions.values()):
+            endpoint.stop()
+        self._endpoint.stop(timeout=timeout, force=force)
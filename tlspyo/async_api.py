@@ -0,0 +1,347 @@
+import asyncio
+import functools
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+from tlspyo.api import Endpoint
+from tlspyo.framing import DEFAULT_STOP_TIMEOUT
+
+
+__docformat__ = "google"
+
+
+_STOPPED = object()  # put in the queue of received objects when the Endpoint is stopped
+
+
+class _ReceivedQueue(asyncio.Queue):
+    """
+    Queue of received objects, holding at most max_queue_len objects (the marker of a stopped Endpoint always fits).
+    """
+    def __init__(self, max_queue_len=None):
+        super().__init__()
+        self._max_queue_len = max_queue_len
+        self._stopped = False
+        self._not_empty = asyncio.Event()
+
+    def full(self):
+        return not self._stopped and self._max_queue_len is not None and self.qsize() >= self._max_queue_len
+
+    def put_nowait(self, item):
+        super().put_nowait(item)
+        self._not_empty.set()
+
+    async def wait_not_empty(self):
+        """
+        Waits until the queue holds an object, without removing it.
+        """
+        while self.empty():
+            self._not_empty.clear()
+            await self._not_empty.wait()
+
+    def put_stopped(self):
+        self._stopped = True
+        self.put_nowait(_STOPPED)
+
+
+class _LoopEndpoint(Endpoint):
+    """
+    Endpoint whose receiver thread hands received objects to an asyncio event loop.
+    """
+    def __init__(self, loop, received, **kwargs):
+        self._loop = loop
+        self._received = received
+        self._mailbox_event = asyncio.Event()  # set when an object is stored in a mailbox
+        super().__init__(**kwargs)
+
+    def _receive_frame(self, frame):
+        super()._receive_frame(frame)
+        if self._mailbox_groups:
+            # wakes up the coroutines waiting for a mailbox object (see AsyncEndpoint.get_latest)
+            try:
+                self._loop.call_soon_threadsafe(self._mailbox_event.set)
+            except RuntimeError:  # the event loop is closed
+                pass
+
+    def _put_received(self, obj):
+        """
+        Hands a received object to the event loop; called by the receiver thread.
+
+        When max_queue_len objects are waiting to be retrieved, the overflow policy applies in the event loop
+        ("block" makes the receiver thread wait for the event loop, see Endpoint._put_received).
+        """
+        stored = self._in_loop(self._store(obj))
+        if self._overflow != "block" or stored is None or self._wait(stored) or self._is_closed():
+            return
+        # the Twisted process stops reading from the Relay until we can store the object:
+        self._send_flow('PAUSE')
+        stored = self._in_loop(self._received.put(obj))
+        if stored is not None:
+            self._wait(stored)
+        self._send_flow('RESUME')
+
+    def _in_loop(self, coroutine):
+        """
+        Schedules a coroutine in the event loop.
+
+        Returns:
+            concurrent.futures.Future: result of the coroutine (None if the event loop is closed)
+        """
+        try:
+            return asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+        except RuntimeError:  # the event loop is closed
+            coroutine.close()
+            return None
+
+    def _wait(self, future):
+        """
+        Waits for the result of a coroutine scheduled by _in_loop, unless the Endpoint is stopped meanwhile.
+        """
+        while True:
+            try:
+                return future.result(timeout=0.1)
+            except FutureTimeoutError:
+                # nothing is retrieved anymore once the Endpoint is stopped
+                if self._is_closed():
+                    future.cancel()
+                    return False
+
+    async def _store(self, obj):
+        """
+        Stores a received object in the event loop, unless max_queue_len objects are waiting to be retrieved.
+
+        Returns:
+            bool: whether obj is stored (with "drop_oldest", it is stored in place of the oldest object)
+        """
+        if self._received.full():
+            if self._overflow == "block":
+                return False
+            self._dropped += 1
+            if self._overflow == "drop_newest":
+                return False
+            dropped = self._received.get_nowait()
+            if isinstance(dropped, Future):
+                dropped.cancel()
+        self._received.put_nowait(obj)
+        return True
+
+
+class AsyncEndpoint:
+    def __init__(self, ip_server: str, port: int, password: str, groups=None, **kwargs):
+        """
+        ``tlspyo`` Endpoint for asyncio applications.
+
+        This is the asyncio counterpart of `tlspyo.api.Endpoint`:
+        received objects are delivered to the running event loop as soon as they arrive,
+        such that coroutines waiting for them are woken up without any additional thread.
+        An AsyncEndpoint must be created while an event loop is running in the calling thread (e.g., in a coroutine).
+
+        Sending objects only hands them to the local Twisted process (or thread), it does not wait for the network.
+        Objects are serialized and handed over in a dedicated thread, in the order of the calls,
+        such that the event loop is not blocked by large objects
+        (nor by the receiver thread of the Endpoint, which may hold the send lock to answer the Relay).
+
+        Args:
+            ip_server (str): the IP address of the Relay (set to '127.0.0.1' for local testing)
+            port (int): the port of the Relay
+            password (str): password of the Relay
+            groups (tuple of str, or str): groups in which this Endpoint is
+            kwargs: other arguments of `tlspyo.api.Endpoint`; with max_queue_len and overflow="block",
+                the Endpoint stops reading from the Relay until coroutines retrieve received objects
+        """
+        self._received = _ReceivedQueue(kwargs.get('max_queue_len'))
+        self._stopped = False
+        self._sender = ThreadPoolExecutor(max_workers=1)  # sends objects in order, outside the event loop
+        self._endpoint = _LoopEndpoint(loop=asyncio.get_running_loop(),
+                                       received=self._received,
+                                       ip_server=ip_server,
+                                       port=port,
+                                       password=password,
+                                       groups=groups,
+                                       **kwargs)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self.receive()
+        except EOFError:
+            raise StopAsyncIteration
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.stop()
+
+    def _next_received(self, obj):
+        if obj is _STOPPED:
+            self._received.put_nowait(_STOPPED)  # for other waiting coroutines
+            raise EOFError("The Endpoint is stopped.")
+        return self._endpoint._process_received_list([obj])[0]
+
+    async def receive(self):
+        """
+        Waits for the oldest received object (FIFO).
+
+        `async for obj in endpoint` iterates over received objects until the Endpoint is stopped.
+
+        Returns:
+            object: the received object
+
+        Raises:
+            EOFError: if the Endpoint is stopped
+        """
+        obj = await self._received.get()
+        if isinstance(obj, Future):
+            await asyncio.wait([asyncio.wrap_future(obj)])  # deserialized by the deserializer pool
+        return self._next_received(obj)
+
+    async def receive_all(self, blocking=False):
+        """
+        Returns all received objects in a list, from oldest to newest.
+
+        Args:
+            blocking (bool): If True, waits until objects are available. Otherwise, the list may be empty.
+
+        Returns:
+            list: received objects
+        """
+        res = [await self.receive()] if blocking else []
+        while not self._received.empty():
+            try:
+                res.append(self._next_received(self._received.get_nowait()))
+            except EOFError:
+                break
+        return res
+
+    async def get_last(self, max_items=1, blocking=False):
+        """
+        Returns at most the max_items most recently received objects, and clears the received objects.
+
+        Older objects are discarded without being deserialized in synchronous deserializer_mode.
+
+        Args:
+            max_items (int): maximum number of items to return
+            blocking (bool): If True, waits until at least one item is available. Otherwise, the list may be empty.
+
+        Returns:
+            list: The returned items, from older to more recent.
+        """
+        if blocking:
+            await self._received.wait_not_empty()
+        raw = []
+        while not self._received.empty():
+            obj = self._received.get_nowait()
+            if obj is _STOPPED:
+                self._received.put_nowait(_STOPPED)
+                break
+            raw.append(obj)
+        for obj in raw[:-max_items]:
+            if isinstance(obj, Future):
+                obj.cancel()
+        return self._endpoint._process_received_list(raw[-max_items:])
+
+    async def get_latest(self, group, blocking=False):
+        """
+        Returns the most recent object received from a mailbox group (see the mailbox argument), if any.
+
+        See `tlspyo.api.Endpoint.get_latest`.
+
+        Args:
+            group (str): mailbox group
+            blocking (bool): If True, waits until an object is available. Otherwise, the returned list may be empty.
+
+        Returns:
+            list: The returned item (at most one).
+
+        Raises:
+            EOFError: if blocking and the Endpoint is stopped
+        """
+        event = self._endpoint._mailbox_event
+        while True:
+            event.clear()
+            res = self._endpoint.get_latest(group)
+            if len(res) > 0 or not blocking:
+                return res
+            if self._stopped:
+                raise EOFError("The Endpoint is stopped.")
+            await event.wait()
+
+    async def _send(self, send, **kwargs):
+        """
+        Calls a send method of the Endpoint in the sender thread, and waits until it returns.
+        """
+        await asyncio.get_running_loop().run_in_executor(self._sender, functools.partial(send, **kwargs))
+
+    async def send_object(self, obj, destination, qos=None):
+        """
+        Either broadcast object to destination group(s) or send it as a consumable.
+
+        See `tlspyo.api.Endpoint.send_object`.
+
+        Args:
+            obj (object): object to send
+            destination (object): destination group(s)
+            qos (str): one of ("reliable", "fire_and_forget", None)
+        """
+        await self._send(self._endpoint.send_object, obj=obj, destination=destination, qos=qos)
+
+    async def send_objects(self, objs, destination, qos=None):
+        """
+        Sends several objects to the same destination group(s), in order.
+
+        See `tlspyo.api.Endpoint.send_objects`.
+
+        Args:
+            objs (iterable): objects to send to destination
+            destination (object): destination group(s)
+            qos (str): one of ("reliable", "fire_and_forget", None)
+        """
+        await self._send(self._endpoint.send_objects, objs=objs, destination=destination, qos=qos)
+
+    async def produce(self, obj, group, qos=None):
+        """
+        Alias for send_object(obj=obj, destination={group: 1}, qos=qos).
+        """
+        await self._send(self._endpoint.produce, obj=obj, group=group, qos=qos)
+
+    async def produce_many(self, objs, group, qos=None):
+        """
+        Alias for send_objects(objs=objs, destination={group: 1}, qos=qos).
+        """
+        await self._send(self._endpoint.produce_many, objs=objs, group=group, qos=qos)
+
+    async def broadcast(self, obj, group, qos=None):
+        """
+        Alias for send_object(obj=obj, destination={group: -1}, qos=qos).
+        """
+        await self._send(self._endpoint.broadcast, obj=obj, group=group, qos=qos)
+
+    async def notify(self, groups):
+        """
+        Notifies the Relay that the Endpoint is ready to retrieve consumables from destination groups.
+
+        See `tlspyo.api.Endpoint.notify`.
+
+        Args:
+            groups (object): destination groups of the consumables.
+        """
+        await self._send(self._endpoint.notify, groups=groups)
+
+    async def stop(self, timeout=DEFAULT_STOP_TIMEOUT, force=False):
+        """
+        Stop the Endpoint.
+
+        Coroutines waiting for received objects raise EOFError, and iterations over received objects end.
+
+        Args:
+            timeout (float): maximum number of seconds to wait for acknowledgements (None to wait indefinitely)
+            force (bool): if True, the Endpoint is stopped without waiting for acknowledgements
+        """
+        if self._stopped:
+            return
+        await self._send(self._endpoint.stop, timeout=timeout, force=force)  # after the objects being sent
+        self._sender.shutdown(wait=False)
+        self._received.put_stopped()
+        self._stopped = True
+        self._endpoint._mailbox_event.set()  # for coroutines waiting for mailbox objects
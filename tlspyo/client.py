@@ -7,10 +7,34 @@ from twisted.internet import ssl
 from twisted.internet.protocol import Protocol, ReconnectingClientFactory
 
 from tlspyo.local_protocol_for_client import LocalProtocolForClientFactory
+from tlspyo.framing import PROTOCOL_VERSION, PAYLOAD_FLAGS, FLAG_OOB, FLAG_COMPRESSED, FLAG_FIRE_AND_FORGET, ENVELOPE_COMMANDS, BATCH_COMMANDS, SESSION_COMMANDS, \
+    DEFAULT_STOP_TIMEOUT, FrameDecoder, encode_frame, encode_header, encode_envelope, encode_control, decode_batch, decode_hello, hello_digest, write_parts
+from tlspyo.serialization import inband_oob, decompress_payload
+from tlspyo.reliability import DEFAULT_ACK_WINDOW, DEFAULT_ACK_EVERY, DEFAULT_ACK_DELAY, Link
 from tlspyo.credentials import get_default_keys_folder
 from tlspyo.logs import logger
 
 
+def legacy_payload(obj, flags):
+    """
+    Re-encodes a payload for a Relay that uses legacy frames, which forwards payloads without flags.
+
+    The Endpoint may encode payloads before it knows the version of the Relay (e.g., when we reconnect to a Relay of an
+    older version): compressed payloads are decompressed, and the buffers of out-of-band pickles are moved in-band.
+
+    :param obj: bytes-like: payload
+    :param flags: int: payload flags
+    :return obj, flags: the payload, and the flags that cannot be removed (deltas require the previous broadcast)
+    """
+    if flags & FLAG_COMPRESSED:
+        obj = decompress_payload(obj)
+        flags &= ~FLAG_COMPRESSED
+    if flags & FLAG_OOB:
+        obj = b"".join(inband_oob(obj))
+        flags &= ~FLAG_OOB
+    return obj, flags
+
+
 class ClientProtocol(Protocol):
     def __init__(self,
                  client,
@@ -20,74 +44,384 @@ class ClientProtocol(Protocol):
 
         self._password = password
         self._header_size = header_size
-        self._buffer = b""
         self._groups = groups
         self._client = client
         self._state = "HANDSHAKE"
+        self._legacy = True  # legacy ASCII frames until the Relay advertises our protocol version
+        self._nonce = None  # authentication challenge of the Relay
+        # out-of-band buffers are rebuilt in place by in-process Endpoints, which receive the frames as they are:
+        self._decoder = FrameDecoder(legacy=True,
+                                     header_size=self._header_size,
+                                     writable_flags=FLAG_OOB if self._client.in_process else 0)
+        self._batch = []  # commands waiting to be coalesced into a BAT frame
+        self._batch_parts = []  # their encoded frames
+        self._batch_size = 0
+        self._batch_call = None  # delayed call that flushes the batch
+        self._ack_call = None  # delayed call that acknowledges the frames received from the Relay
+        self._chunk_versions = {}  # version of the broadcasts being received in chunks, by session and transfer identifier
 
     def connectionMade(self):
         assert self._state == "HANDSHAKE", f"Bad state: {self._state}"
         self._client.to_server = self
+        if self._client.paused:
+            self.transport.pauseProducing()
 
     def connectionLost(self, reason):
         self._state = "DEAD"
         self._client.to_server = None
-
-    def process_header(self):
-        i = self._header_size
-        if len(self._buffer) < i:
-            return 0, len(self._buffer) + 1
-        data_len = int(self._buffer[:self._header_size])
-        j = i + data_len
-        return i, j
+        if self._batch_call is not None and self._batch_call.active():
+            self._batch_call.cancel()
+        self._batch_call = None
+        if self._ack_call is not None and self._ack_call.active():
+            self._ack_call.cancel()
+        self._ack_call = None
+        self._client.link.unacknowledged = 0  # the Relay retransmits unacknowledged frames
+        # commands that were not sent yet will be sent after reconnection:
+        self._client.store = self._batch + self._client.store
+        self._batch, self._batch_parts, self._batch_size = [], [], 0
+
+    def parse_frame(self, frame):
+        if self._state == "HANDSHAKE":
+            # the HELLO of the Relay carries a control message, which we read without deserializing objects
+            return decode_hello(frame.body, self._client.deserializer)
+        if self._legacy:
+            return self._client.deserializer(frame.body)
+        return frame.stamp, frame.cmd, frame.body
 
     def dataReceived(self, data):
-        self._buffer += data
-        if len(self._buffer) >= self._header_size:
-            i, j = self.process_header()
-            while len(self._buffer) >= j:
-                stamp, cmd, obj = self._client.deserializer(self._buffer[i:j])
-                if cmd == 'ACK':
-                    try:
-                        logger.debug(f"ACK received after {time.monotonic() - self._client.pending_acks[stamp][0]}s.")
-                        del self._client.pending_acks[stamp]  # delete pending ACK
-                    except KeyError:
-                        logger.warning(f"Received ACK for stamp {stamp} not present in pending ACKs.")
+        self._decoder.feed(data)
+        frame = self._decoder.next_frame()
+        while frame is not None:
+            stamp, cmd, obj = self.parse_frame(frame)
+            flags = frame.flags & PAYLOAD_FLAGS
+            if cmd == 'ACK':
+                sent = self._client.link.acknowledge(stamp)
+                if sent is not None:
+                    logger.debug(f"ACK received after {time.monotonic() - sent}s.")
+                elif stamp != 0:
+                    logger.debug(f"Received ACK for stamp {stamp}, which acknowledges no pending frame.")
+                self.send_backlog()
+                self._client.check_close()
+            else:
+                if cmd == "HELLO" and isinstance(obj, dict) and obj.get('version') == PROTOCOL_VERSION:
+                    # the Relay speaks our protocol, we switch to binary frames in both directions:
+                    self._legacy = False
+                    self._decoder.legacy = False
+                    self._nonce = obj.get('nonce')
+                duplicate = stamp != 0 and not self._legacy and self._client.link.receive(stamp)
+                if stamp != 0:
+                    self.acknowledge(stamp)
+                if duplicate:
+                    logger.debug(f"Discarding retransmitted frame {stamp}.")
+                elif cmd == "HELLO":
+                    # payloads are compressed by the Endpoint, as advertised by the Relay:
+                    compression = None if self._legacy else obj.get('compression')
+                    qos = None if self._legacy else obj.get('qos')
+                    self._client.set_config({'compression': compression, 'qos': qos, 'legacy': self._legacy})
+                    self.send_control(cmd='HELLO', obj=self._groups)
+                    self._state = "ALIVE"
+                    if not self._legacy:
+                        for session in self._client.sessions.keys():
+                            # the Relay closed our sessions when we were disconnected
+                            self.send_session('JOIN', session, rejoin=True)
+                    self.resume_link()
                 else:
-                    self.send_ack(stamp)  # send ACK
-                    if cmd == "HELLO":
-                        self.send_obj(cmd='HELLO', obj=self._groups)
-                        self._state = "ALIVE"
-                        while len(self._client.store) > 0:
-                            # send buffered commands to the server
-                            cmd, dest, obj = self._client.store[0]
-                            self.send_obj(cmd=cmd, dest=dest, obj=obj)  # send buffered command
-                            self._client.store = self._client.store[1:]  # remove buffered command from store
-                    else:
-                        if self._state != "ALIVE":
-                            logger.warning(f"Received a command in a bad state: {self._state}.")
-                        if cmd == "OBJ":
-                            logger.debug(f"Received object, transferring to local EndPoint.")
-                            # transfer the object to the EndPoint server
-                            if self._client.endpoint is not None:
-                                self._client.endpoint.transport.write(self._buffer[:j])
-                            else:
-                                logger.warning(f"Local EndPoint is not connected, discarding object.")
-                # truncate the processed part of the buffer:
-                self._buffer = self._buffer[j:]
-                i, j = self.process_header()
-
-    def send_obj(self, cmd='OBJ', dest=None, obj=None):
-        self._client.ack_stamp += 1
-        msg = self._client.serializer((self._client.ack_stamp, cmd, dest, obj))
-        msg = bytes(f"{len(msg):<{self._header_size}}{self._password}", 'utf-8') + msg
-        self._client.pending_acks[self._client.ack_stamp] = (time.monotonic(), msg)
-        self.transport.write(msg)
+                    if self._state != "ALIVE":
+                        logger.warning(f"Received a command in a bad state: {self._state}.")
+                    if cmd in ("OBJ", "CHK"):
+                        logger.debug(f"Received object, transferring to local EndPoint.")
+                        # transfer the object to the EndPoint server
+                        if self._client.endpoint is not None:
+                            self._client.endpoint.send_obj(obj, flags, cmd=cmd, routing=frame.routing)
+                            if frame.routing is not None:
+                                self.record_broadcast(cmd, frame.routing)
+                        else:
+                            logger.warning(f"Local EndPoint is not connected, discarding object.")
+                    elif cmd == "RST":
+                        # the Relay requests the full payload of a delta broadcast
+                        if self._client.endpoint is not None:
+                            self._client.endpoint.send_reset(obj)
+            frame = self._decoder.next_frame()
+
+    def record_broadcast(self, cmd, routing):
+        """
+        Records the version of the broadcasts transferred to the Endpoint.
+
+        They are advertised to the Relay upon reconnection, so that it does not send them again.
+
+        :param cmd: str: OBJ or CHK
+        :param routing: dict: routing header of the received object
+        """
+        session = routing.get('session')
+        if not session:
+            broadcasts = self._client.broadcasts
+        elif session in self._client.sessions:
+            broadcasts = self._client.sessions[session]['broadcasts']
+        else:
+            return  # the session has been closed
+        if cmd == 'OBJ':
+            if 'hash' in routing:
+                broadcasts[routing['group']] = routing['hash']
+            return
+        key = (session, routing['id'])
+        if 'hash' in routing:  # first chunk of a versioned broadcast
+            self._chunk_versions[key] = (routing['groups'], routing['hash'])
+        if routing['last']:
+            version = self._chunk_versions.pop(key, None)
+            if version is not None and not routing.get('abort', False):
+                for group in version[0]:
+                    broadcasts[group] = version[1]
+
+    def send_session(self, cmd, session, rejoin=False):
+        """
+        Opens (JOIN) or closes (LEAVE) a logical session on the connection.
+
+        :param cmd: str: JOIN or LEAVE
+        :param session: int: session identifier
+        :param rejoin: bool: whether the session is opened again after reconnection, before frames are retransmitted
+        """
+        hello = {'session': session}
+        if cmd == 'JOIN':
+            hello['groups'] = self._client.sessions[session]['groups']
+            hello['broadcasts'] = self._client.sessions[session]['broadcasts']
+        if rejoin:
+            self.send_control(cmd=cmd, obj=hello)
+        else:
+            self.send_obj(cmd=cmd, obj=hello)
+
+    def resume_link(self):
+        """
+        Resumes the delivery of commands after the handshake.
+
+        Frames that were in flight when the previous connection was lost are retransmitted
+        (the Relay discards those it has already received), then waiting commands are sent.
+        """
+        link = self._client.link
+        if self._legacy:
+            link.pending.clear()  # legacy Relays do not discard retransmitted frames
+        else:
+            for _, parts in link.pending.values():
+                write_parts(self.transport, parts)
+        for command in self._client.store:
+            link.queue(command)
+        self._client.store = []
+        self.send_backlog()
+
+    def send_backlog(self):
+        """
+        Sends the commands that wait for the window to open, in order.
+        """
+        link = self._client.link
+        while len(link.backlog) > 0 and link.is_open() and self._state == "ALIVE":
+            cmd, routing, obj, flags = link.next_command()
+            self.send_command(cmd=cmd, routing=routing, obj=obj, flags=flags)
+
+    def build_frame(self, stamp, cmd, routing, obj, flags=0):
+        """
+        Encodes a command for the Relay.
+
+        :param routing: dict: routing header of envelopes, as built by the Endpoint
+        :param flags: int: payload flags of objects
+        :return parts: list of bytes: parts of the frame, to be written in order
+        """
+        if self._legacy:
+            dest = routing['dest'] if routing is not None else None
+            msg = self._client.serializer((stamp, cmd, dest, obj))
+            return [bytes(f"{len(msg):<{self._header_size}}{self._password}", 'utf-8') + msg]
+        if cmd in ENVELOPE_COMMANDS:
+            # the payload of objects is opaque to the Relay, only the routing header is decoded
+            payload = obj if obj is not None else b""
+            return [encode_envelope(cmd, routing, len(payload), stamp, flags), payload]
+        if cmd == 'BAT':
+            # batches are built by the Endpoint and forwarded as is
+            return [encode_header(cmd, len(obj), stamp, flags), obj]
+        if cmd == 'HELLO':
+            # we authenticate once, binary frames do not carry the password
+            body = encode_control({'version': PROTOCOL_VERSION,
+                                   'auth': hello_digest(self._password, self._nonce),
+                                   'groups': obj,
+                                   'broadcasts': self._client.broadcasts,
+                                   'token': self._client.token,
+                                   'received': self._client.link.received})
+            return [encode_frame(cmd, body, stamp)]
+        if cmd in SESSION_COMMANDS:
+            return [encode_frame(cmd, encode_control(obj), stamp)]
+        return [encode_frame(cmd, stamp=stamp)]
+
+    def send_control(self, cmd, obj):
+        """
+        Sends a command that belongs to the connection: it is neither acknowledged nor retransmitted.
+        """
+        write_parts(self.transport, self.build_frame(0, cmd, None, obj))
+
+    def send_obj(self, cmd='OBJ', routing=None, obj=None, flags=0):
+        """
+        Sends a command to the Relay, or appends it to the backlog of the link if the window is closed.
+
+        Fire-and-forget objects bypass the link: they are sent immediately, and may overtake waiting commands.
+        """
+        if flags & FLAG_FIRE_AND_FORGET and not self._legacy:
+            write_parts(self.transport, self.build_frame(0, cmd, routing, obj, flags))
+            return
+        link = self._client.link
+        if len(link.backlog) > 0 or not link.is_open():
+            link.queue((cmd, routing, obj, flags))  # sent once frames in flight are acknowledged
+            return
+        self.send_command(cmd=cmd, routing=routing, obj=obj, flags=flags)
+
+    def send_command(self, cmd='OBJ', routing=None, obj=None, flags=0):
+        if self._legacy:
+            flags &= ~FLAG_FIRE_AND_FORGET  # legacy Relays acknowledge all frames
+            if cmd == 'CHK':
+                # legacy Relays cannot forward chunks, we send the object once it is complete
+                routing, obj = self.join_chunks(routing, obj)
+                if obj is None:
+                    return
+                cmd = 'OBJ'
+            if flags:
+                obj, flags = legacy_payload(obj, flags)
+        if flags and self._legacy:
+            logger.error(f"The Relay uses legacy frames and cannot forward this object, discarding it.")
+            return
+        if self._legacy and (cmd in SESSION_COMMANDS or (routing is not None and routing.get('session'))):
+            logger.warning(f"The Relay uses legacy frames and does not support sessions, discarding command {cmd}.")
+            return
+        if cmd == 'BAT' and self._legacy:
+            # the Relay cannot unpack batches, we send the batched commands one by one
+            for frame in decode_batch(obj):
+                self.send_command(cmd=frame.cmd, routing=frame.routing, obj=frame.body, flags=frame.flags)
+            return
+        if self._client.coalesce_delay is not None and cmd in BATCH_COMMANDS and not self._legacy:
+            parts = self.build_frame(0, cmd, routing, obj, flags)
+            if sum(len(part) for part in parts) < self._client.coalesce_max_size:
+                self.batch_parts(parts, (cmd, routing, obj, flags))
+                return
+        link = self._client.link
+        if len(self._batch) > 0 and link.is_open():
+            self.flush_batch()  # commands are sent in order
+        if not link.is_open():
+            # the batch used the last frame of the window: the command waits for frames in flight to be acknowledged
+            self.requeue_batch((cmd, routing, obj, flags))
+            return
+        msg = link.send(lambda stamp: self.build_frame(stamp, cmd, routing, obj, flags))
+        write_parts(self.transport, msg)
+
+    def join_chunks(self, routing, chunk):
+        """
+        Reassembles the chunks of a payload, for a Relay that uses legacy frames.
+
+        The Endpoint may chunk payloads before it knows the version of the Relay (e.g., when we reconnect to a Relay
+        of an older version).
+
+        :param routing: dict: routing header of the chunk
+        :param chunk: bytes-like: the chunk
+        :return (routing, payload): routing header and payload of the object once its last chunk is received,
+            (None, None) before
+        """
+        transfers = self._client.legacy_transfers
+        first, chunks = transfers.setdefault(routing['id'], (routing, []))
+        chunks.append(bytes(chunk))
+        if not routing['last']:
+            return None, None
+        del transfers[routing['id']]
+        if 'dest' not in first:
+            logger.error(f"Missing the first chunks of an object, discarding it.")
+            return None, None
+        return first, b"".join(chunks)
 
     def send_ack(self, stamp):
-        msg = self._client.serializer((stamp, 'ACK', None, None))
-        msg = bytes(f"{len(msg):<{self._header_size}}{self._password}", 'utf-8') + msg
-        self.transport.write(msg)
+        msg = self.build_frame(stamp, 'ACK', None, None)
+        write_parts(self.transport, msg)
+
+    def acknowledge(self, stamp):
+        """
+        Acknowledges a frame received from the Relay.
+
+        Frames are acknowledged by a single cumulative ACK, once ack_every frames have been received
+        or ack_delay seconds after the first of them (legacy Relays expect an ACK per frame).
+
+        :param stamp: int: stamp of the frame
+        """
+        if self._legacy:
+            self.send_ack(stamp)
+            return
+        link = self._client.link
+        link.unacknowledged += 1
+        if link.unacknowledged >= self._client.ack_every:
+            self.flush_ack()
+        elif self._ack_call is None:
+            from twisted.internet import reactor
+            self._ack_call = reactor.callLater(self._client.ack_delay, self.flush_ack)
+
+    def flush_ack(self):
+        """
+        Acknowledges all the frames received from the Relay so far.
+        """
+        if self._ack_call is not None and self._ack_call.active():
+            self._ack_call.cancel()
+        self._ack_call = None
+        link = self._client.link
+        if link.unacknowledged > 0:
+            link.unacknowledged = 0
+            self.send_ack(link.received)
+
+    def batch_parts(self, parts, command):
+        """
+        Coalesces a small command with the commands sent shortly before or after it.
+
+        The batch is sent as a single BAT frame (acknowledged once) after coalesce_delay,
+        or as soon as it would exceed coalesce_max_size.
+
+        :param parts: list of bytes: encoded frame of the command
+        :param command: tuple: (cmd, routing, obj, flags) of the command, stored again if the connection is lost
+        """
+        size = sum(len(part) for part in parts)
+        if self._batch_size + size > self._client.coalesce_max_size:
+            if not self._client.link.is_open():
+                self.requeue_batch(command)
+                return
+            self.flush_batch()
+        self._batch.append(command)
+        self._batch_parts += parts
+        self._batch_size += size
+        if self._batch_call is None:
+            from twisted.internet import reactor
+            self._batch_call = reactor.callLater(self._client.coalesce_delay, self.flush_batch)
+
+    def flush_batch(self):
+        """
+        Sends the pending batch of commands, if any.
+
+        If the window is closed, the commands return to the backlog instead (they are coalesced again when sent).
+        """
+        if self._batch_call is not None and self._batch_call.active():
+            self._batch_call.cancel()
+        self._batch_call = None
+        if len(self._batch) == 0:
+            return
+        if not self._client.link.is_open():
+            self.requeue_batch()
+            return
+        parts, size = self._batch_parts, self._batch_size
+        msg = self._client.link.send(lambda stamp: [encode_header('BAT', size, stamp)] + parts)
+        self._batch, self._batch_parts, self._batch_size = [], [], 0
+        write_parts(self.transport, msg)
+
+    def requeue_batch(self, command=None):
+        """
+        Puts the pending batch of commands back at the start of the backlog, followed by a command that could not be sent.
+
+        :param command: tuple: (cmd, routing, obj, flags) of the command, if any
+        """
+        if self._batch_call is not None and self._batch_call.active():
+            self._batch_call.cancel()
+        self._batch_call = None
+        link = self._client.link
+        if command is not None:
+            link.queue(command, first=True)
+        for batched in reversed(self._batch):
+            link.queue(batched, first=True)
+        self._batch, self._batch_parts, self._batch_size = [], [], 0
 
     def get_state(self):
         return self._state
@@ -136,13 +470,20 @@ class Client:
                  header_size=10,
                  groups=None,
                  local_com_port=2097,
+                 local_com_sock=None,
                  security="TLS",
                  keys_dir=None,
                  hostname='default',
                  recon_max_delay=60.0,
                  recon_initial_delay=10.0,
                  recon_factor=1.5,
-                 recon_jitter=0.1):
+                 recon_jitter=0.1,
+                 coalesce_delay=None,
+                 coalesce_max_size=65536,
+                 shm_threshold=None,
+                 ack_window=DEFAULT_ACK_WINDOW,
+                 ack_every=DEFAULT_ACK_EVERY,
+                 ack_delay=DEFAULT_ACK_DELAY):
 
         self.serializer = serializer
         self.deserializer = deserializer
@@ -151,14 +492,26 @@ class Client:
         self._ip_server = ip_server
         self._port_server = port_server
         self._local_com_port = local_com_port
+        self.local_com_sock = local_com_sock  # end of the local socketpair, if the channel is not a TCP port
         self.password = password
         self.header_size = header_size
         self._reactor = None
+        self._stop = None  # called when the client is closed
+        self._factory = None
+        self.in_process = False  # whether the Endpoint runs in the same process (see tlspyo.engine)
         self.to_server = None  # to communicate with the central relay
         self.endpoint = None  # to communicate with endpoint
         self.store = []
-        self.ack_stamp = 0
-        self.pending_acks = {}  # this contains copies of sent commands until corresponding ACKs are received
+        self.legacy_transfers = {}  # chunks of the objects being sent to a legacy Relay, by transfer (see ClientProtocol.join_chunks)
+        self.broadcasts = {}  # version of the last broadcast transferred to the Endpoint, by group
+        self.sessions = {}  # 'groups' and 'broadcasts' of the logical Endpoints multiplexed on our connection, by session
+        self.config = None  # settings advertised by the Relay, forwarded to the Endpoint
+        self.token = os.urandom(16).hex()  # identifies us to the Relay across reconnections
+        self.link = Link(window=ack_window)  # sent commands are kept until the Relay acknowledges them
+        self.ack_every = ack_every  # number of received frames acknowledged at once
+        self.ack_delay = ack_delay  # max delay before received frames are acknowledged
+        self._closing = False  # whether we terminate once all pending ACKs are received
+        self._close_deadline = None  # terminates the client if pending ACKs are not received in time
         self._security = security
         self._keys_dir = keys_dir
         self._hostname = hostname
@@ -166,6 +519,10 @@ class Client:
         self.recon_initial_delay = recon_initial_delay
         self.recon_factor = recon_factor
         self.recon_jitter = recon_jitter
+        self.coalesce_delay = coalesce_delay
+        self.coalesce_max_size = coalesce_max_size
+        self.shm_threshold = shm_threshold  # payloads larger than this are passed to the Endpoint in shared memory
+        self.paused = False  # whether we stop reading from the Relay because the Endpoint does not retrieve objects
 
     def run(self):
         """
@@ -176,12 +533,39 @@ class Client:
         # from twisted.internet.interfaces import IReadDescriptor
         from twisted.internet import reactor
 
+        self.start(reactor)
+
+        # Start the reactor
+        reactor.run()
+
+        # When done, deallocate reactor memory
+        self._reactor = None
+
+    def start(self, reactor, local=None, stop=None):
+        """
+        Connects to the local Endpoint and to the Relay.
+
+        :param reactor: the Twisted reactor (must be called in its thread)
+        :param local: InProcessConnection: in-memory connection to the Endpoint (None to connect to local_com_port)
+        :param stop: callable: called when the client is closed (None to stop the reactor)
+        """
+        self._reactor = reactor
+        self._stop = stop if stop is not None else reactor.stop
+
         # Initialize the local connection
-        reactor.connectTCP(host='127.0.0.1', port=self._local_com_port, factory=LocalProtocolForClientFactory(self))
+        if self.local_com_sock is not None:
+            reactor.adoptStreamConnection(self.local_com_sock.fileno(), self.local_com_sock.family, LocalProtocolForClientFactory(self))
+            self.local_com_sock.close()  # the reactor uses a copy
+        elif local is None:
+            reactor.connectTCP(host='127.0.0.1', port=self._local_com_port, factory=LocalProtocolForClientFactory(self))
+        else:
+            self.in_process = True
+            local.connect()
 
         # Initialize the Internet connection
+        self._factory = TLSClientFactory(client=self)
         if self._security == "TCP":
-            reactor.connectTCP(host=self._ip_server, port=self._port_server, factory=TLSClientFactory(client=self))
+            reactor.connectTCP(host=self._ip_server, port=self._port_server, factory=self._factory)
         elif self._security == "TLS":
             # Use default keys if none are provided
             self_signed = os.path.join(self._keys_dir, 'certificate.pem') if self._keys_dir is not None else os.path.join(get_default_keys_folder(), 'certificate.pem')
@@ -196,42 +580,111 @@ class Client:
             reactor.connectSSL(
                 host=self._ip_server,
                 port=self._port_server,
-                factory=TLSClientFactory(client=self),
+                factory=self._factory,
                 contextFactory=ssl.optionsForClientTLS(hostname=self._hostname, trustRoot=authority)
             )
         else:
             logger.warning(f"Unsupported connection: {self._security}")
-        
-        # Start the reactor
-        self._reactor = reactor
-        reactor.run()
 
-        # When done, deallocate reactor memory
-        self._reactor = None
+    def set_config(self, config):
+        """
+        Updates the settings advertised by the Relay and forwards them to the Endpoint.
+
+        :param config: dict: JSON-serializable settings
+        """
+        self.config = config
+        if self.endpoint is not None:
+            self.endpoint.send_config(config)
+
+    def pause_reception(self, paused):
+        """
+        Stops or starts again reading from the Relay, upon request of the Endpoint.
+
+        While we do not read, the Relay cannot send more objects than the network buffers can hold.
+
+        :param paused: bool: whether to stop reading
+        """
+        if paused != self.paused:
+            self.paused = paused
+            if self.to_server is not None:
+                if paused:
+                    self.to_server.transport.pauseProducing()
+                else:
+                    self.to_server.transport.resumeProducing()
+
+    def update_session(self, cmd, hello):
+        """
+        Opens (JOIN) or closes (LEAVE) a session of the local Endpoint, and forwards it to the Relay.
+
+        Sessions are opened again upon reconnection.
+
+        :param cmd: str: JOIN or LEAVE
+        :param hello: dict: 'session' identifier, and 'groups' of the session if it is opened
+        """
+        session = hello['session']
+        if cmd == 'JOIN':
+            self.sessions[session] = {'groups': hello['groups'], 'broadcasts': {}}
+        elif self.sessions.pop(session, None) is None:
+            return
+        if self.to_server is not None and self.to_server.get_state() == "ALIVE":
+            self.to_server.send_session(cmd, session)
 
     def check_acks(self):
         """Returns true if we are not waiting for acknowledgements.
 
         Returns:
-            bool: Whether the dictionary of pending acknowledgements is empty.
+            bool: Whether all the commands of the link have been sent and acknowledged.
         """
-        res = len(self.pending_acks.keys()) == 0 
-        return res
-
-    def close(self, counter):
+        return self.link.is_idle()
 
-        # Check if we are allowed to leave by looking at acknowledgements
-        logger.debug(f"Attempting to terminate Endpoint for {counter}th time")
+    def close(self, timeout=DEFAULT_STOP_TIMEOUT, force=False):
+        """
+        Terminates the client as soon as all pending ACKs are received.
 
-        if self.check_acks() or counter > 10:
-            if self._reactor is not None:
-                if self.to_server is not None:
-                    self.to_server.transport.loseConnection()
-                logger.info(f"Succesfully terminated endpoint connections")
-                self._reactor.stop()
+        :param timeout: float: maximum number of seconds to wait for pending ACKs (None to wait indefinitely)
+        :param force: bool: if True, the client is terminated immediately (also if it is already closing)
+        """
+        if self._closing:
+            if force:
+                self.terminate()  # stop waiting for pending ACKs
+            return
+        self._closing = True
+        self.pause_reception(False)  # the ACKs of the Relay must be read
+        if self.to_server is not None:
+            self.to_server.flush_batch()
+        if force or self.check_acks():
+            self.terminate()
         else:
-            from twisted.internet import reactor
-            reactor.callLater(1, self.close, counter+1)
+            logger.debug(f"Waiting for {len(self.link.pending)} pending ACKs before terminating Endpoint.")
+            if timeout is not None and self._reactor is not None:
+                self._close_deadline = self._reactor.callLater(timeout, self.terminate)
+
+    def check_close(self):
+        """
+        Called when an ACK is received: terminates the client if it was waiting for this ACK to close.
+        """
+        if self._closing and self.check_acks():
+            self.terminate()
+
+    def terminate(self):
+        if self._close_deadline is not None:
+            if self._close_deadline.active():
+                self._close_deadline.cancel()
+            else:
+                logger.warning(f"Terminating Endpoint with {len(self.link.pending)} pending ACKs.")
+            self._close_deadline = None
+        if self._reactor is not None and self._stop is not None:
+            self._factory.stopTrying()  # the reactor may be shared with other clients
+            if self.to_server is not None:
+                self.to_server.flush_ack()
+                self.to_server.transport.loseConnection()
+            logger.info(f"Succesfully terminated endpoint connections")
+            stop, self._stop = self._stop, None  # the client is terminated only once
+            if self.endpoint is not None:
+                # the frames written to the Endpoint are flushed first (their payloads may be in shared memory)
+                self.endpoint.when_lost(stop)
+            else:
+                stop()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,212 @@
+import queue
+import socket
+import threading
+import multiprocessing
+
+from twisted.internet import error
+from twisted.python import failure
+
+from tlspyo.framing import FRAME_HEADER_SIZE, Frame
+from tlspyo.utils import wait_event
+
+
+ENGINES = ("process", "thread")
+
+_reactor_lock = threading.Lock()
+_reactor_thread = None  # thread running the shared reactor, if any
+
+
+def shared_reactor():
+    """
+    Starts the Twisted reactor in a background thread of the calling process, if it is not running yet.
+
+    All the Relays and Endpoints that use the "thread" engine in a process share this reactor.
+
+    :return reactor: the running reactor
+    """
+    global _reactor_thread
+    from twisted.internet import reactor
+    with _reactor_lock:
+        if _reactor_thread is None:
+            _reactor_thread = threading.Thread(target=reactor.run, kwargs={'installSignalHandlers': False}, daemon=True)
+            _reactor_thread.start()
+    return reactor
+
+
+def new_process(target):
+    """
+    Process running the reactor of a Relay or Endpoint that uses the "process" engine.
+
+    Once the shared reactor runs in the calling process, processes are spawned instead of forked,
+    because forked processes would inherit a running reactor (the target must then be picklable).
+
+    :param target: callable: run method of the Client or Server
+    :return process: multiprocessing.Process: the process (not started)
+    """
+    if _reactor_thread is not None:
+        return multiprocessing.get_context('spawn').Process(target=target, args=())
+    return multiprocessing.Process(target=target, args=())
+
+
+class LocalChannel:
+    """
+    Local channel between a Relay or Endpoint and its Twisted process, for the "process" engine.
+
+    Unless a port is specified, the channel is a socketpair inherited by the Twisted process on POSIX systems
+    (no port is bound, and other local processes cannot connect to it), or a loopback connection on an ephemeral port.
+    """
+    def __init__(self, port=None):
+        """
+        :param port: int: local port to listen to (None to allocate the channel automatically)
+        """
+        self.port = port
+        self.conn = None  # our end of the channel
+        self.child_sock = None  # end of the socketpair adopted by the Twisted process
+        self._listener = None
+        if port is None and hasattr(socket, 'AF_UNIX'):
+            self.conn, self.child_sock = socket.socketpair()
+        else:
+            self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            if port is not None:
+                self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self._listener.bind(('127.0.0.1', port if port is not None else 0))
+            self._listener.listen()
+            self.port = self._listener.getsockname()[1]
+
+    def accept(self):
+        """
+        Waits for the Twisted process to connect; must be called once the process is started.
+
+        :return conn: socket.socket: our end of the channel
+        """
+        if self._listener is not None:
+            self.conn, _ = self._listener.accept()
+            self.conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # objects are sent as soon as possible
+        else:
+            self.child_sock.close()  # the Twisted process holds its own copy
+            # the Twisted process sends a TEST frame once it is ready:
+            if len(self.conn.recv(FRAME_HEADER_SIZE, socket.MSG_WAITALL)) != FRAME_HEADER_SIZE:
+                raise ConnectionError("The Twisted process closed the local channel.")
+        return self.conn
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+        if self._listener is not None:
+            self._listener.close()
+
+
+class ReactorThread:
+    """
+    Runs a Client or a Server in the shared reactor, with the interface of multiprocessing.Process.
+    """
+    def __init__(self, target, local):
+        """
+        :param target: callable: start method of the Client or Server
+        :param local: InProcessConnection: in-memory connection of the Relay or Endpoint
+        """
+        self._target = target
+        self._local = local
+        self._started = threading.Event()
+        self._stopped = threading.Event()
+        self._error = None  # raised by the target, if any
+
+    def start(self):
+        reactor = shared_reactor()
+        reactor.callFromThread(self._run, reactor)
+        wait_event(self._started)
+        if self._error is not None:
+            raise self._error
+
+    def _run(self, reactor):
+        try:
+            self._target(reactor, self._local, self._stopped.set)
+        except Exception as e:
+            self._error = e
+        finally:
+            self._started.set()
+
+    def join(self):
+        wait_event(self._stopped)
+
+
+class InProcessTransport:
+    """
+    Minimal Twisted transport of the local protocol of an InProcessConnection.
+    """
+    def __init__(self, connection):
+        self._connection = connection
+        self.connected = False
+
+    def setTcpNoDelay(self, enabled):
+        pass
+
+    def loseConnection(self):
+        if self.connected:
+            self.connected = False
+            self._connection.frames.put(None)  # stops the receiver thread of the Endpoint
+            self._connection.protocol.connectionLost(failure.Failure(error.ConnectionDone()))
+
+    def abortConnection(self):
+        self.loseConnection()
+
+
+class InProcessConnection:
+    """
+    In-memory local connection between a Relay or Endpoint and its Twisted protocol, for the "thread" engine.
+
+    It replaces the local socket of the Relay or Endpoint:
+    frames sent with sendall or sendmsg are handed to the local protocol in the reactor thread,
+    and the local protocol puts the frames it outputs in the frames queue as they are, without encoding them.
+    Envelopes sent with send_frame are not encoded either (see LocalProtocolForClient.process_frame).
+    """
+    def __init__(self, protocol):
+        """
+        :param protocol: Protocol: local protocol of the Client or Server
+        """
+        self.protocol = protocol
+        self.frames = queue.Queue()
+        self.transport = InProcessTransport(self)
+
+    def connect(self):
+        """
+        Connects the local protocol; must be called in the reactor thread.
+        """
+        self.transport.connected = True
+        self.protocol.makeConnection(self.transport)
+
+    def sendmsg(self, buffers):
+        # the buffers are joined, such that the caller can reuse them as soon as we return (as with a socket)
+        data = b"".join(buffers)
+        shared_reactor().callFromThread(self._receive, data)
+        return len(data)
+
+    def sendall(self, data):
+        self.sendmsg([data])
+
+    def send_frame(self, cmd, routing, parts, flags=0):
+        """
+        Hands a frame to the local protocol as it is, without encoding it.
+
+        :param cmd: str: command of the frame
+        :param routing: dict: routing header of envelopes (None for other frames)
+        :param parts: list of bytes-like: parts of the body; bytes parts are immutable and are not copied,
+            other parts are copied, such that the caller can reuse them as soon as we return (as with a socket)
+        :param flags: int: payload flags
+        """
+        if len(parts) == 1 and isinstance(parts[0], bytes):
+            body = parts[0]
+        else:
+            body = b"".join(parts)
+        shared_reactor().callFromThread(self._receive_frame, Frame(cmd, 0, flags, body, routing))
+
+    def _receive(self, data):
+        if self.transport.connected:
+            self.protocol.dataReceived(data)
+
+    def _receive_frame(self, frame):
+        if self.transport.connected:
+            self.protocol.frameReceived(frame)
+
+    def close(self):
+        pass
@@ -0,0 +1,417 @@
+import io
+import hmac
+import json
+import pickle
+import struct
+from collections import namedtuple
+
+
+# Version of the binary protocol, advertised by the Relay in its HELLO.
+# Peers that do not advertise (or do not speak) this version fall back to legacy ASCII frames.
+PROTOCOL_VERSION = 13
+
+# Max body size of the frames received from a client before it is authenticated
+HANDSHAKE_MAX_SIZE = 65536
+
+# Binary frame header: body length, flags, message type, stamp.
+# The most significant byte of the body length is always 0, whereas legacy ASCII headers start with a digit.
+FRAME_HEADER = struct.Struct('!QBBQ')
+FRAME_HEADER_SIZE = FRAME_HEADER.size
+
+MESSAGE_TYPES = {
+    'HELLO': 1,
+    'ACK': 2,
+    'OBJ': 3,
+    'NTF': 4,
+    'STOP': 5,
+    'TEST': 6,
+    'CFG': 7,
+    'CHK': 8,
+    'BAT': 9,
+    'RST': 10,
+    'JOIN': 11,
+    'LEAVE': 12,
+    'PAUSE': 13,
+    'RESUME': 14,
+    'STS': 15,  # local: statistics of the Relay, never sent to Endpoints (see tlspyo.api.Relay.stats)
+}
+MESSAGE_COMMANDS = {v: k for k, v in MESSAGE_TYPES.items()}
+
+# Flags describing how payloads are encoded; the Relay forwards them along with the payloads
+FLAG_OOB = 0x01  # pickle protocol 5 with out-of-band buffers (see tlspyo.serialization)
+FLAG_COMPRESSED = 0x02  # compressed payload, starting with the identifier of its codec (see tlspyo.serialization)
+FLAG_DELTA = 0x04  # delta against the previous broadcast of the group (see tlspyo.serialization.encode_delta)
+FLAG_FIRE_AND_FORGET = 0x08  # sent with stamp 0 at each hop: neither acknowledged nor retransmitted (see tlspyo.reliability)
+PAYLOAD_FLAGS = FLAG_OOB | FLAG_COMPRESSED | FLAG_DELTA | FLAG_FIRE_AND_FORGET
+
+# Flag of the local frames exchanged by Endpoints and their Twisted process: the body refers to a shared memory segment
+# that holds the payload (see tlspyo.shm); it is never sent to the Relay
+FLAG_SHM = 0x80
+
+# Frames of these commands are envelopes: their body is a routing header followed by an opaque payload.
+# The routing header is read by the Relay, whereas the payload is forwarded byte-for-byte.
+ENVELOPE_COMMANDS = frozenset(('OBJ', 'NTF', 'CHK'))
+ROUTING_SIZE = struct.Struct('!I')
+
+# Large payloads are streamed as CHK envelopes of at most this size (see split_chunks).
+# Their routing header identifies the transfer ('id') and tells whether the chunk is the 'last' one;
+# the first chunk also carries the 'size' of the full payload (and its 'dest' from Endpoints to the Relay).
+DEFAULT_CHUNK_SIZE = 1048576
+
+# When they are stopped, Relays and Endpoints wait at most this number of seconds for the ACKs of the commands they sent.
+# The body of local STOP frames may override it with a 'timeout', or set 'force' to close without waiting.
+DEFAULT_STOP_TIMEOUT = 10.0
+
+# The body of BAT frames is a sequence of frames of these commands, acknowledged as a whole (see decode_batch)
+BATCH_COMMANDS = frozenset(('OBJ', 'NTF'))
+
+# Commands that open and close the logical sessions multiplexed on a connection (see tlspyo.api.EndpointPool).
+# Their body is a control message identifying the 'session'; envelopes of sessions carry it in their routing header.
+SESSION_COMMANDS = frozenset(('JOIN', 'LEAVE'))
+
+# Local commands of Endpoints whose queue of received objects is full: their Twisted process stops (PAUSE)
+# and starts again (RESUME) reading from the Relay; they are never sent to the Relay
+FLOW_COMMANDS = frozenset(('PAUSE', 'RESUME'))
+
+# Frames larger than this are written part by part to Twisted transports (see write_parts)
+WRITE_JOIN_THRESHOLD = 65536
+
+# Max number of parts sent by a single sendmsg call (see send_parts)
+SENDMSG_MAX_PARTS = 512
+
+# Decoded frame; cmd and stamp are None for legacy frames (they are part of the serialized body).
+# For envelopes, routing is the decoded routing header and body is the payload; otherwise, routing is None.
+Frame = namedtuple('Frame', ('cmd', 'stamp', 'flags', 'body', 'routing'))
+
+
+def encode_header(cmd, data_len, stamp=0, flags=0):
+    """
+    Builds the binary header of a frame.
+
+    :param cmd: str: command of the frame (key of MESSAGE_TYPES)
+    :param data_len: int: length of the frame body in bytes
+    :param stamp: int: stamp of the frame (used for acknowledgements)
+    :param flags: int: 8-bit flags of the frame
+    :return header: bytes: the binary header
+    """
+    return FRAME_HEADER.pack(data_len, flags, MESSAGE_TYPES[cmd], stamp)
+
+
+def encode_frame(cmd, body=b"", stamp=0, flags=0):
+    """
+    Builds a full binary frame.
+
+    :param cmd: str: command of the frame (key of MESSAGE_TYPES)
+    :param body: bytes: body of the frame
+    :param stamp: int: stamp of the frame (used for acknowledgements)
+    :param flags: int: 8-bit flags of the frame
+    :return frame: bytes: the binary frame
+    """
+    return FRAME_HEADER.pack(len(body), flags, MESSAGE_TYPES[cmd], stamp) + body
+
+
+def encode_routing(routing):
+    """
+    Builds the routing header of an envelope (length-prefixed JSON).
+
+    :param routing: dict: routing information (must be JSON-serializable)
+    :return routing_header: bytes: the encoded routing header
+    """
+    routing = encode_control(routing)
+    return ROUTING_SIZE.pack(len(routing)) + routing
+
+
+def encode_envelope(cmd, routing, payload_len=0, stamp=0, flags=0):
+    """
+    Builds the head of an envelope frame, i.e., everything that precedes the payload.
+
+    The payload is not copied: the full frame is the returned head followed by the payload.
+
+    :param cmd: str: command of the frame (in ENVELOPE_COMMANDS)
+    :param routing: dict: routing header (must be JSON-serializable)
+    :param payload_len: int: length of the opaque payload of the frame, in bytes
+    :param stamp: int: stamp of the frame (used for acknowledgements)
+    :param flags: int: 8-bit flags of the frame
+    :return head: bytes: binary header and routing header of the frame
+    """
+    routing = encode_routing(routing)
+    return FRAME_HEADER.pack(len(routing) + payload_len, flags, MESSAGE_TYPES[cmd], stamp) + routing
+
+
+def split_chunks(parts, chunk_size):
+    """
+    Splits the parts of a payload into chunks, without copying them.
+
+    :param parts: list of bytes-like: parts of the payload, in order
+    :param chunk_size: int: size of the chunks in bytes (the last chunk may be smaller)
+    :return chunks: generator of lists of memoryviews: the parts of each chunk
+    """
+    chunk, n = [], 0
+    for part in parts:
+        view = memoryview(part).cast('B')
+        while len(view) > 0:
+            k = min(len(view), chunk_size - n)
+            chunk.append(view[:k])
+            view = view[k:]
+            n += k
+            if n == chunk_size:
+                yield chunk
+                chunk, n = [], 0
+    if n > 0:
+        yield chunk
+
+
+def write_parts(transport, parts):
+    """
+    Writes the parts of a frame to a Twisted transport.
+
+    Small frames are written at once, whereas the parts of large frames are written separately,
+    because some transports (e.g., TLS) copy the parts to join them.
+
+    :param transport: ITransport: transport to write to
+    :param parts: list of bytes: parts of the frame, in order
+    """
+    if sum(len(part) for part in parts) <= WRITE_JOIN_THRESHOLD:
+        transport.writeSequence(parts)
+    else:
+        for part in parts:
+            transport.write(part)
+
+
+def send_parts(sock, parts):
+    """
+    Sends the parts of a frame on a blocking socket.
+
+    Parts are sent with scatter-gather I/O when the platform supports it, such that they are never joined.
+
+    :param sock: socket.socket: blocking socket
+    :param parts: list of bytes-like: parts of the frame, in order
+    """
+    if not hasattr(sock, 'sendmsg'):
+        for part in parts:
+            sock.sendall(part)
+        return
+    views = [memoryview(part).cast('B') for part in parts if len(part) > 0]
+    k = 0
+    while k < len(views):
+        sent = sock.sendmsg(views[k:k + SENDMSG_MAX_PARTS])
+        while k < len(views) and sent >= len(views[k]):
+            sent -= len(views[k])
+            k += 1
+        if sent > 0:
+            views[k] = views[k][sent:]
+
+
+def decode_header(buffer, offset=0):
+    """
+    Parses a binary header.
+
+    Raises ValueError if the header is invalid.
+
+    :param buffer: bytes-like: buffer containing at least FRAME_HEADER_SIZE bytes after offset
+    :param offset: int: position of the header in buffer
+    :return (data_len, flags, cmd, stamp): length of the body, flags, command and stamp of the frame
+    """
+    data_len, flags, msg_type, stamp = FRAME_HEADER.unpack_from(buffer, offset)
+    try:
+        cmd = MESSAGE_COMMANDS[msg_type]
+    except KeyError:
+        raise ValueError(f"Invalid message type: {msg_type}")
+    return data_len, flags, cmd, stamp
+
+
+def encode_legacy_header(data_len, header_size):
+    """
+    Builds the ASCII header of a legacy frame (space-padded decimal length).
+    """
+    return bytes(f"{data_len:<{header_size}}", 'utf-8')
+
+
+def is_legacy_frame(buffer):
+    """
+    Tells whether a non-empty buffer starts with a legacy ASCII frame rather than a binary frame.
+    """
+    return buffer[0] != 0
+
+
+def encode_control(obj):
+    """
+    Serializes handshake information.
+
+    Control messages and routing headers do not depend on the user serializer,
+    so that the Relay can read them before authentication and never needs to deserialize payloads.
+    """
+    return bytes(json.dumps(obj), 'utf-8')
+
+
+def decode_control(body):
+    """
+    Deserializes handshake information (see encode_control).
+    """
+    return json.loads(bytes(body).decode('utf-8'))
+
+
+def hello_digest(password, nonce):
+    """
+    Answer to the authentication challenge sent by the Relay in its HELLO.
+
+    :param password: str: password of the Relay
+    :param nonce: str: random challenge sent by the Relay
+    :return digest: str: HMAC of the challenge, keyed with the password
+    """
+    return hmac.new(bytes(password, 'utf-8'), bytes(nonce, 'utf-8'), 'sha256').hexdigest()
+
+
+class _ControlUnpickler(pickle.Unpickler):
+    """
+    Unpickler that only rebuilds builtin scalars and containers: it never resolves globals.
+    """
+    def find_class(self, module, name):
+        raise pickle.UnpicklingError(f"Forbidden global in a HELLO: {module}.{name}")
+
+
+def encode_hello(hello, serializer, header_size):
+    """
+    Builds the HELLO of the Relay.
+
+    It is a legacy frame, such that Endpoints of all versions read it, whose object is a JSON string:
+    Endpoints read the protocol version and the authentication challenge without deserializing any object.
+
+    :param hello: dict: control message of the Relay (see encode_control)
+    :param serializer: callable: serializer of the Relay, shared with the Endpoints of older versions
+    :param header_size: int: size of the ASCII header of legacy frames
+    :return frame: bytes: the HELLO frame
+    """
+    msg = serializer((0, 'HELLO', str(encode_control(hello), 'utf-8')))
+    return encode_legacy_header(len(msg), header_size) + msg
+
+
+def decode_hello(body, deserializer):
+    """
+    Reads the body of the HELLO of a Relay (see encode_hello).
+
+    Pickled HELLOs are read without resolving globals, whatever the deserializer;
+    HELLOs encoded by custom serializers, which the Relay shares with its Endpoints, are read by the deserializer.
+
+    :param body: bytes: body of the legacy HELLO frame
+    :param deserializer: callable: deserializer of the Endpoint
+    :return stamp, cmd, obj: obj is the control message of the Relay (a dict), or None for Relays of older versions
+    """
+    if bytes(body[:1]) == pickle.PROTO:
+        stamp, cmd, obj = _ControlUnpickler(io.BytesIO(body)).load()
+    else:
+        stamp, cmd, obj = deserializer(body)
+    if isinstance(obj, str):
+        obj = decode_control(bytes(obj, 'utf-8'))
+    return stamp, cmd, obj
+
+
+def decode_batch(body):
+    """
+    Decodes the frames contained in the body of a BAT frame.
+
+    Raises ValueError if the batch is invalid.
+
+    :param body: bytes-like: body of the BAT frame
+    :return frames: list of Frame: the batched frames, in order
+    """
+    decoder = FrameDecoder()
+    decoder.feed(body)
+    frames = []
+    frame = decoder.next_frame()
+    while frame is not None:
+        frames.append(frame)
+        frame = decoder.next_frame()
+    if len(decoder) > 0:
+        raise ValueError("Truncated batch")
+    return frames
+
+
+class FrameDecoder:
+    """
+    Incremental decoder of the frames received on a stream.
+
+    Received bytes are appended to a bytearray and frames are consumed by moving an offset,
+    such that no byte is copied more than once while a frame is incomplete.
+    The bodies of complete frames are copied once, when they are returned.
+    """
+    def __init__(self, legacy=False, header_size=None, password=None, max_data_len=None, writable_flags=0):
+        """
+        :param legacy: bool or None: whether frames are legacy ASCII frames (None: detect from the first frame)
+        :param header_size: int: size of the ASCII header of legacy frames
+        :param password: bytes: password expected after the header of legacy frames (None if they carry no password)
+        :param max_data_len: int: max body size of frames (None for unlimited); can be changed between frames
+        :param writable_flags: int: the bodies of frames with any of these flags are returned as bytearrays
+        """
+        self.legacy = legacy
+        self._writable_flags = writable_flags
+        self.max_data_len = max_data_len
+        self._header_size = header_size
+        self._password = password
+        self._password_size = len(password) if password is not None else 0
+        self._buffer = bytearray()
+        self._offset = 0
+        self._pending = None  # parsed header of the next frame, until its body is complete
+
+    def __len__(self):
+        return len(self._buffer) - self._offset
+
+    def feed(self, data):
+        """
+        Appends received bytes to the buffer.
+
+        :param data: bytes-like: received bytes
+        """
+        if self._offset > 0:
+            # drop consumed frames; what remains is at most one partial frame
+            del self._buffer[:self._offset]
+            self._offset = 0
+        self._buffer += data
+
+    def next_frame(self):
+        """
+        Consumes the next complete frame.
+
+        Raises ValueError if the frame is invalid.
+
+        :return frame: Frame: the next frame, or None if no complete frame is available
+        """
+        if self._pending is None:
+            available = len(self._buffer) - self._offset
+            if self.legacy is None:
+                if available == 0:
+                    return None
+                self.legacy = is_legacy_frame(self._buffer[self._offset:self._offset + 1])
+            header_size = self._header_size if self.legacy else FRAME_HEADER_SIZE
+            i = header_size + self._password_size if self.legacy else header_size
+            if available < i:
+                return None
+            if self.legacy:
+                data_len = int(self._buffer[self._offset:self._offset + header_size])
+                flags, cmd, stamp = 0, None, None
+            else:
+                data_len, flags, cmd, stamp = decode_header(self._buffer, self._offset)
+            if self.legacy and self._password is not None and self._buffer[self._offset + header_size:self._offset + i] != self._password:
+                raise ValueError("Invalid password")
+            if self.max_data_len is not None and data_len > self.max_data_len:
+                raise ValueError(f"Frame too large ({data_len} bytes)")
+            self._pending = (i, i + data_len, cmd, stamp, flags)
+        i, j, cmd, stamp, flags = self._pending  # relative to the start of the frame
+        i, j = self._offset + i, self._offset + j
+        if len(self._buffer) < j:
+            return None
+        routing = None
+        with memoryview(self._buffer) as view:
+            if cmd in ENVELOPE_COMMANDS:
+                k = i + ROUTING_SIZE.size
+                if k > j:
+                    raise ValueError("Truncated routing header")
+                k += ROUTING_SIZE.unpack_from(view, i)[0]
+                if k > j:
+                    raise ValueError("Invalid routing header")
+                routing = decode_control(view[i + ROUTING_SIZE.size:k])
+                i = k
+            body = bytearray(view[i:j]) if flags & self._writable_flags else bytes(view[i:j])
+        self._offset = j
+        self._pending = None
+        return Frame(cmd, stamp, flags, body, routing)
@@ -1,5 +1,8 @@
 from twisted.internet.protocol import Protocol, ClientFactory
 
+from tlspyo.framing import PAYLOAD_FLAGS, FLAG_SHM, ENVELOPE_COMMANDS, SESSION_COMMANDS, FLOW_COMMANDS, Frame, FrameDecoder, encode_frame, \
+    encode_envelope, encode_control, decode_control, write_parts
+from tlspyo.shm import write_shared, read_shared
 from tlspyo.logs import logger
 
 
@@ -8,58 +11,142 @@ class LocalProtocolForClient(Protocol):
     def __init__(self, client):
         self._client = client
         self._state = "INIT"
-        self._buffer = b""
-        self._header_size = self._client.header_size
+        self._decoder = FrameDecoder()
         self._identifier = None
+        self._lost_callbacks = []  # called once the connection is lost (see when_lost)
 
     def connectionMade(self):
         self._client.endpoint = self
         self._state = "ALIVE"
+        if self._client.local_com_sock is None:
+            self.transport.setTcpNoDelay(True)  # socketpairs do not delay small writes
+        else:
+            self.transport.write(encode_frame('TEST'))  # tells the Endpoint that we are ready
+        if self._client.config is not None:
+            self.send_config(self._client.config)
 
     def connectionLost(self, reason):
         self._client.endpoint = None
         self._state = "DEAD"
+        callbacks, self._lost_callbacks = self._lost_callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def when_lost(self, callback):
+        """
+        Closes the connection once the frames written to the Endpoint are flushed, then calls a function.
+
+        The Endpoint destroys the shared memory segments of the frames it reads (see send_obj):
+        the Twisted process must not stop before they are flushed.
+
+        :param callback: callable: called without arguments once the connection is lost
+        """
+        self._lost_callbacks.append(callback)
+        self.transport.loseConnection()
 
     def dataReceived(self, data):
         try:
-            self._buffer += data
-            i = self._header_size
-            if len(self._buffer) >= i:
-                i, j = self.process_header()
-                while len(self._buffer) >= j:
-                    cmd, dest, obj_bytes = self._client.deserializer(self._buffer[i:j])
-                    if cmd == "STOP":
-                        self.transport.loseConnection()
-                        self._client.close(1)
-                    elif cmd in ("OBJ", "NTF"):
-                        # send the object to the central relay
-                        if self._client.to_server is not None and self._state == "ALIVE" and self._client.to_server.get_state() == "ALIVE":
-                            self._client.to_server.send_obj(cmd=cmd, dest=dest, obj=obj_bytes)
-                        else:
-                            logger.warning('The client is not connected to the Internet server, storing message.')
-                            self._client.store.append((cmd, dest, obj_bytes))
-                    elif cmd == 'TEST':
-                        pass
-                    else:
-                        logger.warning(f"Local: Invalid command: {cmd}")
-                        self._state = "CLOSED"
-                        self.transport.abortConnection()
-                    # truncate the processed part of the buffer:
-                    self._buffer = self._buffer[j:]
-                    i, j = self.process_header()
+            self._decoder.feed(data)
+            frame = self._decoder.next_frame()
+            while frame is not None:
+                self.process_frame(frame)
+                frame = self._decoder.next_frame()
+        except Exception as e:
+            self.fail(e)
+
+    def frameReceived(self, frame):
+        """
+        Processes a frame of an Endpoint that uses the "thread" engine, which is not encoded (see InProcessConnection).
+        """
+        try:
+            self.process_frame(frame)
         except Exception as e:
-            logger.warning(f"Local: Unhandled exception: {e}")
-            self._state = "KILLED"
+            self.fail(e)
+
+    def fail(self, e):
+        logger.warning(f"Local: Unhandled exception: {e}")
+        self._state = "KILLED"
+        self.transport.abortConnection()
+        raise e
+
+    def process_frame(self, frame):
+        cmd = frame.cmd
+        if cmd == "STOP":
+            # the Endpoint does not read objects anymore; we keep reading until the client is terminated (see when_lost),
+            # a later STOP may force the client to stop without waiting for pending ACKs
+            self._state = "CLOSED"
+            options = decode_control(frame.body) if len(frame.body) > 0 else {}
+            self._client.close(**options)
+        elif cmd in ENVELOPE_COMMANDS or cmd == "BAT":
+            # the routing header (or batch) of the Endpoint is forwarded as is
+            routing = frame.routing
+            obj_bytes = frame.body if cmd != "NTF" else None
+            if frame.flags & FLAG_SHM:
+                obj_bytes = read_shared(obj_bytes)
+            flags = frame.flags & PAYLOAD_FLAGS
+            # send the object to the central relay
+            if self._client.to_server is not None and self._state == "ALIVE" and self._client.to_server.get_state() == "ALIVE":
+                self._client.to_server.send_obj(cmd=cmd, routing=routing, obj=obj_bytes, flags=flags)
+            else:
+                logger.warning('The client is not connected to the Internet server, storing message.')
+                self._client.store.append((cmd, routing, obj_bytes, flags))
+        elif cmd in SESSION_COMMANDS:
+            self._client.update_session(cmd, decode_control(frame.body))
+        elif cmd in FLOW_COMMANDS:
+            self._client.pause_reception(cmd == 'PAUSE')
+        elif cmd == 'TEST':
+            pass
+        else:
+            logger.warning(f"Local: Invalid command: {cmd}")
+            self._state = "CLOSED"
             self.transport.abortConnection()
-            raise e
-
-    def process_header(self):
-        i = self._header_size
-        if len(self._buffer) < i:
-            return 0, len(self._buffer) + 1
-        data_len = int(self._buffer[:self._header_size])
-        j = i + data_len
-        return i, j
+
+    def send_obj(self, obj_bytes, flags=0, cmd='OBJ', routing=None):
+        """
+        Transfers a received payload (or chunk of payload) to the Endpoint.
+
+        Large payloads are passed in shared memory.
+        """
+        if self._state != "ALIVE":
+            return  # the Endpoint is stopped
+        routing = routing if routing is not None else {}
+        threshold = self._client.shm_threshold
+        if threshold is not None and len(obj_bytes) >= threshold:
+            obj_bytes, flags = write_shared([obj_bytes], len(obj_bytes)), flags | FLAG_SHM
+        write_parts(self.transport, [encode_envelope(cmd, routing, len(obj_bytes), flags=flags), obj_bytes])
+
+    def send_config(self, config):
+        """
+        Transfers the settings advertised by the Relay to the Endpoint.
+        """
+        self.transport.write(encode_frame('CFG', encode_control(config)))
+
+    def send_reset(self, body):
+        """
+        Transfers a request of the Relay for the full payload of a delta broadcast to the Endpoint.
+        """
+        self.transport.write(encode_frame('RST', body))
+
+
+class InProcessProtocolForClient(LocalProtocolForClient):
+    """
+    Local protocol of Endpoints that use the "thread" engine (see tlspyo.engine).
+
+    Frames are put in the queue of the Endpoint as they are, instead of being encoded.
+    """
+
+    def __init__(self, client, frames):
+        super().__init__(client)
+        self._frames = frames
+
+    def send_obj(self, obj_bytes, flags=0, cmd='OBJ', routing=None):
+        self._frames.put(Frame(cmd, 0, flags, obj_bytes, routing if routing is not None else {}))
+
+    def send_config(self, config):
+        self._frames.put(Frame('CFG', 0, 0, encode_control(config), None))
+
+    def send_reset(self, body):
+        self._frames.put(Frame('RST', 0, 0, body, None))
 
 
 class LocalProtocolForClientFactory(ClientFactory):
@@ -1,5 +1,6 @@
 from twisted.internet.protocol import Protocol, ClientFactory
 
+from tlspyo.framing import Frame, FrameDecoder, encode_frame, encode_control, decode_control
 from tlspyo.logs import logger
 
 
@@ -8,13 +9,14 @@ class LocalProtocolForServer(Protocol):
     def __init__(self, server):
         self._server = server
         self._state = "INIT"
-        self._buffer = b""
-        self._header_size = self._server.header_size
+        self._decoder = FrameDecoder()
         self._identifier = None
 
     def connectionMade(self):
         assert self._state == "INIT", f"Bad state: {self._state}"
         self._state = "ALIVE"
+        if self._server.local_com_sock is not None:
+            self.transport.write(encode_frame('TEST'))  # tells the Relay that we are ready
 
     def connectionLost(self, reason):
         if self._server.has_client(self._identifier):
@@ -25,37 +27,49 @@ class LocalProtocolForServer(Protocol):
 
     def dataReceived(self, data):
         try:
-            self._buffer += data
-            i = self._header_size
-            if len(self._buffer) >= i:
-                i, j = self.process_header()
-                while len(self._buffer) >= j:
-                    cmd, _ = self._server.deserializer(self._buffer[i:j])
-                    if cmd == "STOP":
-                        self.transport.loseConnection()
-                        self._server.close(1)
-                    elif cmd == 'TEST':
-                        pass
-                    else:
-                        logger.warning(f"Local: Invalid command: {cmd}")
-                        self._state = "CLOSED"
-                        self.transport.abortConnection()
-                    # truncate the processed part of the buffer:
-                    self._buffer = self._buffer[j:]
-                    i, j = self.process_header()
+            self._decoder.feed(data)
+            frame = self._decoder.next_frame()
+            while frame is not None:
+                cmd = frame.cmd
+                if cmd == "STOP":
+                    # we keep reading, a later STOP may force the Relay to stop without waiting for pending ACKs
+                    options = decode_control(frame.body) if len(frame.body) > 0 else {}
+                    self._server.close(**options)
+                elif cmd == 'STS':
+                    self.send_stats(self._server.stats())
+                elif cmd == 'TEST':
+                    pass
+                else:
+                    logger.warning(f"Local: Invalid command: {cmd}")
+                    self._state = "CLOSED"
+                    self.transport.abortConnection()
+                frame = self._decoder.next_frame()
         except Exception as e:
             logger.warning(f"Local: Unhandled exception: {e}")
             self._state = "KILLED"
             self.transport.abortConnection()
             raise e
 
-    def process_header(self):
-        i = self._header_size
-        if len(self._buffer) < i:
-            return 0, len(self._buffer) + 1
-        data_len = int(self._buffer[:self._header_size])
-        j = i + data_len
-        return i, j
+    def send_stats(self, stats):
+        """
+        Replies to a request of the Relay for its statistics.
+        """
+        self.transport.write(encode_frame('STS', encode_control(stats)))
+
+
+class InProcessProtocolForServer(LocalProtocolForServer):
+    """
+    Local protocol of Relays that use the "thread" engine (see tlspyo.engine).
+
+    Frames are put in the queue of the Relay as they are, instead of being encoded.
+    """
+
+    def __init__(self, server, frames):
+        super().__init__(server)
+        self._frames = frames
+
+    def send_stats(self, stats):
+        self._frames.put(Frame('STS', 0, 0, encode_control(stats), None))
 
 
 class LocalProtocolForServerFactory(ClientFactory):
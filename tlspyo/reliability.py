@@ -0,0 +1,159 @@
+import time
+from collections import OrderedDict, deque
+
+
+# Maximum number of frames sent to a peer and not acknowledged yet (frames in flight)
+DEFAULT_ACK_WINDOW = 128
+
+# Frames received from a peer are acknowledged by a single cumulative ACK, once this number of frames has been received
+# or this number of seconds after the first of them (peers of older versions acknowledge each frame immediately)
+DEFAULT_ACK_EVERY = 16
+DEFAULT_ACK_DELAY = 0.01
+
+# Number of seconds during which the Relay keeps the frames in flight toward a disconnected Endpoint,
+# to retransmit them if the Endpoint reconnects
+DEFAULT_RECONNECTION_TIMEOUT = 60.0
+
+# Maximum size in bytes of the commands waiting for the window of a peer to open
+DEFAULT_MAX_BACKLOG = 268435456
+
+
+class Link:
+    """
+    At-least-once delivery of the frames sent to a peer (the Relay for a client, a client for the Relay).
+
+    Frames are numbered with consecutive stamps, and kept until the peer acknowledges them.
+    ACKs are cumulative: the ACK of a stamp acknowledges all the frames up to this stamp.
+    A link outlives the connections to its peer: when the peer reconnects, the frames in flight are retransmitted,
+    and the peer discards the frames whose stamp it has already received.
+    Frames are only sent while the window is open; other commands wait in the backlog, in order.
+    A command can supersede an older command of the backlog (e.g., the broadcast of a group supersedes
+    the previous broadcast to this group), which is then never sent.
+
+    Frames with stamp 0 belong to a connection (e.g., HELLO): they are neither acknowledged nor retransmitted.
+    """
+    def __init__(self, window=DEFAULT_ACK_WINDOW, stamp=0, max_backlog=None):
+        """
+        :param window: int: maximum number of frames in flight (None for unlimited)
+        :param stamp: int: stamp of the last frame sent to the peer (stamps of new frames follow it)
+        :param max_backlog: int: maximum size of the backlog in bytes (None for unlimited)
+        """
+        self.window = window
+        self.stamp = stamp
+        self.received = 0  # stamp of the last frame received from the peer
+        self.unacknowledged = 0  # number of frames received from the peer since our last ACK
+        self.pending = OrderedDict()  # frames in flight, by stamp: (time sent, parts of the frame)
+        self.pending_bytes = 0  # size of the frames in flight
+        self.backlog = deque()  # commands waiting for the window to open: (key, size, command)
+        self.backlog_bytes = 0  # size of the commands of the backlog
+        self.max_backlog = max_backlog
+        self._keyed = {}  # entries of the backlog that a newer command can supersede, by key
+        self.owner = None  # protocol of the current connection to the peer, if any
+        self.expiry = None  # delayed call that releases the link of a disconnected peer, if any
+
+    def is_open(self):
+        """
+        :return open: bool: whether a frame can be sent without exceeding the window
+        """
+        return self.window is None or len(self.pending) < self.window
+
+    def is_idle(self):
+        """
+        :return idle: bool: whether all commands have been sent and acknowledged
+        """
+        return len(self.pending) == 0 and len(self.backlog) == 0
+
+    def queue(self, command, size=0, key=None, first=False):
+        """
+        Appends a command to the backlog.
+
+        :param command: object: the command
+        :param size: int: size of the command in bytes
+        :param key: hashable: if not None, the command supersedes the command of the backlog with the same key
+            (the older command is dropped, the new one is appended)
+        :param first: bool: whether the command is put back at the start of the backlog (e.g., it could not be sent)
+        :return fits: bool: whether the backlog still fits in max_backlog
+        """
+        if key is not None:
+            old = self._keyed.pop(key, None)
+            if old is not None:
+                self.backlog.remove(old)
+                self.backlog_bytes -= old[1]
+        entry = (key, size, command)
+        if key is not None:
+            self._keyed[key] = entry
+        if first:
+            self.backlog.appendleft(entry)
+        else:
+            self.backlog.append(entry)
+        self.backlog_bytes += size
+        return self.max_backlog is None or self.backlog_bytes <= self.max_backlog
+
+    def next_command(self):
+        """
+        Removes the first command of the backlog.
+
+        :return command: object: the command
+        """
+        entry = self.backlog.popleft()
+        key, size, command = entry
+        self.backlog_bytes -= size
+        if key is not None and self._keyed.get(key) is entry:
+            del self._keyed[key]
+        return command
+
+    def send(self, build):
+        """
+        Stamps a new frame and keeps it until it is acknowledged.
+
+        :param build: callable: builds the parts of the frame from its stamp
+        :return parts: list of bytes: parts of the frame, to be written in order
+        """
+        self.stamp += 1
+        parts = build(self.stamp)
+        self.pending[self.stamp] = (time.monotonic(), parts)
+        self.pending_bytes += sum(len(part) for part in parts)
+        return parts
+
+    def acknowledge(self, stamp):
+        """
+        Releases all the frames up to a stamp, that the peer acknowledges (or reports as received).
+
+        Frames in flight are ordered by stamp, such that they are released from the oldest one.
+
+        :param stamp: int: last stamp received by the peer
+        :return sent: float: time at which the last released frame was sent (None if no frame was released)
+        """
+        sent = None
+        while len(self.pending) > 0 and next(iter(self.pending)) <= stamp:
+            _, (sent, parts) = self.pending.popitem(last=False)
+            self.pending_bytes -= sum(len(part) for part in parts)
+        return sent
+
+    def release(self):
+        """
+        Drops the frames in flight and the backlog, when the peer will not reconnect.
+
+        :return released: int: size of the dropped frames in flight
+        """
+        released = self.pending_bytes
+        self.pending.clear()
+        self.backlog.clear()
+        self._keyed.clear()
+        self.pending_bytes = 0
+        self.backlog_bytes = 0
+        return released
+
+    def receive(self, stamp):
+        """
+        Records the stamp of a frame received from the peer.
+
+        Peers send frames in order of their stamps, so a frame whose stamp is not above the last one is a retransmission.
+
+        :param stamp: int: stamp of the frame
+        :return duplicate: bool: whether the frame has already been received (and must be discarded)
+        """
+        if stamp <= self.received:
+            return True
+        self.received = stamp
+        return False
@@ -0,0 +1,293 @@
+import io
+import hashlib
+import pickle as pkl
+import pickletools
+import struct
+import zlib
+from collections import deque
+
+
+# Pickle protocol 5 (python >= 3.8) can keep large contiguous buffers out of the pickle stream
+OOB_AVAILABLE = pkl.HIGHEST_PROTOCOL >= 5
+
+# Contiguous buffers smaller than this are pickled in-band
+OOB_MIN_SIZE = 65536
+
+# Out-of-band payload: number of buffers, size of each buffer, pickle stream, buffers
+OOB_COUNT = struct.Struct('!I')
+OOB_SIZE = struct.Struct('!Q')
+
+# Size of the buffers that pickle writes in-band (see inband_oob)
+IN_BAND_SIZE = struct.Struct('<Q')
+
+
+def dumps_oob(obj):
+    """
+    Pickles an object with protocol 5, keeping large contiguous buffers (e.g., numpy arrays) out-of-band.
+
+    The out-of-band buffers are not copied.
+
+    :param obj: object: picklable object
+    :return (parts, oob): list of bytes-like objects that form the payload when concatenated,
+        and whether the payload has out-of-band buffers (otherwise, parts contains a regular pickle)
+    """
+    buffers = []
+
+    def buffer_callback(buffer):
+        try:
+            raw = buffer.raw()
+        except BufferError:  # non-contiguous buffer
+            return True
+        if raw.nbytes < OOB_MIN_SIZE:
+            return True
+        buffers.append(raw)
+        return False
+
+    stream = pkl.dumps(obj, protocol=5, buffer_callback=buffer_callback)
+    if len(buffers) == 0:
+        return [stream], False
+    head = OOB_COUNT.pack(len(buffers)) + b"".join(OOB_SIZE.pack(raw.nbytes) for raw in buffers)
+    return [head, stream] + buffers, True
+
+
+def loads_oob(payload):
+    """
+    Unpickles a payload built by dumps_oob.
+
+    Out-of-band buffers are rebuilt in place, as views of the payload: they are writable if the payload is a bytearray.
+
+    :param payload: bytes-like: concatenation of the parts returned by dumps_oob
+    :return obj: object: the unpickled object
+    """
+    stream, buffers = _split_oob(payload)
+    return pkl.loads(stream, buffers=buffers)
+
+
+def inband_oob(payload):
+    """
+    Converts a payload built by dumps_oob into a regular pickle, for peers that cannot receive out-of-band buffers.
+
+    The payload is not unpickled: the references to out-of-band buffers (NEXT_BUFFER opcodes) are replaced with the
+    buffers, as pickle writes in-band buffers (BINBYTES8 for read-only buffers, BYTEARRAY8 otherwise).
+    Frames are removed from the pickle stream, since the buffers would exceed their length.
+
+    :param payload: bytes-like: concatenation of the parts returned by dumps_oob
+    :return parts: list of bytes-like objects that form the pickle when concatenated (buffers are not copied)
+    """
+    stream, buffers = _split_oob(payload)
+    ops = list(pickletools.genops(io.BytesIO(stream)))
+    parts = []
+    i = 0
+    for k, (opcode, _, pos) in enumerate(ops):
+        if opcode.code == pkl.FRAME.decode('latin-1'):
+            parts.append(stream[i:pos])
+            i = ops[k + 1][2]
+        elif opcode.code == pkl.NEXT_BUFFER.decode('latin-1'):
+            buffer = buffers.pop(0)
+            readonly = k + 1 < len(ops) and ops[k + 1][0].code == pkl.READONLY_BUFFER.decode('latin-1')
+            parts += [stream[i:pos], (pkl.BINBYTES8 if readonly else pkl.BYTEARRAY8) + IN_BAND_SIZE.pack(len(buffer)), buffer]
+            i = pos + 1
+    parts.append(stream[i:])
+    return parts
+
+
+def _split_oob(payload):
+    """
+    Splits a payload built by dumps_oob.
+
+    :param payload: bytes-like: concatenation of the parts returned by dumps_oob
+    :return (stream, buffers): the pickle stream and the out-of-band buffers, as views of the payload
+    """
+    view = memoryview(payload)
+    count = OOB_COUNT.unpack_from(view)[0]
+    sizes = [OOB_SIZE.unpack_from(view, OOB_COUNT.size + k * OOB_SIZE.size)[0] for k in range(count)]
+    i = OOB_COUNT.size + count * OOB_SIZE.size
+    j = len(view) - sum(sizes)
+    buffers = []
+    k = j
+    for size in sizes:
+        buffers.append(view[k:k + size])
+        k += size
+    return view[i:j], buffers
+
+
+# Payloads smaller than this are not compressed, unless the Relay specifies another threshold
+DEFAULT_COMPRESSION_THRESHOLD = 1024
+
+# Compressed payload: codec identifier, compressed payload
+COMPRESSION_HEADER = struct.Struct('!B')
+
+COMPRESSION_CODECS = {}  # codec name -> (codec identifier, compress, decompress)
+COMPRESSION_NAMES = {}  # codec identifier -> codec name
+
+
+def register_codec(name, codec_id, compress, decompress):
+    """
+    Makes a compression codec available to Endpoints.
+
+    A codec must be registered with the same name and identifier by all the Endpoints that use it.
+
+    :param name: str: name of the codec, as used in the compression settings of the Relay
+    :param codec_id: int: identifier of the codec (1 to 255; values below 16 are reserved for tlspyo)
+    :param compress: callable: outputs a compressed bytestring from a bytes-like object
+    :param decompress: callable: outputs a bytestring from a bytes-like object output by compress
+    """
+    assert 0 < codec_id < 256, f"Invalid codec identifier: {codec_id}"
+    COMPRESSION_CODECS[name] = (codec_id, compress, decompress)
+    COMPRESSION_NAMES[codec_id] = name
+
+
+register_codec('zlib', 1, zlib.compress, zlib.decompress)
+
+try:
+    import lz4.frame
+except ImportError:
+    pass
+else:
+    register_codec('lz4', 2, lz4.frame.compress, lz4.frame.decompress)
+
+try:
+    import zstandard
+except ImportError:
+    pass
+else:
+    register_codec('zstd', 3,
+                   lambda data: zstandard.ZstdCompressor().compress(data),
+                   lambda data: zstandard.ZstdDecompressor().decompress(data))
+
+
+def compress_payload(parts, codec):
+    """
+    Compresses a payload.
+
+    :param parts: list of bytes-like: parts of the payload
+    :param codec: str: name of a registered codec
+    :return parts: list of bytes: parts of the compressed payload, or None if compression does not reduce its size
+    """
+    codec_id, compress, _ = COMPRESSION_CODECS[codec]
+    data = parts[0] if len(parts) == 1 else b"".join(parts)
+    compressed = compress(data)
+    if COMPRESSION_HEADER.size + len(compressed) >= len(data):
+        return None
+    return [COMPRESSION_HEADER.pack(codec_id), compressed]
+
+
+def decompress_payload(payload):
+    """
+    Decompresses a payload built by compress_payload.
+
+    Raises ValueError if the codec of the payload is not registered.
+
+    :param payload: bytes-like: compressed payload
+    :return payload: bytes: decompressed payload
+    """
+    codec_id = COMPRESSION_HEADER.unpack_from(payload)[0]
+    try:
+        _, _, decompress = COMPRESSION_CODECS[COMPRESSION_NAMES[codec_id]]
+    except KeyError:
+        raise ValueError(f"Unknown compression codec: {codec_id}")
+    return decompress(memoryview(payload)[COMPRESSION_HEADER.size:])
+
+
+# Delta payload: size of the new payload, compressed XOR of the base and new payloads
+DELTA_HEADER = struct.Struct('!Q')
+
+
+def payload_hash(payload):
+    """
+    Identifies a version of a broadcast payload.
+
+    :param payload: bytes-like or list of bytes-like: payload, or parts of the payload
+    :return hash: str: hexadecimal digest of the payload
+    """
+    if not isinstance(payload, list):
+        return hashlib.blake2b(payload, digest_size=16).hexdigest()
+    digest = hashlib.blake2b(digest_size=16)
+    for part in payload:
+        digest.update(part)
+    return digest.hexdigest()
+
+
+# Deltas are computed block by block, such that other threads are never blocked for long (the XOR of large
+# integers holds the GIL) and no intermediate copy of the whole payload is made
+DELTA_BLOCK_SIZE = 1048576
+
+
+def _xor(a, b):
+    return (int.from_bytes(a, 'little') ^ int.from_bytes(b, 'little')).to_bytes(len(a), 'little')
+
+
+def encode_delta(base, payload):
+    """
+    Encodes a payload as a binary delta against a base payload.
+
+    Unchanged bytes are zeros in the XOR of both payloads, which compresses well when the payloads are similar
+    and share the same layout (e.g., new values of arrays of the same shapes).
+
+    :param base: bytes-like: base payload
+    :param payload: bytes-like: new payload
+    :return delta: bytes: the delta
+    """
+    base, payload = memoryview(base).cast('B'), memoryview(payload).cast('B')
+    m = min(len(base), len(payload))
+    compressor = zlib.compressobj(1)
+    res = [DELTA_HEADER.pack(len(payload))]
+    for i in range(0, m, DELTA_BLOCK_SIZE):
+        j = min(i + DELTA_BLOCK_SIZE, m)
+        res.append(compressor.compress(_xor(base[i:j], payload[i:j])))
+    res.append(compressor.compress(payload[m:]))
+    res.append(compressor.flush())
+    return b"".join(res)
+
+
+def _take(views, n):
+    """
+    Removes the first n bytes from a deque of memoryviews (fewer if they hold less), copying them only if needed.
+    """
+    res = []
+    while n > 0 and len(views) > 0:
+        view = views[0]
+        if len(view) <= n:
+            res.append(views.popleft())
+            n -= len(view)
+        else:
+            res.append(view[:n])
+            views[0] = view[n:]
+            n = 0
+    return res[0] if len(res) == 1 else b"".join(res)
+
+
+def iter_delta(base, delta, block_size=DELTA_BLOCK_SIZE):
+    """
+    Rebuilds a payload from its base payload and a delta built by encode_delta, block by block.
+
+    :param base: bytes-like or list of bytes-like: base payload, or its chunks
+    :param delta: bytes-like: delta
+    :param block_size: int: size of the blocks (the last block may be smaller)
+    :return blocks: generator of bytes: consecutive blocks of the new payload
+    """
+    size = DELTA_HEADER.unpack_from(delta)[0]
+    views = deque(memoryview(part).cast('B') for part in (base if isinstance(base, list) else [base]))
+    decompressor = zlib.decompressobj()
+    data = memoryview(delta)[DELTA_HEADER.size:]
+    offset = 0
+    while offset < size:
+        diff = decompressor.decompress(data, block_size)
+        data = decompressor.unconsumed_tail
+        if len(diff) == 0:
+            raise ValueError("Truncated delta")
+        base_block = _take(views, len(diff))
+        m = len(base_block)
+        yield _xor(base_block, diff[:m]) + diff[m:] if m > 0 else diff
+        offset += len(diff)
+
+
+def apply_delta(base, delta):
+    """
+    Rebuilds a payload from its base payload and a delta built by encode_delta.
+
+    :param base: bytes-like: base payload
+    :param delta: bytes-like: delta
+    :return payload: bytes: the new payload
+    """
+    return b"".join(iter_delta(base, delta))
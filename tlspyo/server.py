@@ -1,132 +1,486 @@
 import os
-import time
+import hmac
 from collections import deque
 
 import OpenSSL
 from twisted.internet.protocol import Protocol, Factory
-from twisted.internet import ssl
+from twisted.internet import ssl, defer, threads
 
 from tlspyo.local_protocol_for_server import LocalProtocolForServerFactory
+from tlspyo.framing import PROTOCOL_VERSION, HANDSHAKE_MAX_SIZE, PAYLOAD_FLAGS, BATCH_COMMANDS, SESSION_COMMANDS, ROUTING_SIZE, \
+    DEFAULT_STOP_TIMEOUT, FrameDecoder, encode_frame, FLAG_DELTA, FLAG_FIRE_AND_FORGET, encode_header, encode_routing, encode_legacy_header, encode_control, decode_control, decode_batch, hello_digest, \
+    encode_hello, write_parts, DEFAULT_CHUNK_SIZE
+from tlspyo.serialization import iter_delta
+from tlspyo.reliability import DEFAULT_ACK_WINDOW, DEFAULT_ACK_EVERY, DEFAULT_ACK_DELAY, DEFAULT_RECONNECTION_TIMEOUT, \
+    DEFAULT_MAX_BACKLOG, Link
 from tlspyo.credentials import get_default_keys_folder
 from tlspyo.logs import logger
 
 
+def _payload_size(payloads):
+    """
+    Total size of (payload, flags) pairs, whose payloads are bytes or lists of chunks.
+    """
+    return sum(sum(len(chunk) for chunk in obj) if isinstance(obj, list) else len(obj) for obj, _ in payloads)
+
+
+def rebuild_payload(base, deltas, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Applies consecutive deltas to a payload.
+
+    This runs in a worker thread of the Relay.
+
+    :param base: bytes or list of bytes: base payload, or its chunks
+    :param deltas: list: deltas to apply in order (bytes, or lists of chunks)
+    :param chunk_size: int: size of the chunks of the new payload
+    :return payload: bytes or list of bytes: the new payload, as a list of chunks if it is larger than chunk_size
+    """
+    payload = base
+    for delta in deltas:
+        if isinstance(delta, list):
+            delta = b"".join(delta)
+        payload = list(iter_delta(payload, delta, chunk_size))
+    if len(payload) <= 1:
+        return b"".join(payload)
+    return payload
+
+
 class ServerProtocol(Protocol):
 
     def __init__(self, server):
         self._server = server
         self._identifier = None
         self._state = "HANDSHAKE"
-        self._buffer = b""
         self._password = self._server.password
-        self._len_password = len(bytes(self._password, encoding='utf8'))
         self._header_size = self._server.header_size
+        self._legacy = None  # whether the client uses legacy ASCII frames (None until its first frame)
+        self._nonce = os.urandom(16).hex()  # authentication challenge
+        self._transfers = {}  # chunked payloads being received from the client, by transfer identifier
+        self._known_broadcasts = {}  # versions of the broadcasts that the client already holds, by group
+        self._sessions = {}  # logical clients multiplexed on this connection, by session (see ServerSession)
+        self._token = None  # identifies the client across reconnections (None for clients of older versions)
+        self._peer_received = 0  # stamp of the last frame that the client received on its previous connections
+        # replaced by the link of the client if it reconnects:
+        self.link = Link(window=self._server.ack_window, max_backlog=self._server.max_backlog)
+        self._ack_call = None  # delayed call that acknowledges the frames received from the client
+        # legacy frames carry the password, binary frames are authenticated once by the HELLO of the client:
+        self._decoder = FrameDecoder(legacy=None,
+                                     header_size=self._header_size,
+                                     password=bytes(self._password, encoding='utf8'),
+                                     max_data_len=HANDSHAKE_MAX_SIZE)
 
     def connectionMade(self):
         assert self._state == "HANDSHAKE", f"Bad state: {self._state}"
-        self.send_obj(cmd="HELLO")
+        # the HELLO advertises our protocol version to the client; it is a legacy frame that Endpoints of all versions
+        # read, and we switch to binary frames if the client answers with one (it belongs to the connection, its stamp is 0):
+        hello = {'version': PROTOCOL_VERSION,
+                 'nonce': self._nonce,
+                 'compression': self._server.compression_settings(),
+                 'qos': self._server.qos_settings()}
+        self.transport.write(encode_hello(hello, self._server.serializer, self._header_size))
 
     def connectionLost(self, reason):
         logger.info(f"Connection lost: {reason.getErrorMessage()}")
+        for session in self._sessions.values():
+            session.release()
+        self._sessions = {}
+        if self._ack_call is not None and self._ack_call.active():
+            self._ack_call.cancel()
+        self._ack_call = None
+        self.release()
+        self.release_link()
+        self._state = "DEAD"
+
+    def release(self):
+        """
+        Aborts the ongoing transfers of the client and removes it from the Relay.
+        """
+        for transfer in self._transfers.values():
+            # recipients discard the chunks they already received
+            self.stream_chunk(transfer, {'id': transfer['id'], 'last': True, 'abort': True}, b"")
+        self._transfers = {}
         if self._server.has_client(self._identifier):
             self._server.delete_client(self._identifier)
         assert not self._server.has_client(self._identifier)
         self._identifier = None
-        self._state = "DEAD"
 
-    def process_header(self):
-        i = self._header_size + self._len_password
-        if len(self._buffer) < i:
-            return 0, len(self._buffer) + 1, None
+    def resume_link(self):
+        """
+        Adopts the link of a reconnecting client.
+
+        Frames that were in flight when its previous connection was lost are retransmitted
+        (the client discards those it has already received), then waiting commands are sent.
+        """
+        if self._token is None:
+            return  # clients of older versions do not reconnect with their link
+        link = self._server.links.get(self._token)
+        if link is None:
+            # our stamps follow the last one received by the client (e.g., from a previous instance of the Relay)
+            self.link.stamp = self._peer_received
+            self._server.links[self._token] = self.link
+        else:
+            if link.expiry is not None and link.expiry.active():
+                link.expiry.cancel()
+            link.expiry = None
+            if link.owner is not None:
+                logger.info(f"Client {link.owner._identifier} reconnected before its connection was closed, closing it.")
+                link.owner.transport.abortConnection()
+            link.acknowledge(self._peer_received)
+            link.unacknowledged = 0  # the client retransmits unacknowledged frames
+            self.link = link
+            for _, parts in link.pending.values():
+                write_parts(self.transport, parts)
+        self.link.owner = self
+        self.send_backlog()
+
+    def release_link(self):
+        """
+        Keeps the link of the client for reconnection_timeout seconds, after which its frames in flight are released.
+
+        Clients that cannot reconnect (e.g., of older versions) release their frames in flight immediately.
+        """
+        if self._token is None:
+            self.link.release()
+            return
+        if self.link.owner is not self:
+            return  # the client has reconnected
+        self.link.owner = None
+        if self._server.is_closing() or self._server.reconnection_timeout is None:
+            self._server.release_link(self._token)
+        else:
+            self.link.expiry = self._server.call_later(self._server.reconnection_timeout,
+                                                       self._server.release_link, self._token)
+
+    def next_frame(self):
         try:
-            data_len = int(self._buffer[:self._header_size])
-        except ValueError:
-            logger.info(f"Invalid request.")
-            self._state = "KILLED"
-            self.transport.abortConnection()
-            return 0, len(self._buffer) + 1, None
-        j = i + data_len
-        psw = self._buffer[self._header_size:i]
-        psw = psw.decode('utf8')
-        if psw != self._password:
-            logger.info(f"Invalid password: {psw}")
+            frame = self._decoder.next_frame()
+        except ValueError as e:
+            logger.info(f"Invalid request: {e}.")
             self._state = "KILLED"
             self.transport.abortConnection()
-        return i, j, psw
+            return None
+        # clients that speak our protocol answer our HELLO with binary frames
+        self._legacy = self._decoder.legacy
+        return frame
+
+    def parse_frame(self, frame):
+        if self._legacy:
+            return self._server.deserializer(frame.body)
+        if frame.cmd == 'ACK':
+            return frame.stamp, frame.cmd, None, None
+        if self._state == "HANDSHAKE" and frame.cmd != "HELLO":
+            raise ValueError(f"Unauthenticated command: {frame.cmd}")
+        if frame.cmd == 'HELLO':
+            hello = decode_control(frame.body)
+            if hello.get('version') != PROTOCOL_VERSION:
+                raise ValueError(f"Unsupported protocol version: {hello.get('version')}")
+            if not hmac.compare_digest(str(hello.get('auth')), hello_digest(self._password, self._nonce)):
+                raise ValueError("Invalid password")
+            groups = hello['groups']
+            self._token = hello.get('token')
+            self._peer_received = hello.get('received') or 0
+            # reconnecting clients report the broadcasts they already hold, we do not send them again
+            self._known_broadcasts = hello.get('broadcasts') or {}
+            return frame.stamp, frame.cmd, None, tuple(groups) if isinstance(groups, list) else groups
+        # the payload of objects is forwarded as is, only the routing header is decoded
+        if frame.cmd == 'CHK':
+            return frame.stamp, frame.cmd, frame.routing, frame.body
+        if frame.cmd == 'BAT':
+            return frame.stamp, frame.cmd, None, decode_batch(frame.body)
+        if frame.cmd in SESSION_COMMANDS:
+            return frame.stamp, frame.cmd, None, decode_control(frame.body)
+        return frame.stamp, frame.cmd, frame.routing['dest'], frame.body
 
     def dataReceived(self, data):
         try:
-            self._buffer += data
-            i = self._header_size + self._len_password
-            if len(self._buffer) >= i:
-                i, j, psw = self.process_header()
-                if self._state == "KILLED":  # invalid password or request
+            self._decoder.feed(data)
+            frame = self.next_frame()
+            while frame is not None:
+                if not self.process_frame(frame):
                     return
-                while len(self._buffer) >= j:
-                    stamp, cmd, dest, obj = self._server.deserializer(self._buffer[i:j])
-                    if cmd == 'ACK':
-                        try:
-                            del self._server.pending_acks[stamp]  # delete pending ACK
-                        except KeyError:
-                            logger.warning(f"Received ACK for stamp {stamp} not present in pending ACKs.")
-                    else:
-                        self.send_ack(stamp)  # send ACK
-                        if isinstance(dest, str):
-                            dest = (dest, )
-                        if cmd == "HELLO":
-                            groups = obj
-                            if isinstance(groups, str):
-                                groups = (groups,)
-                            if self._server.check_new_client(groups=groups):
-                                logger.info(f"New client with groups {groups}.")
-                                self._identifier = self._server.add_client(groups=groups, client=self)
-                                self._state = "ALIVE"
-                                self.retrieve_broadcast()
-                            else:
-                                self._state = "CLOSED"
-                                self.transport.loseConnection()
-                        elif self._state == "ALIVE":
-                            if cmd == "OBJ":
-                                logger.debug(f"Received object from client {self._identifier} for groups {dest}.")
-                                self.forward_obj_to_dest(obj=obj, dest=dest)
-                            elif cmd == "NTF":
-                                logger.debug(f"Received notification from client {self._identifier} for destination {dest}.")
-                                self.retrieve_consumables(groups=dest)
-                            else:
-                                logger.warning(f"Invalid command: {cmd}")
-                                self._state = "CLOSED"
-                                self.transport.loseConnection()
-                    # truncate the processed part of the buffer:
-                    self._buffer = self._buffer[j:]
-                    i, j, psw = self.process_header()
-                    if self._state == "KILLED":
-                        return
+                frame = self.next_frame()
         except Exception as e:
             logger.warning(f"Killing connection because of unhandled exception: {e}")
             self._state = "KILLED"
             self.transport.abortConnection()
             raise e
 
-    def send_obj(self, cmd='OBJ', obj=None):
-        self._server.ack_stamp += 1
-        msg = self._server.serializer((self._server.ack_stamp, cmd, obj))
-        msg = bytes(f"{len(msg):<{self._header_size}}", 'utf-8') + msg
-        self._server.pending_acks[self._server.ack_stamp] = (time.monotonic(), msg)
-        self.transport.write(msg)
+    def process_frame(self, frame, batch=None):
+        """
+        Executes the command of a frame.
+
+        :param frame: Frame: decoded frame
+        :param batch: set: if the frame is part of a batch, groups whose consumables are dispatched after the batch
+            (batches are acknowledged as a whole)
+        :return alive: bool: False if the connection has been killed
+        """
+        batched = batch is not None
+        flags = frame.flags & PAYLOAD_FLAGS  # forwarded along with the payload
+        try:
+            stamp, cmd, dest, obj = self.parse_frame(frame)
+            if batched and cmd not in BATCH_COMMANDS:
+                raise ValueError(f"Command {cmd} cannot be batched")
+        except ValueError as e:
+            logger.info(f"Invalid request: {e}.")
+            self._state = "KILLED"
+            self.transport.abortConnection()
+            return False
+        if cmd == 'ACK':
+            if self.link.acknowledge(stamp) is None and stamp != 0:
+                logger.debug(f"Received ACK for stamp {stamp}, which acknowledges no pending frame.")
+            self.send_backlog()
+            self._server.check_close()
+        else:
+            if not batched and stamp != 0:
+                duplicate = self.link.receive(stamp)
+                self.acknowledge(stamp)
+                if duplicate:
+                    logger.debug(f"Discarding frame {stamp} retransmitted by client {self._identifier}.")
+                    return True
+            if isinstance(dest, str):
+                dest = (dest, )
+            if cmd == "HELLO":
+                groups = obj
+                if isinstance(groups, str):
+                    groups = (groups,)
+                if self._server.check_new_client(groups=groups):
+                    logger.info(f"New client with groups {groups} (protocol: {'legacy' if self._legacy else PROTOCOL_VERSION}).")
+                    self._identifier = self._server.add_client(groups=groups, client=self)
+                    self._state = "ALIVE"
+                    self._decoder.max_data_len = None
+                    self.resume_link()
+                    self.retrieve_broadcast()
+                else:
+                    self._state = "CLOSED"
+                    self.transport.loseConnection()
+            elif self._state == "ALIVE":
+                # envelopes of the logical clients multiplexed on this connection identify their session:
+                session = frame.routing.get('session') if frame.routing is not None else None
+                client = self if not session else self._sessions.get(session)
+                if client is None:
+                    logger.warning(f"Received a command for unknown session {session} of client {self._identifier}, discarding it.")
+                elif cmd == "OBJ" and flags & FLAG_DELTA:
+                    logger.debug(f"Received delta from client {client._identifier} for groups {dest}.")
+                    client.forward_delta(delta=obj, routing=frame.routing, flags=flags)
+                elif cmd == "OBJ":
+                    logger.debug(f"Received object from client {client._identifier} for groups {dest}.")
+                    version = frame.routing.get('hash') if frame.routing is not None else None
+                    delta = frame.routing.get('delta', False) if frame.routing is not None else False
+                    client.forward_obj_to_dest(obj=obj, dest=dest, flags=flags, deferred=batch, version=version, delta=delta)
+                elif cmd == "CHK":
+                    client.forward_chunk(chunk=obj, routing=dest, flags=flags)
+                elif cmd == "NTF":
+                    logger.debug(f"Received notification from client {client._identifier} for destination {dest}.")
+                    client.retrieve_consumables(groups=dest)
+                elif cmd == "JOIN":
+                    self.join_session(obj)
+                elif cmd == "LEAVE":
+                    self.leave_session(obj)
+                elif cmd == "BAT":
+                    logger.debug(f"Received a batch of {len(obj)} commands from client {self._identifier}.")
+                    batch = set()
+                    for sub_frame in obj:
+                        if not self.process_frame(sub_frame, batch=batch):
+                            return False
+                    for group in batch:
+                        self.dispatch_pending_consumables(group)
+                else:
+                    logger.warning(f"Invalid command: {cmd}")
+                    self._state = "CLOSED"
+                    self.transport.loseConnection()
+        return True
+
+    def join_session(self, hello):
+        """
+        Adds a logical client multiplexed on this connection.
+
+        :param hello: dict: 'session' identifier, 'groups' and known 'broadcasts' of the logical client
+        """
+        session, groups = hello['session'], tuple(hello['groups'])
+        if session in self._sessions:
+            logger.warning(f"Session {session} of client {self._identifier} already exists.")
+        elif self._server.check_new_client(groups=groups):
+            logger.info(f"New session {session} of client {self._identifier} with groups {groups}.")
+            client = ServerSession(self, session, hello.get('broadcasts') or {})
+            client._identifier = self._server.add_client(groups=groups, client=client)
+            self._sessions[session] = client
+            client.retrieve_broadcast()
+        else:
+            logger.info(f"Refused session {session} of client {self._identifier} with groups {groups}.")
+
+    def leave_session(self, hello):
+        """
+        Removes a logical client multiplexed on this connection.
+
+        :param hello: dict: 'session' identifier of the logical client
+        """
+        client = self._sessions.pop(hello['session'], None)
+        if client is not None:
+            logger.info(f"Session {hello['session']} of client {self._identifier} closed.")
+            client.release()
+
+    def build_frame(self, stamp, cmd, obj, routing=None, flags=0):
+        """
+        Encodes a command for the client.
+
+        The payload and routing header are not copied, such that they can be shared by several frames.
+
+        :param routing: bytes: encoded routing header of objects (see encode_routing)
+        :param flags: int: payload flags of objects
+        :return parts: list of bytes: parts of the frame, to be written in order
+        """
+        if self._legacy is False:
+            if cmd in ('OBJ', 'CHK'):
+                if routing is None:
+                    routing = encode_routing({})
+                return [encode_header(cmd, len(routing) + len(obj), stamp, flags), routing, obj]
+            return [encode_frame(cmd, obj if obj is not None else b"", stamp=stamp)]
+        msg = self._server.serializer((stamp, cmd, obj))
+        return [encode_legacy_header(len(msg), self._header_size) + msg]
+
+    def send_obj(self, cmd='OBJ', obj=None, routing=None, flags=0, key=None, shared=False):
+        """
+        Sends a command to the client, or appends it to the backlog of the link if the window is closed.
+
+        Clients whose backlog exceeds max_backlog are disconnected (see drop_backlog).
+
+        :param key: hashable: if not None, the command supersedes the command of the backlog with the same key
+        :param shared: bool: whether obj is shared with a broadcast stored by the Relay, which it does not count
+            in the backlog (late joiners would otherwise never receive broadcasts larger than max_backlog)
+        """
+        if self._legacy:
+            flags &= ~FLAG_FIRE_AND_FORGET  # legacy clients acknowledge all frames
+        if flags and self._legacy:
+            logger.warning(f"Client {self._identifier} uses legacy frames and cannot decode this object, discarding it.")
+            return
+        if flags & FLAG_FIRE_AND_FORGET:
+            # fire-and-forget objects bypass the link (they may overtake waiting commands):
+            # they are neither acknowledged nor retransmitted
+            write_parts(self.transport, self.build_frame(0, cmd, obj, routing, flags))
+            return
+        if len(self.link.backlog) > 0 or not self.link.is_open():
+            # sent once frames in flight are acknowledged:
+            size = (len(obj) if obj is not None and not shared else 0) + (len(routing) if routing is not None else 0)
+            if not self.link.queue((cmd, obj, routing, flags), size, key):
+                self.drop_backlog()
+            return
+        self.send_command(cmd=cmd, obj=obj, routing=routing, flags=flags)
+
+    def send_command(self, cmd, obj, routing=None, flags=0):
+        msg = self.link.send(lambda stamp: self.build_frame(stamp, cmd, obj, routing, flags))
+        write_parts(self.transport, msg)
+
+    def send_backlog(self):
+        """
+        Sends the commands that wait for the window to open, in order.
+        """
+        while len(self.link.backlog) > 0 and self.link.is_open():
+            cmd, obj, routing, flags = self.link.next_command()
+            self.send_command(cmd=cmd, obj=obj, routing=routing, flags=flags)
+
+    def drop_backlog(self):
+        """
+        Disconnects a client that does not keep up with the commands sent to it.
+
+        Its link is released: the client starts over with the current broadcasts when it reconnects.
+        """
+        if self._state == "KILLED":
+            return
+        logger.warning(f"The backlog of client {self._identifier} exceeds {self.link.max_backlog} bytes, "
+                       f"dropping {len(self.link.backlog)} commands and disconnecting it.")
+        if self._token is not None and self._server.links.get(self._token) is self.link:
+            del self._server.links[self._token]
+        self.link.release()
+        self._state = "KILLED"
+        self.transport.abortConnection()
 
     def send_ack(self, stamp):
-        msg = self._server.serializer((stamp, 'ACK', None))
-        msg = bytes(f"{len(msg):<{self._header_size}}", 'utf-8') + msg
-        self.transport.write(msg)
+        msg = self.build_frame(stamp, 'ACK', None)
+        write_parts(self.transport, msg)
+
+    def acknowledge(self, stamp):
+        """
+        Acknowledges a frame received from the client.
+
+        Frames are acknowledged by a single cumulative ACK, once ack_every frames have been received
+        or ack_delay seconds after the first of them (legacy clients expect an ACK per frame).
+
+        :param stamp: int: stamp of the frame
+        """
+        if self._legacy:
+            self.send_ack(stamp)
+            return
+        self.link.unacknowledged += 1
+        if self.link.unacknowledged >= self._server.ack_every:
+            self.flush_ack()
+        elif self._ack_call is None:
+            self._ack_call = self._server.call_later(self._server.ack_delay, self.flush_ack)
+
+    def flush_ack(self):
+        """
+        Acknowledges all the frames received from the client so far.
+        """
+        if self._ack_call is not None and self._ack_call.active():
+            self._ack_call.cancel()
+        self._ack_call = None
+        if self.link.unacknowledged > 0:
+            self.link.unacknowledged = 0
+            self.send_ack(self.link.received)
+
+    def send_payload(self, obj, flags=0, routing=None, d_group=None, group=None):
+        """
+        Sends an object to the client.
+
+        :param obj: bytes or list of bytes: payload, or chunks of a chunked payload
+        :param flags: int: payload flags
+        :param routing: bytes: encoded routing header of unchunked payloads (see encode_routing)
+        :param d_group: dict: info of the group whose broadcast is sent, if any
+        :param group: str: group of the consumable that is sent, if any
+        """
+        if not isinstance(obj, list):
+            # a broadcast waiting in the backlog is superseded by the next broadcast to the group:
+            key = ('OBJ', d_group['name']) if d_group is not None else None
+            self.send_obj(cmd='OBJ', obj=obj, routing=routing, flags=flags, key=key, shared=d_group is not None)
+        elif self._legacy:
+            logger.warning(f"Client {self._identifier} uses legacy frames and cannot receive chunked objects, discarding it.")
+        else:
+            self._server.transfer_id += 1
+            size = sum(len(chunk) for chunk in obj)
+            for k, chunk in enumerate(obj):
+                routing = {'id': self._server.transfer_id, 'last': k == len(obj) - 1}
+                if k == 0:
+                    routing['size'] = size
+                    if d_group is not None:
+                        routing['groups'] = [d_group['name']]
+                        if d_group['version'] is not None:
+                            routing['hash'] = d_group['version']
+                        if d_group['delta']:
+                            routing['delta'] = True  # receivers keep the payload, to apply the next delta
+                    elif group is not None:
+                        routing['groups'] = [group]
+                self.send_obj(cmd='CHK', obj=chunk, routing=encode_routing(routing), flags=flags, shared=d_group is not None)
+
+    def is_legacy(self):
+        return self._legacy
 
     def retrieve_broadcast(self):
         if self._identifier is not None:
             for _, d_group in self._server.group_info.items():
                 if self._identifier in d_group['ids']:
                     to_broadcast = d_group['to_broadcast']
-                    if to_broadcast is not None:
-                        logger.debug("Sending object {to_broadcast} from retrieve broadcast")
-                        self.send_obj(cmd='OBJ', obj=to_broadcast)
+                    if to_broadcast is not None and d_group['version'] is not None \
+                            and self._known_broadcasts.get(d_group['name']) == d_group['version']:
+                        logger.debug(f"Client {self._identifier} already holds the broadcast of group {d_group['name']}.")
+                        d_group['versions'][self._identifier] = d_group['version']
+                    elif to_broadcast is not None and len(d_group['deltas']) > 0:
+                        # the full payload of the current version is rebuilt from the deltas first
+                        d_group['waiting'].add(self._identifier)
+                        self._server.rebuild_broadcast(d_group['name'])
+                    elif to_broadcast is not None:
+                        logger.debug("Sending object from retrieve broadcast")
+                        obj, flags = to_broadcast
+                        self.send_payload(obj=obj, flags=flags, routing=self.broadcast_routing(d_group),
+                                          d_group=d_group)
 
     def retrieve_consumables(self, groups):
         if self._identifier is not None:
@@ -151,12 +505,13 @@ class ServerProtocol(Protocol):
             d_group = self._server.group_info[group]
             to_consume = d_group['to_consume']
             pending_consumers = d_group['pending_consumers']
+            routing = encode_routing({'group': group})  # shared by all consumables
             for id in pending_consumers.keys():
                 while pending_consumers[id] > 0 and len(to_consume) > 0:
                     pending_consumers[id] -= 1
-                    obj = to_consume.popleft()
+                    obj, flags = to_consume.popleft()
                     logger.debug(f"Sending a consumable to client {id} from group {group} (remaining: {pending_consumers[id]}).")
-                    self._server.to_clients[id].send_obj(cmd='OBJ', obj=obj)
+                    self._server.to_clients[id].send_payload(obj=obj, flags=flags, routing=routing, group=group)
         else:
             logger.warning(f"Group {group} is not registered in the server.")
 
@@ -165,13 +520,165 @@ class ServerProtocol(Protocol):
         if group in self._server.group_info.keys():
             d_group = self._server.group_info[group]
             to_consume = d_group['to_consume']
-            pending_consumers = d_group['pending_consumers']
+            routing = encode_routing({'group': group})  # shared by all consumables
             while len(to_consume) > 0:
                 logger.debug(f'Sending a consumable to client {self._identifier} from group {group}.')
-                obj = to_consume.popleft()
-                self.send_obj(cmd='OBJ', obj=obj)
+                obj, flags = to_consume.popleft()
+                self.send_payload(obj=obj, flags=flags, routing=routing, group=group)
+
+    def forward_chunk(self, chunk, routing, flags=0):
+        """
+        Streams a chunk of a chunked payload to the clients of the destination broadcast groups.
+
+        Chunks are forwarded as soon as they are received, but the Relay still buffers them until the last one
+        is received: the payload is then broadcast to clients who joined during the transfer,
+        and stored as a list of chunks for future clients and consumers.
+        The previous broadcast of the destination groups is dropped when the transfer starts,
+        such that the Relay does not hold both payloads.
+        Chunked deltas are only streamed to the clients that hold their base version (see forward_delta).
+
+        :param chunk: bytes: the chunk
+        :param routing: dict: routing header of the chunk
+        :param flags: int: payload flags
+        """
+        if 'size' in routing:  # first chunk
+            dest = routing['dest']
+            assert isinstance(dest, dict), f"destination is a {type(dest)}; must be a dict."
+            self._server.transfer_id += 1
+            transfer = {'id': self._server.transfer_id,
+                        'dest': dest,
+                        'routing': routing,
+                        'version': routing.get('hash'),
+                        'delta': routing.get('delta', False),
+                        'size': routing['size'],
+                        'chunks': [],
+                        'recipients': set()}
+            if flags & FLAG_DELTA:
+                group = self.delta_group(routing)
+                if group is None:
+                    transfer['dest'] = None  # the chunks of the delta are discarded
+                else:
+                    transfer['recipients'] = self._server.delta_holders(group, routing['base'])
+            else:
+                recipients = set()
+                for group, value in dest.items():
+                    if value < 0 and self._server.try_add_group(group):
+                        recipients.update(self._server.group_info[group]['ids'])
+                        self._server.clear_broadcast(group)
+                legacy = {id_cli for id_cli in recipients if self._server.to_clients[id_cli].is_legacy()}
+                if len(legacy) > 0:
+                    logger.warning(f"Clients {legacy} use legacy frames and cannot receive chunked objects, discarding it.")
+                transfer['recipients'] = recipients - legacy
+            self._transfers[routing['id']] = transfer
+        else:
+            transfer = self._transfers.get(routing['id'])
+            if transfer is None:
+                logger.warning(f"Received a chunk of unknown transfer {routing['id']}, discarding it.")
+                return
+        if routing['last']:
+            del self._transfers[routing['id']]
+        if transfer['dest'] is None:
+            return
+        transfer['chunks'].append(chunk)
+        out_routing = {'id': transfer['id'], 'last': routing['last']}
+        if len(transfer['chunks']) == 1:
+            out_routing['size'] = transfer['size']
+            out_routing['groups'] = [group for group, value in transfer['dest'].items() if value < 0]
+            if transfer['version'] is not None:
+                # lets recipients record the version of the broadcasts they hold
+                out_routing['hash'] = transfer['version']
+            if transfer['delta']:
+                out_routing['delta'] = True  # receivers keep the payload, to apply the next delta
+            if flags & FLAG_DELTA:
+                out_routing['base'] = transfer['routing']['base']
+        self.stream_chunk(transfer, out_routing, chunk, flags)
+        if not routing['last']:
+            return
+        if flags & FLAG_DELTA:
+            # another producer may have broadcast to the group during the transfer:
+            group = self.delta_group(transfer['routing'])
+            if group is not None:
+                self._server.add_delta(group, transfer['chunks'], transfer['version'], flags, transfer['recipients'])
+        else:
+            self.forward_obj_to_dest(obj=transfer['chunks'], dest=transfer['dest'], flags=flags,
+                                     streamed=transfer['recipients'], version=transfer['version'],
+                                     delta=transfer['delta'])
+
+    def delta_group(self, routing):
+        """
+        Destination group of a delta, if the Relay holds its base version.
 
-    def forward_obj_to_dest(self, obj, dest):
+        Otherwise, the producer is asked to send the full payload instead.
+
+        :param routing: dict: routing header of the delta, with the destination group and the 'hash' and 'base' versions
+        :return group: str: the group (None if the delta must be discarded)
+        """
+        dest = routing['dest']
+        if not isinstance(dest, dict) or len(dest) != 1 or list(dest.values())[0] >= 0:
+            logger.warning(f"Invalid destination for a delta: {dest}, discarding it.")
+            return None
+        group = list(dest.keys())[0]
+        if not self._server.try_add_group(group):
+            return None
+        d_g = self._server.group_info[group]
+        if d_g['to_broadcast'] is None or d_g['version'] != routing['base']:
+            logger.debug(f"Base version of the delta for group {group} is unknown, requesting the full payload.")
+            self.send_obj(cmd='RST', obj=encode_control({'group': group, 'hash': routing['hash']}))
+            return None
+        return group
+
+    def forward_delta(self, delta, routing, flags):
+        """
+        Forwards a delta-encoded broadcast as is to the clients that hold its base version.
+
+        Other clients receive the full payload, that the Relay rebuilds from the deltas in a worker thread,
+        only when a client needs it (see Server.rebuild_broadcast).
+        If the Relay does not hold the base version, it asks the producer to send the full payload instead.
+
+        :param delta: bytes: the delta (see tlspyo.serialization.encode_delta)
+        :param routing: dict: routing header, with the destination group and the 'hash' and 'base' versions
+        :param flags: int: payload flags
+        """
+        group = self.delta_group(routing)
+        if group is None:
+            return
+        holders = self._server.delta_holders(group, routing['base'])
+        delta_routing = encode_routing({'group': group, 'hash': routing['hash'], 'delta': True, 'base': routing['base']})
+        for id_cli in holders:
+            self._server.to_clients[id_cli].send_obj(cmd='OBJ', obj=delta, routing=delta_routing, flags=flags)
+        self._server.add_delta(group, delta, routing['hash'], flags, holders)
+
+    def broadcast_routing(self, d_group):
+        """
+        Routing header of the broadcast of a group, with its version if the producer provided one.
+
+        Clients that receive the broadcast are recorded as holding its version.
+        """
+        if d_group['version'] is None:
+            return encode_routing({'group': d_group['name']})
+        for id_cli in d_group['ids']:
+            if not self._server.to_clients[id_cli].is_legacy():
+                d_group['versions'][id_cli] = d_group['version']
+        routing = {'group': d_group['name'], 'hash': d_group['version']}
+        if d_group['delta']:
+            routing['delta'] = True  # receivers keep the payload, to apply the next delta
+        return encode_routing(routing)
+
+    def stream_chunk(self, transfer, routing, chunk, flags=0):
+        routing = encode_routing(routing)  # shared by all recipients
+        for id_cli in transfer['recipients']:
+            if self._server.has_client(id_cli):
+                self._server.to_clients[id_cli].send_obj(cmd='CHK', obj=chunk, routing=routing, flags=flags)
+
+    def forward_obj_to_dest(self, obj, dest, flags=0, streamed=(), deferred=None, version=None, delta=False):
+        """
+        :param obj: bytes or list of bytes: payload, or chunks of a chunked payload
+        :param streamed: set of ints: clients to which the payload has already been streamed
+        :param deferred: set: if not None, groups whose consumables must be dispatched are added to this set
+            instead of being dispatched immediately
+        :param version: str: version (content hash) of broadcasts, if the producer provided one
+        :param delta: bool: whether the producer uses delta broadcasts
+        """
         if dest is not None:
             assert isinstance(dest, dict), f"destination is a {type(dest)}; must be a dict."
             for group, value in dest.items():
@@ -179,22 +686,78 @@ class ServerProtocol(Protocol):
                     d_g = self._server.group_info[group]
                     if value < 0:
                         # broadcast object to group
-                        d_g['to_broadcast'] = obj
+                        d_g['to_broadcast'] = (obj, flags)
+                        d_g['version'] = version
+                        d_g['delta'] = delta
+                        d_g['versions'] = {}
+                        d_g['deltas'] = []
+                        d_g['waiting'] = set()
                         ids = d_g['ids']
+                        # the payload and routing header are encoded once and shared by all recipients:
+                        routing = self.broadcast_routing(d_g)
                         for id_cli in ids:
-                            logger.debug(f"Sending object from group {group} to identifier {id_cli}.")
-                            self._server.to_clients[id_cli].send_obj(cmd='OBJ', obj=obj)
+                            if id_cli not in streamed:
+                                logger.debug(f"Sending object from group {group} to identifier {id_cli}.")
+                                self._server.to_clients[id_cli].send_payload(obj=obj, routing=routing, flags=flags,
+                                                                                   d_group=d_g)
                     elif value > 0:
                         # add object to group's consumables
                         logger.debug(f"Adding {value} copies of the consumable to group {group}.")
                         for _ in range(value):
-                            d_g['to_consume'].append(obj)
-                        self.dispatch_pending_consumables(group)
+                            d_g['to_consume'].append((obj, flags))
+                        if deferred is not None:
+                            deferred.add(group)
+                        else:
+                            self.dispatch_pending_consumables(group)
 
     def get_state(self):
         return self._state
 
 
+class ServerSession(ServerProtocol):
+    """
+    Logical client multiplexed on the connection of a ServerProtocol (see tlspyo.api.EndpointPool).
+
+    It is registered in the Relay like any other client, and its frames are sent on the connection
+    with its session identifier in their routing header.
+    """
+
+    def __init__(self, protocol, session, known_broadcasts):
+        """
+        :param protocol: ServerProtocol: protocol of the connection
+        :param session: int: session identifier, chosen by the client
+        :param known_broadcasts: dict: versions of the broadcasts that the logical client already holds, by group
+        """
+        self._server = protocol._server
+        self._protocol = protocol
+        self._session = session
+        self._identifier = None
+        self._state = "ALIVE"
+        self._legacy = False
+        self._transfers = {}
+        self._known_broadcasts = known_broadcasts
+        self._sessions = {}
+        self.transport = protocol.transport
+
+    @property
+    def link(self):
+        return self._protocol.link
+
+    def flush_ack(self):
+        self._protocol.flush_ack()
+
+    def send_obj(self, cmd='OBJ', obj=None, routing=None, flags=0, key=None, shared=False):
+        if key is not None:
+            key = (self._session, ) + key
+        if cmd in ('OBJ', 'CHK'):
+            fields = decode_control(memoryview(routing)[ROUTING_SIZE.size:]) if routing is not None else {}
+            fields['session'] = self._session
+            routing = encode_routing(fields)
+        elif cmd == 'RST':
+            obj = encode_control(dict(decode_control(obj), session=self._session))
+        self._protocol.send_obj(cmd=cmd, obj=obj, routing=routing, flags=flags, key=key, shared=shared)
+
+
 class ServerProtocolFactory(Factory):
 
     protocol = ServerProtocol
@@ -216,14 +779,23 @@ class Server:
                  accepted_groups=None,
                  header_size=10,
                  local_com_port=2097,
+                 local_com_sock=None,
                  security="TLS",
-                 keys_dir=None):
+                 keys_dir=None,
+                 compression=None,
+                 compression_threshold=None,
+                 ack_window=DEFAULT_ACK_WINDOW,
+                 ack_every=DEFAULT_ACK_EVERY,
+                 ack_delay=DEFAULT_ACK_DELAY,
+                 reconnection_timeout=DEFAULT_RECONNECTION_TIMEOUT,
+                 max_backlog=DEFAULT_MAX_BACKLOG):
 
         self.serializer = serializer
         self.deserializer = deserializer
 
         self._port = port
         self._local_com_port = local_com_port
+        self.local_com_sock = local_com_sock  # end of the local socketpair, if the channel is not a TCP port
         assert self._local_com_port != self._port, f"Internet and local ports are the same ({self._port})."
         self.password = password
         self.header_size = header_size
@@ -231,12 +803,22 @@ class Server:
         self.to_clients = {}  # dict of identifiers to protocols toward clients
         self.group_info = {}  # dictionary of group names to dicts of group info
         self._id_cpt = 0
-        self.ack_stamp = 0
-        self.pending_acks = {}  # this contains copies of sent commands until corresponding ACKs are received
+        self.transfer_id = 0  # identifier of the last chunked transfer sent to clients
+        self.ack_window = ack_window  # maximum number of frames in flight toward each client
+        self.ack_every = ack_every  # number of frames received from a client that are acknowledged at once
+        self.ack_delay = ack_delay  # max delay before the frames received from a client are acknowledged
+        self.reconnection_timeout = reconnection_timeout  # seconds during which links of disconnected clients are kept
+        self.max_backlog = max_backlog  # max size in bytes of the commands waiting for the window of a client
+        self.links = {}  # links of the clients that can reconnect, by token (see tlspyo.reliability.Link)
+        self._closing = False  # whether we terminate once all pending ACKs are received
+        self._close_deadline = None  # terminates the server if pending ACKs are not received in time
         self._reactor = None
         self._listener = None
+        self._stop = None  # called when the server is closed
         self._security = security
         self._keys_dir = keys_dir
+        self._compression = compression
+        self._compression_threshold = compression_threshold
 
     def run(self):
         """
@@ -247,14 +829,35 @@ class Server:
         # from twisted.internet.interfaces import IReadDescriptor
         from twisted.internet import reactor
 
+        if not self.start(reactor):
+            return
+
+        self._reactor.run()  # main Twisted reactor loop
+        self._reactor = None  # remove when done
+
+    def start(self, reactor, local=None, stop=None):
+        """
+        Connects to the local Relay and starts listening.
+
+        :param reactor: the Twisted reactor (must be called in its thread)
+        :param local: InProcessConnection: in-memory connection to the Relay (None to connect to local_com_port)
+        :param stop: callable: called when the server is closed (None to stop the reactor)
+        :return success: bool: whether the server is listening
+        """
         # Start local communication
-        reactor.connectTCP(host='127.0.0.1', port=self._local_com_port, factory=LocalProtocolForServerFactory(self))
+        if self.local_com_sock is not None:
+            reactor.adoptStreamConnection(self.local_com_sock.fileno(), self.local_com_sock.family, LocalProtocolForServerFactory(self))
+            self.local_com_sock.close()  # the reactor uses a copy
+        elif local is None:
+            reactor.connectTCP(host='127.0.0.1', port=self._local_com_port, factory=LocalProtocolForServerFactory(self))
+        else:
+            local.connect()
 
         # Start relay server
         factory = ServerProtocolFactory(self)
         if self._security == "TCP":
             logger.info(f"Listening on TCP to port {self._port}")
-            reactor.listenTCP(self._port, factory)
+            self._listener = reactor.listenTCP(self._port, factory)
         elif self._security == "TLS":
             # Use default keys if none are provided
             private_key = os.path.join(self._keys_dir, 'key.pem') if self._keys_dir is not None else os.path.join(get_default_keys_folder(), 'key.pem')
@@ -267,14 +870,14 @@ class Server:
                     Make sure that you are providing a correct path, that your private key is named 'private.key' and that your public key is named 'selfsigned.crt'. \
                     You can use the script generate_certificates.py to generate the keys.")
             logger.info(f"Listening on TLS to port {self._port}, with credentials {private_key} and {self_signed}")
-            reactor.listenSSL(self._port, factory, context)
+            self._listener = reactor.listenSSL(self._port, factory, context)
         else:
             logger.warning(f"Unsupported connection: {self._security}")
-            return
+            return False
 
         self._reactor = reactor
-        self._reactor.run()  # main Twisted reactor loop
-        self._reactor = None  # remove when done
+        self._stop = stop if stop is not None else reactor.stop
+        return True
 
     def add_accepted_group(self, group, max_count=None, max_consumables=None):
         """
@@ -289,6 +892,37 @@ class Server:
         self._accepted_groups[group] = {'max_count': max_count,
                                         'max_consumables': max_consumables}
 
+    def compression_settings(self):
+        """
+        Compression settings advertised to clients in the HELLO.
+
+        Payloads are compressed by the sending Endpoints, the Relay forwards them as is.
+        A setting is either None (no compression) or a [codec, threshold] list.
+
+        :return settings: dict: 'default' setting, and settings of accepted 'groups'
+        """
+        default = [self._compression, self._compression_threshold] if self._compression is not None else None
+        groups = {}
+        if self._accepted_groups is not None:
+            for group, d_group in self._accepted_groups.items():
+                codec = d_group.get('compression', self._compression)
+                threshold = d_group.get('compression_threshold', self._compression_threshold)
+                groups[group] = [codec, threshold] if codec is not None else None
+        return {'default': default, 'groups': groups}
+
+    def qos_settings(self):
+        """
+        QoS of the accepted groups that set one, advertised to clients in the HELLO.
+
+        :return settings: dict: QoS by group
+        """
+        settings = {}
+        if self._accepted_groups is not None:
+            for group, d_group in self._accepted_groups.items():
+                if d_group.get('qos') is not None:
+                    settings[group] = d_group['qos']
+        return settings
+
     def check_new_client(self, groups):
         """
         Checks whether a client can be added to requested groups.
@@ -336,12 +970,115 @@ class Server:
     def add_group(self, group, max_consumables=None):
         if group not in self.group_info.keys():
             logger.debug(f"Adding group {group} to relay")
-            self.group_info[group] = {'ids': [],  # ids of the clients present in this group
-                                      'to_broadcast': None,  # object to broadcast
-                                      'to_consume': deque(maxlen=max_consumables) if max_consumables is not None else deque(),  # queue of objects to consume
+            self.group_info[group] = {'name': group,
+                                      'ids': [],  # ids of the clients present in this group
+                                      'to_broadcast': None,  # object to broadcast, with its payload flags
+                                      'version': None,  # content hash of to_broadcast (None if unknown)
+                                      'delta': False,  # whether to_broadcast comes from a delta producer
+                                      'versions': {},  # dict mapping client ids to the version of to_broadcast they hold
+                                      'deltas': [],  # deltas (with their payload flags) not yet applied to to_broadcast
+                                      'waiting': set(),  # ids of the clients waiting for the payload rebuilt from deltas
+                                      'rebuilding': False,  # whether the deltas are being applied in a worker thread
+                                      'to_consume': deque(maxlen=max_consumables) if max_consumables is not None else deque(),  # queue of objects to consume, with their payload flags
                                       'pending_consumers': {}  # dict mapping client ids to number of remaining consumables to send from this group
                                       }
 
+    def delta_holders(self, group, version):
+        """
+        Clients of a group that hold a given version of its broadcast.
+
+        :param group: str: the group
+        :param version: str: the version
+        :return ids: set of ints: ids of the clients
+        """
+        return {id_cli for id_cli, v in self.group_info[group]['versions'].items() if v == version}
+
+    def add_delta(self, group, delta, version, flags, holders):
+        """
+        Makes a delta the new version of the broadcast of a group.
+
+        The delta is kept until it is applied to the stored payload by rebuild_broadcast,
+        which happens when a client needs the full payload, or when the deltas get larger than the payload.
+
+        :param group: str: the group
+        :param delta: bytes or list of bytes: the delta, or its chunks
+        :param version: str: the new version
+        :param flags: int: payload flags of the delta
+        :param holders: set of ints: clients that received the delta, and thus hold the new version
+        """
+        d_g = self.group_info[group]
+        d_g['deltas'].append((delta, flags))
+        d_g['version'] = version
+        d_g['delta'] = True
+        for id_cli in d_g['ids']:
+            if id_cli in holders:
+                d_g['versions'][id_cli] = version
+            elif not self.to_clients[id_cli].is_legacy():
+                d_g['versions'].pop(id_cli, None)
+                d_g['waiting'].add(id_cli)
+        if len(d_g['waiting']) > 0 or _payload_size(d_g['deltas']) > _payload_size([d_g['to_broadcast']]):
+            self.rebuild_broadcast(group)
+
+    def rebuild_broadcast(self, group):
+        """
+        Applies the pending deltas of a group to its stored payload, in a worker thread of the reactor.
+
+        The payload is then sent to the clients waiting for it.
+
+        :param group: str: the group
+        """
+        d_g = self.group_info[group]
+        if d_g['rebuilding'] or len(d_g['deltas']) == 0:
+            return
+        d_g['rebuilding'] = True
+        base = d_g['to_broadcast']
+        deltas = list(d_g['deltas'])
+        d = threads.deferToThreadPool(self._reactor, self._reactor.getThreadPool(),
+                                      rebuild_payload, base[0], [delta for delta, _ in deltas])
+        d.addCallbacks(self.rebuilt_broadcast, self.failed_rebuild,
+                       callbackArgs=(group, base, deltas), errbackArgs=(group,))
+
+    def rebuilt_broadcast(self, payload, group, base, deltas):
+        d_g = self.group_info[group]
+        d_g['rebuilding'] = False
+        if d_g['to_broadcast'] is not base:
+            # a full payload was broadcast in the meantime
+            return
+        d_g['to_broadcast'] = (payload, deltas[-1][1] & ~FLAG_DELTA)
+        d_g['deltas'] = d_g['deltas'][len(deltas):]
+        if len(d_g['deltas']) > 0:
+            # the group received new deltas in the meantime
+            if len(d_g['waiting']) > 0:
+                self.rebuild_broadcast(group)
+            return
+        waiting = d_g['waiting']
+        d_g['waiting'] = set()
+        routing = encode_routing({'group': group, 'hash': d_g['version'], 'delta': True})
+        payload, flags = d_g['to_broadcast']
+        for id_cli in waiting:
+            if id_cli in d_g['ids']:
+                logger.debug(f"Sending rebuilt object from group {group} to identifier {id_cli}.")
+                d_g['versions'][id_cli] = d_g['version']
+                self.to_clients[id_cli].send_payload(obj=payload, routing=routing, flags=flags, d_group=d_g)
+
+    def failed_rebuild(self, failure, group):
+        logger.error(f"Could not apply the deltas of group {group}, discarding its broadcast: {failure.getErrorMessage()}")
+        self.group_info[group]['rebuilding'] = False
+        self.clear_broadcast(group)
+
+    def clear_broadcast(self, group):
+        """
+        Drops the broadcast of a group, e.g., when a new one is being received.
+
+        :param group: str: the group
+        """
+        d_g = self.group_info[group]
+        d_g['to_broadcast'] = None
+        d_g['version'] = None
+        d_g['versions'] = {}
+        d_g['deltas'] = []
+        d_g['waiting'] = set()
+
     def delete_client(self, identifier):
         for group, d_group in self.group_info.items():
             idents = d_group['ids']
@@ -349,6 +1086,8 @@ class Server:
                 logger.debug(f"Removing client {identifier} from group {group}.")
                 idents.remove(identifier)
                 del d_group['pending_consumers'][identifier]
+                d_group['versions'].pop(identifier, None)
+                d_group['waiting'].discard(identifier)
         logger.debug(f"Removing client {identifier} from list of clients.")
         del self.to_clients[identifier]
 
@@ -359,28 +1098,94 @@ class Server:
         """Returns true if we are not waiting for acknowledgements.
 
         Returns:
-            bool: Whether the dictionary of pending acknowledgements is empty.
+            bool: Whether all the commands sent to connected clients have been acknowledged.
+        """
+        links = {client.link for client in self.to_clients.values()}
+        return all(link.is_idle() for link in links)
+
+    def release_link(self, token):
+        """
+        Releases the link of a client that did not reconnect.
+
+        :param token: str: token of the client
         """
-        res = len(self.pending_acks.keys()) == 0 
-        return res
+        link = self.links.get(token)
+        if link is not None and link.owner is None:
+            logger.debug(f"Releasing {len(link.pending)} frames in flight toward a disconnected client.")
+            del self.links[token]
+            link.release()
 
-    def close(self, counter):
+    def stats(self):
+        """
+        Statistics of the Relay, mainly about the memory held for unacknowledged frames.
+
+        Payloads shared by several frames (e.g., broadcasts) are counted in pending_bytes for each of them.
 
-        # Check if we are allowed to leave by looking at acknowledgements
-        logger.debug(f"Attempting to terminate Relay for {counter}th time")
+        :return stats: dict: 'clients' (connected clients),
+            'retained_links' (links of disconnected clients kept for reconnection),
+            'pending_frames' and 'pending_bytes' (frames in flight toward all clients, and their size),
+            'backlog' and 'backlog_bytes' (commands waiting for the window of their client to open, and their size)
+        """
+        links = {client.link for client in self.to_clients.values()}
+        retained = [link for link in self.links.values() if link.owner is None]
+        links.update(retained)
+        return {'clients': len(self.to_clients),
+                'retained_links': len(retained),
+                'pending_frames': sum(len(link.pending) for link in links),
+                'pending_bytes': sum(link.pending_bytes for link in links),
+                'backlog': sum(len(link.backlog) for link in links),
+                'backlog_bytes': sum(link.backlog_bytes for link in links)}
 
-        if self.check_acks() or counter > 10:
-            if self._reactor is not None:
-                identifiers = list(self.to_clients.keys())
-                for identifier in identifiers:
-                    self.to_clients[identifier].transport.loseConnection()
-                    self.delete_client(identifier)
-                logger.info(f"Succesfully terminated relay connections")
-                self._reactor.stop()
+    def is_closing(self):
+        return self._closing
+
+    def call_later(self, delay, f, *args):
+        return self._reactor.callLater(delay, f, *args)
+
+    def close(self, timeout=DEFAULT_STOP_TIMEOUT, force=False):
+        """
+        Terminates the server as soon as all pending ACKs are received.
+
+        :param timeout: float: maximum number of seconds to wait for pending ACKs (None to wait indefinitely)
+        :param force: bool: if True, the server is terminated immediately (also if it is already closing)
+        """
+        if self._closing:
+            if force:
+                self.terminate()  # stop waiting for pending ACKs
+            return
+        self._closing = True
+        if force or self.check_acks():
+            self.terminate()
         else:
-            from twisted.internet import reactor
-            reactor.callLater(1, self.close, counter+1)
-        
+            logger.debug("Waiting for pending ACKs before terminating Relay.")
+            if timeout is not None and self._reactor is not None:
+                self._close_deadline = self._reactor.callLater(timeout, self.terminate)
+
+    def check_close(self):
+        """
+        Called when an ACK is received: terminates the server if it was waiting for this ACK to close.
+        """
+        if self._closing and self.check_acks():
+            self.terminate()
+
+    def terminate(self):
+        if self._close_deadline is not None:
+            if self._close_deadline.active():
+                self._close_deadline.cancel()
+            else:
+                logger.warning("Terminating Relay with pending ACKs.")
+            self._close_deadline = None
+        if self._reactor is not None and self._stop is not None:
+            identifiers = list(self.to_clients.keys())
+            for identifier in identifiers:
+                self.to_clients[identifier].flush_ack()
+                self.to_clients[identifier].transport.loseConnection()
+                self.delete_client(identifier)
+            logger.info(f"Succesfully terminated relay connections")
+            # the reactor may be shared with other servers, we release the port before stopping:
+            stop, self._stop = self._stop, None  # the server is terminated only once
+            defer.maybeDeferred(self._listener.stopListening).addBoth(lambda _: stop())
+
 
 if __name__ == "__main__":
     pass
@@ -0,0 +1,86 @@
+import os
+import struct
+
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:  # python < 3.8
+    shared_memory = None
+
+
+# Payloads are passed in shared memory between Endpoints and their Twisted process on POSIX systems
+# (on Windows, a segment is destroyed as soon as its writer closes it, before the reader can open it)
+SHM_AVAILABLE = shared_memory is not None and os.name == 'posix'
+
+# Payloads smaller than this are sent through the local socket, unless the Endpoint specifies another threshold
+DEFAULT_SHM_THRESHOLD = 262144
+
+# Body of local frames whose payload is in shared memory: size of the payload, name of the segment
+SHM_HEADER = struct.Struct('!Q')
+
+
+def _open_segment(name=None, size=0):
+    """
+    Creates (name is None) or opens a shared memory segment, which the calling process does not track.
+
+    Segments are created by one process and destroyed by another one, which the resource tracker does not support.
+    """
+    create = name is None
+    try:
+        return shared_memory.SharedMemory(name=name, create=create, size=size, track=False)
+    except TypeError:  # python < 3.13, segments are tracked until they are unlinked
+        shm = shared_memory.SharedMemory(name=name, create=create, size=size)
+        if create:
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+
+def write_shared(parts, size):
+    """
+    Writes a payload into a new shared memory segment.
+
+    The segment is destroyed by read_shared (or discard_shared, if the payload is not read).
+
+    :param parts: list of bytes-like: parts of the payload
+    :param size: int: size of the payload
+    :return body: bytes: body of the local frame that refers to the segment
+    """
+    shm = _open_segment(size=max(size, 1))
+    try:
+        offset = 0
+        for part in parts:
+            view = memoryview(part).cast('B')
+            shm.buf[offset:offset + len(view)] = view
+            offset += len(view)
+    finally:
+        shm.close()
+    return SHM_HEADER.pack(size) + shm.name.encode('ascii')
+
+
+def read_shared(body, writable=False):
+    """
+    Reads a payload written by write_shared, and destroys its shared memory segment.
+
+    :param body: bytes-like: body of the local frame output by write_shared
+    :param writable: bool: whether the payload is returned as a bytearray
+    :return payload: bytes or bytearray: the payload
+    """
+    size = SHM_HEADER.unpack_from(body)[0]
+    shm = _open_segment(name=bytes(body[SHM_HEADER.size:]).decode('ascii'))
+    try:
+        with shm.buf[:size] as view:
+            payload = bytearray(view) if writable else bytes(view)
+    finally:
+        shm.close()
+        shm.unlink()
+    return payload
+
+
+def discard_shared(body):
+    """
+    Destroys the shared memory segment of a payload written by write_shared, without reading it.
+
+    :param body: bytes-like: body of the local frame output by write_shared
+    """
+    shm = _open_segment(name=bytes(body[SHM_HEADER.size:]).decode('ascii'))
+    shm.close()
+    shm.unlink()